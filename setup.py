@@ -46,6 +46,10 @@ setup(
     ],
 
     install_requires=REQUIRES,
+    extras_require={
+        'zstd': ['zstandard'],
+        'parquet': ['pyarrow'],
+    },
     tests_require=['coverage', 'pytest'],
 
     packages=find_packages(),
@@ -0,0 +1,93 @@
+import json
+import socketserver
+import threading
+
+from twitter_scraping import async_stream
+from twitter_scraping.async_stream import AsyncStream
+from twitter_scraping.replay import ReplayServer, synthetic_tweets
+
+
+class _NoAuth(object):
+    def apply_auth(self):
+        return None
+
+
+class _Listener(object):
+    def __init__(self, timeouts_allowed=0):
+        self.ids = []
+        self.events = []
+        self._timeouts_allowed = timeouts_allowed
+
+    def on_connect(self):
+        self.events.append('connect')
+
+    def on_data(self, raw_data):
+        message = json.loads(raw_data)
+        if 'disconnect' in message:
+            return False
+        self.ids.append(message['id'])
+
+    def on_error(self, status_code):
+        self.events.append(status_code)
+
+    def on_timeout(self):
+        self.events.append('timeout')
+        self._timeouts_allowed -= 1
+        if self._timeouts_allowed < 0:
+            return False
+
+    def on_exception(self, exception):
+        self.events.append(exception)
+
+
+def _stream(server, listener, **kwargs):
+    return AsyncStream(_NoAuth(), listener, host=server.url.split("//")[1], secure=False, **kwargs)
+
+
+def test_several_streams_share_one_loop_and_back_off_after_errors():
+    tweets = list(synthetic_tweets(50))
+    servers = [ReplayServer(tweets, error_codes=[503]).start() for _ in range(2)]
+    try:
+        listeners = [_Listener(), _Listener()]
+        streams = [_stream(server, listener, retry_time_start=0.01) for server, listener in zip(servers, listeners)]
+        async_stream.run(*[stream.filter(track=["cats"]) for stream in streams])
+    finally:
+        for server in servers:
+            server.stop()
+    expected = [json.loads(tweet.decode('utf-8'))['id'] for tweet in tweets]
+    for listener in listeners:
+        assert listener.events == [503, 'connect']
+        assert listener.ids == expected
+
+
+class _StallingHandler(socketserver.StreamRequestHandler):
+    # Sends one tweet, then nothing at all until the client hangs up
+    def handle(self):
+        while self.rfile.readline().strip():
+            pass
+        self.server.connections += 1
+        message = b"".join(synthetic_tweets(1)) + b"\r\n"
+        self.wfile.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+        self.wfile.write(b"%x\r\n" % len(message) + message + b"\r\n")
+        self.wfile.flush()
+        self.rfile.read(1)
+
+
+def test_stalled_connections_are_reestablished():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _StallingHandler)
+    server.daemon_threads = True
+    server.connections = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        listener = _Listener(timeouts_allowed=1)
+        stream = AsyncStream(_NoAuth(), listener, host="127.0.0.1:{}".format(server.server_address[1]), secure=False,
+                             stall_timeout=0.3, snooze_time_step=0.01)
+        async_stream.run(stream.filter(track=["cats"]))
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    assert listener.events == ['connect', 'timeout', 'connect', 'timeout']
+    assert len(listener.ids) == 2
+    assert server.connections == 2
@@ -0,0 +1,134 @@
+import glob
+import json
+
+import pytest
+import tweepy
+
+from twitter_scraping import cli
+from twitter_scraping.backfill import SEARCH, USER_TIMELINE, Backfill, backfill_queries
+from twitter_scraping.dedup import WindowedIdSet
+from twitter_scraping.email import DummyEmailer
+from twitter_scraping.manifest import ManifestLocked, ShardManifest
+from twitter_scraping.replay import MockApiServer
+from twitter_scraping.scraper import ScraperBuilder, ScraperStreamListener
+from twitter_scraping.shard_index import created_at_ms
+
+BASE_ID = 1300000000000000000
+
+
+def _id(n):
+    return BASE_ID + (n << 22)
+
+
+def _time(n):
+    return created_at_ms(_id(n)) / 1000.0
+
+
+def _status(n, user_id=1, text="cats"):
+    return json.dumps({'created_at': "Sat Mar 27 12:00:00 +0000 2021", 'id': _id(n), 'id_str': str(_id(n)),
+                       'text': "{} {}".format(text, n), 'in_reply_to_status_id': None,
+                       'user': {'id': user_id, 'id_str': str(user_id), 'screen_name': "user{}".format(user_id)}})
+
+
+@pytest.fixture
+def server():
+    tweets = [_status(n, text="cats" if n % 2 else "dogs", user_id=n % 3) for n in range(300)]
+    server = MockApiServer(tweets, limits={SEARCH: 3}, window_seconds=1.0, error_codes=[503]).start()
+    yield server
+    server.stop()
+
+
+def _fetch(server, queries, ranges):
+    fetched = []
+    backfill = Backfill(None, queries, ranges, api_url=server.url, workers=2, retry_delay=0.01)
+    assert backfill.run(fetched.append) == len(fetched)
+    return backfill, sorted(json.loads(s)['id'] for s in fetched)
+
+
+def test_fetches_each_range_through_pages_and_rate_limits(server):
+    # The first range takes two pages of search, and the fourth request
+    # onwards waits for the rate limit window
+    backfill, ids = _fetch(server, backfill_queries(track=["cats"]), [(_time(0), _time(250)), (_time(260), None)])
+    assert ids == [_id(n) for n in range(300) if n % 2 and not 250 <= n < 260]
+    assert backfill.num_failed == 0
+    # The injected 503 is retried
+    assert server.num_requests > 4
+
+
+def test_fetches_user_timelines(server):
+    _, ids = _fetch(server, backfill_queries(follow=["2"]), [(_time(100), _time(200))])
+    assert ids == [_id(n) for n in range(100, 200) if n % 3 == 2]
+
+
+def test_abandons_queries_which_fail(server):
+    backfill, ids = _fetch(server, [(USER_TIMELINE, {'user_id': "7"}), ('statuses/missing', {})], [(_time(0), None)])
+    assert ids == []
+    assert backfill.num_failed == 1
+
+
+def _builder(output_dir, server):
+    auth = tweepy.OAuthHandler("key", "secret")
+    auth.set_access_token("token", "token secret")
+    return ScraperBuilder().track(["cats"]).output_dir(str(output_dir)).api_url(server.url).auth(auth) \
+        .emailer(DummyEmailer()).raw(True)
+
+
+def test_writes_fetched_tweets_through_the_listener(tmpdir, server):
+    with _builder(tmpdir, server).backfill([(_time(0), _time(20))], workers=1) as num_fetched:
+        assert num_fetched == 10
+    ids = []
+    for filename in glob.glob(str(tmpdir.join("tweets-shard-*[0-9].json"))):
+        with open(filename) as f:
+            ids.extend(json.loads(line)['id'] for line in f)
+    assert sorted(ids) == [_id(n) for n in range(20) if n % 2]
+
+
+def _written_ids(output_dir):
+    ids = []
+    for filename in glob.glob(str(output_dir.join("tweets-shard-*[0-9].json"))):
+        with open(filename) as f:
+            ids.extend(json.loads(line)['id'] for line in f)
+    return sorted(ids)
+
+
+def test_only_reads_the_dedup_snapshot(tmpdir, server):
+    snapshot = str(tmpdir.join("dedup.snapshot"))
+    stream_ids = WindowedIdSet()
+    stream_ids.check_and_add(str(_id(1)))
+    stream_ids.check_and_add(str(_id(3)))
+    stream_ids.save(snapshot)
+    with open(snapshot, "rb") as f:
+        saved = f.read()
+    builder = _builder(tmpdir.mkdir("backfill"), server).dedup('window').dedup_snapshot(snapshot)
+    with builder.backfill([(_time(0), _time(10))], workers=1):
+        pass
+    assert _written_ids(tmpdir.join("backfill")) == [_id(n) for n in (5, 7, 9)]
+    with open(snapshot, "rb") as f:
+        assert f.read() == saved
+    assert tmpdir.listdir(lambda p: p.basename.endswith(".tmp")) == []
+
+
+def test_refuses_the_directory_of_a_running_stream(tmpdir, server):
+    with ScraperStreamListener(str(tmpdir), emailer=DummyEmailer(), raw=True) as listener:
+        listener.on_data(_status(1))
+        with pytest.raises(SystemExit):
+            with _builder(tmpdir, server).backfill([(_time(0), None)]):
+                pass
+    # Left as it was, for the stream to carry on with
+    with open(str(tmpdir.join("tweets-shard-1.json"))) as f:
+        assert [json.loads(line)['id'] for line in f] == [_id(1)]
+
+
+def test_refuses_a_directory_in_use(tmpdir, server):
+    # Even without open shards in its manifest, such as while the stream
+    # is starting up
+    manifest = ShardManifest(str(tmpdir))
+    try:
+        with pytest.raises(ManifestLocked):
+            ShardManifest(str(tmpdir))
+        assert cli.backfill(["--track", "cats", "-o", str(tmpdir), "--since", str(_time(0)),
+                             "--api-url", server.url]) == 1
+    finally:
+        manifest.close()
+    # Free again once the other run has finished
+    ShardManifest(str(tmpdir)).close()
@@ -0,0 +1,36 @@
+import json
+
+import pytest
+
+from twitter_scraping import cli
+from twitter_scraping.email import DummyEmailer
+from twitter_scraping.scraper import SamplingOptions, ScraperStreamListener
+
+# pyarrow comes with the optional 'parquet' extra
+pq = pytest.importorskip("pyarrow.parquet")
+
+BASE_ID = 1300000000000000000
+
+
+def _status(n):
+    return json.dumps({'created_at': "Sat Mar 27 12:00:00 +0000 2021", 'id': BASE_ID + (n << 22),
+                       'id_str': str(BASE_ID + (n << 22)), 'text': "tweet #{}".format(n), 'lang': "en",
+                       'in_reply_to_status_id': None, 'entities': {'hashtags': [{'text': str(n)}]},
+                       'user': {'id': n, 'id_str': str(n), 'screen_name': "user{}".format(n)}})
+
+
+def test_convert_drop_json_keeps_record_sidecars(tmpdir):
+    with ScraperStreamListener(str(tmpdir), emailer=DummyEmailer(), raw=True, sampling=SamplingOptions(rate=0.5)) as listener:
+        for n in range(50):
+            listener.on_data(_status(n))
+    assert tmpdir.join("tweets-shard-1.json.sample.json").exists()
+
+    cli.convert([str(tmpdir), "--drop-json"])
+
+    table = pq.read_table(str(tmpdir.join("tweets-shard-1.parquet")))
+    with open(str(tmpdir.join("tweets-shard-1.parquet.sample.json"))) as f:
+        sample = json.load(f)
+    assert sample['seen'] == 50 and sample['kept'] == table.num_rows
+    assert table.column('hashtags').to_pylist()[0] == [str(table.column('user_id')[0].as_py())]
+    leftovers = [p.basename for p in tmpdir.listdir() if p.basename.startswith("tweets-shard-1.json")]
+    assert leftovers == []
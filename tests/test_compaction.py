@@ -0,0 +1,105 @@
+import json
+import os
+
+from twitter_scraping.compaction import SORT_TIME, ShardCompactor
+from twitter_scraping.compression import get_codec
+from twitter_scraping.reader import ShardQuery
+from twitter_scraping.shard_index import ShardReader
+from twitter_scraping.storage import LocalStorage
+
+BASE_ID = 1300000000000000000
+
+
+def _tweet(n, **fields):
+    tweet = {'id_str': str(BASE_ID + (n << 22)), 'text': "tweet {}".format(n)}
+    tweet.update(fields)
+    return json.dumps(tweet, separators=(',', ':'))
+
+
+def _write_shard(path, lines, codec=None):
+    data = "".join(line + "\n" for line in lines).encode('utf-8')
+    with open(path, "wb") as f:
+        writer = get_codec(codec or 'none').open_writer(f)
+        writer.write(data)
+        if writer is not f:
+            writer.close()
+
+
+def _read(output_dir):
+    return [json.loads(line.decode('utf-8')) for line in ShardQuery(LocalStorage(output_dir), raw=True, processes=1)]
+
+
+def test_drops_duplicates_across_shards_and_sorts(tmpdir):
+    source = tmpdir.mkdir("source")
+    _write_shard(str(source.join("tweets-shard-1.json")), [_tweet(n, copy=1) for n in (5, 3, 1)])
+    _write_shard(str(source.join("tweets-shard-2.json.gz")), [_tweet(n, copy=2) for n in (4, 3, 2, 1)], codec='gzip')
+    source.mkdir("worker-1")
+    _write_shard(str(source.join("worker-1", "tweets-shard-1.json")), [_tweet(n, copy=3) for n in (6, 5)])
+    output = str(tmpdir.join("output"))
+
+    report = ShardCompactor(LocalStorage(str(source)), output, max_records=4, processes=1).run()
+
+    records = _read(output)
+    assert [int(r['id_str']) for r in records] == [BASE_ID + (n << 22) for n in range(1, 7)]
+    assert report['records_read'] == 9
+    assert report['records_written'] == 6
+    assert report['duplicates_dropped'] == 3
+    assert report['shards_written'] == 2
+    assert report['bytes_reclaimed'] == report['bytes_read'] - report['bytes_written']
+
+
+def test_kept_copy_does_not_depend_on_shard_order(tmpdir):
+    outputs = []
+    for i, order in enumerate([(1, 2), (2, 1)]):
+        source = tmpdir.mkdir("source-{}".format(i))
+        for n, copy in enumerate(order, 1):
+            _write_shard(str(source.join("tweets-shard-{}.json".format(n))), [_tweet(1, copy=copy)])
+        output = str(tmpdir.join("output-{}".format(i)))
+        ShardCompactor(LocalStorage(str(source)), output, processes=1).run()
+        outputs.append(_read(output))
+    assert outputs[0] == outputs[1]
+
+
+def test_keeps_complete_copy_over_truncated_one(tmpdir):
+    source = tmpdir.mkdir("source")
+    full = _tweet(1, text="the whole tweet")
+    truncated = full[:full.index('"text"')]
+    _write_shard(str(source.join("tweets-shard-1.json")), [full])
+    # A crash leaves the last record without its newline
+    with open(str(source.join("tweets-shard-2.json")), "w") as f:
+        f.write(_tweet(2) + "\n" + truncated)
+    output = str(tmpdir.join("output"))
+
+    report = ShardCompactor(LocalStorage(str(source)), output, processes=1).run()
+
+    records = [line.decode('utf-8') for line in ShardQuery(LocalStorage(output), raw=True, processes=1)]
+    assert records == [full, _tweet(2)]
+    assert report['duplicates_dropped'] == 1
+
+
+def test_sorts_by_time_across_processes_and_indexes_output(tmpdir):
+    source = tmpdir.mkdir("source")
+    for shard in range(4):
+        _write_shard(str(source.join("tweets-shard-{}.json".format(shard + 1))),
+                     [_tweet(n) for n in range(shard * 50, shard * 50 + 100)])
+    output = str(tmpdir.join("output"))
+
+    report = ShardCompactor(LocalStorage(str(source)), output, order=SORT_TIME, max_records=60,
+                            memory_bytes=4096, processes=2).run()
+
+    ids = [int(r['id_str']) for r in _read(output)]
+    assert ids == [BASE_ID + (n << 22) for n in range(250)]
+    assert report['duplicates_dropped'] == 150
+    with ShardReader(os.path.join(output, "tweets-shard-1.json")) as reader:
+        assert json.loads(reader.get(BASE_ID + (3 << 22)).decode('utf-8'))['text'] == "tweet 3"
+
+
+def test_refuses_output_holding_shards(tmpdir):
+    source = tmpdir.mkdir("source")
+    _write_shard(str(source.join("tweets-shard-1.json")), [_tweet(1)])
+    try:
+        ShardCompactor(LocalStorage(str(source)), str(source), processes=1).run()
+    except Exception as e:
+        assert "already holds shards" in str(e)
+    else:
+        assert False, "expected the compaction to be refused"
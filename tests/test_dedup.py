@@ -0,0 +1,19 @@
+from twitter_scraping.dedup import WindowedIdSet
+
+BASE_ID = 1300000000000000000
+
+
+def test_closing_a_loaded_windowed_set_unmaps_its_snapshot(tmpdir):
+    path = str(tmpdir.join("dedup.snapshot"))
+    ids = WindowedIdSet()
+    for n in range(100):
+        ids.check_and_add(str(BASE_ID + (n << 22)))
+    ids.save(path)
+
+    loaded = WindowedIdSet.load(path)
+    assert str(BASE_ID + (7 << 22)) in loaded
+    snapshot = loaded._snapshot
+    loaded.close()
+    assert snapshot.closed
+    # Closing twice is harmless
+    loaded.close()
@@ -0,0 +1,48 @@
+import threading
+import time
+
+from twitter_scraping.email import BackgroundEmailer, SMTPSink
+
+
+class _SlowEmailer(object):
+    default_subject = "Scraper"
+
+    def __init__(self):
+        self.sent = []
+        self.release = threading.Event()
+
+    def send_text(self, message, subject=None):
+        self.release.wait()
+        self.sent.append((subject, message))
+
+    def close(self):
+        pass
+
+
+def test_bursts_are_sent_as_one_digest_per_subject():
+    sink = SMTPSink().start()
+    try:
+        emailer = BackgroundEmailer(sink.emailer("Scraper"), digest_window=0.2, min_interval=0.2)
+        for n in range(5):
+            emailer.send_text("Error {}".format(n), subject="{default_subject}: errors")
+        emailer.send_text("Connected", subject="{default_subject}: connected")
+        time.sleep(0.6)
+        subjects = sorted(message['Subject'] for message in sink.messages)
+        assert subjects == ["Scraper: connected", "Scraper: errors (5 notifications)"]
+        digest = [m for m in sink.messages if m['Subject'].endswith("(5 notifications)")][0]
+        assert all("Error {}".format(n) in digest.get_payload() for n in range(5))
+        emailer.close()
+    finally:
+        sink.stop()
+
+
+def test_sending_never_waits_for_delivery():
+    slow = _SlowEmailer()
+    emailer = BackgroundEmailer(slow, digest_window=0.0, min_interval=0.0)
+    start = time.time()
+    for n in range(3):
+        emailer.send_text("Error {}".format(n))
+    assert time.time() - start < 0.1
+    slow.release.set()
+    emailer.close()
+    assert sum(message.count("Error") for _, message in slow.sent) == 3
@@ -0,0 +1,69 @@
+import glob
+import json
+import os
+import random
+
+from twitter_scraping.email import DummyEmailer
+from twitter_scraping.engagement import QUOTE, RETWEET, EngagementAggregator, summarize
+from twitter_scraping.scraper import EngagementOptions, ScraperStreamListener
+
+BASE_ID = 1300000000000000000
+
+
+def _id(n):
+    return str(BASE_ID + (n << 22))
+
+
+def _status(n, retweet_of=None, quote_of=None):
+    status = {'created_at': "Sat Mar 27 12:00:00 +0000 2021", 'id': int(_id(n)), 'id_str': _id(n),
+              'text': "tweet {}".format(n), 'in_reply_to_status_id': None,
+              'user': {'id': n, 'id_str': str(n), 'screen_name': "user{}".format(n)}}
+    if retweet_of is not None:
+        status['retweeted_status'] = json.loads(_status(retweet_of))
+    if quote_of is not None:
+        status['is_quote_status'] = True
+        status['quoted_status_id_str'] = _id(quote_of)
+    return json.dumps(status)
+
+
+def test_evicting_the_least_engaged_keeps_totals_exact():
+    records = []
+    aggregator = EngagementAggregator(records.append, capacity=10)
+    rng = random.Random(0)
+    expected = {}
+    for n in range(1000, 3000):
+        # A few popular originals, and a long tail retweeted once or twice
+        original = _id(rng.choice([1, 2, 3]) if rng.random() < 0.7 else rng.randint(10, 500))
+        kind = QUOTE if n % 10 == 0 else RETWEET
+        aggregator.add(original, _id(n), kind)
+        counts = expected.setdefault(original, {'retweets': 0, 'quotes': 0})
+        counts['quotes' if kind == QUOTE else 'retweets'] += 1
+    assert len(aggregator) <= 10
+    assert aggregator.num_evicted > 0
+    aggregator.flush()
+
+    totals = summarize(json.loads(record) for record in records)
+    assert dict((k, {'retweets': v['retweets'], 'quotes': v['quotes']}) for k, v in totals.items()) == expected
+    # The popular originals stayed in memory throughout, so got one record each
+    for n in (1, 2, 3):
+        assert len([r for r in records if json.loads(r)['id_str'] == _id(n)]) == 1
+    assert totals[_id(1)]['first_seen_ms'] <= totals[_id(1)]['last_seen_ms']
+
+
+def test_the_listener_writes_engagement_to_its_own_shards(tmpdir):
+    engagement = EngagementOptions(flush_interval=3600.0)
+    with ScraperStreamListener(str(tmpdir), emailer=DummyEmailer(), raw=True, engagement=engagement) as listener:
+        for message in [_status(1), _status(2, retweet_of=1), _status(3, retweet_of=1), _status(4, quote_of=1),
+                        _status(5, retweet_of=6)]:
+            listener.on_data(message)
+    records = []
+    for filename in glob.glob(os.path.join(str(tmpdir), "engagement", "engagement-shard-*.json")):
+        with open(filename) as f:
+            records.extend(json.loads(line) for line in f)
+    totals = summarize(records)
+    assert totals[_id(1)]['retweets'] == 2 and totals[_id(1)]['quotes'] == 1
+    assert totals[_id(6)]['retweets'] == 1
+    assert totals[_id(1)]['first_seen_ms'] < totals[_id(1)]['last_seen_ms']
+    # Retweets are still written only as their originals
+    with open(str(tmpdir.join("tweets-shard-1.json"))) as f:
+        assert [json.loads(line)['id_str'] for line in f] == [_id(1), _id(4), _id(6)]
@@ -0,0 +1,85 @@
+import json
+import os
+import threading
+import time
+
+from twitter_scraping.handoff import ConnectionManager
+from twitter_scraping.scraper import ScraperStreamListener
+
+BASE_ID = 1300000000000000000
+
+
+def _status(n):
+    return json.dumps({'created_at': "Sat Mar 27 12:00:00 +0000 2021", 'id': BASE_ID + (n << 22),
+                       'id_str': str(BASE_ID + (n << 22)), 'text': "tweet {}".format(n), 'in_reply_to_status_id': None,
+                       'user': {'id': n, 'id_str': str(n), 'screen_name': "user{}".format(n)}})
+
+
+class _Emailer(object):
+    def __init__(self):
+        self.sent = []
+
+    def send_text(self, message, subject=None):
+        self.sent.append((subject, message))
+
+
+class _FakeStream(object):
+    # Delivers a status every few milliseconds for the old filters, and
+    # fails like tweepy on a bad request for the new ones
+    def __init__(self, listener, stop):
+        self.listener = listener
+        self._stop = stop
+        self._disconnected = threading.Event()
+
+    def filter(self, track=None, **kwargs):
+        if track == ['bad']:
+            self.listener.on_error(406)
+            return
+        self.listener.on_connect()
+        n = 0
+        while not self._stop.is_set() and not self._disconnected.is_set():
+            n += 1
+            self.listener.on_data(_status(n))
+            time.sleep(0.005)
+
+    def disconnect(self):
+        self._disconnected.set()
+
+
+def test_failed_handoff_leaves_the_running_stream_alone(tmpdir):
+    emailer = _Emailer()
+    stop = threading.Event()
+    with ScraperStreamListener(str(tmpdir), emailer=emailer, raw=True) as listener:
+        manager = ConnectionManager(lambda l: _FakeStream(l, stop), listener, {'track': ['good']}, handoff_timeout=5.0)
+        thread = threading.Thread(target=manager.run)
+        thread.start()
+        time.sleep(0.1)
+        manager.reload({'track': ['bad']})
+        # The manager checks for reloads every second
+        time.sleep(1.5)
+        received = listener._received.value
+        time.sleep(0.1)
+        assert listener._received.value > received
+        stop.set()
+        thread.join()
+        assert manager.filters == {'track': ['good']}
+        assert manager.num_handoffs == 0
+        assert listener.num_connections == 1
+    assert emailer.sent == []
+    assert not os.path.exists(str(tmpdir.join("gaps.jsonl")))
+
+
+def test_handoff_passes_on_the_new_connection_once_it_delivers(tmpdir):
+    stop = threading.Event()
+    with ScraperStreamListener(str(tmpdir), emailer=_Emailer(), raw=True) as listener:
+        manager = ConnectionManager(lambda l: _FakeStream(l, stop), listener, {'track': ['good']}, handoff_timeout=5.0)
+        thread = threading.Thread(target=manager.run)
+        thread.start()
+        time.sleep(0.1)
+        manager.reload({'track': ['other']})
+        time.sleep(1.5)
+        stop.set()
+        thread.join()
+        assert manager.filters == {'track': ['other']}
+        assert manager.num_handoffs == 1
+        assert listener.num_connections == 2
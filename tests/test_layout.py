@@ -0,0 +1,67 @@
+import calendar
+import json
+import os
+
+from twitter_scraping import manifest
+from twitter_scraping.file_utils import PartitionedShardWriter
+from twitter_scraping.layout import PartitionLayout
+from twitter_scraping.manifest import ShardManifest, open_shards
+from twitter_scraping.shard_index import first_id_at
+
+TEMPLATE = "tweets-shard-{n}.json"
+# 2021-03-27 07:00 and 08:00 UTC
+SEVEN = calendar.timegm((2021, 3, 27, 7, 0, 0)) * 1000
+EIGHT = SEVEN + 3600 * 1000
+
+
+def _record(ms, n, lang):
+    tweet_id = first_id_at(ms) + n
+    return json.dumps({'id': tweet_id, 'id_str': str(tweet_id), 'lang': lang}) + "\n"
+
+
+def _lines(path):
+    with open(str(path)) as f:
+        return f.readlines()
+
+
+def test_records_go_to_their_partition_directories(tmpdir):
+    writer = PartitionedShardWriter(str(tmpdir), TEMPLATE, PartitionLayout(['dt', 'hour', 'lang']), max_open=1)
+    writer.write(_record(SEVEN, 1, 'en') + _record(SEVEN, 2, 'fr') + _record(EIGHT, 3, 'en'))
+    # Late, after its partition's shard was sealed to stay under the cap
+    writer.write(_record(SEVEN, 4, 'en'))
+    writer.close()
+
+    seven_en = tmpdir.join("dt=2021-03-27", "hour=07", "lang=en")
+    assert _lines(seven_en.join("tweets-shard-1.json")) == [_record(SEVEN, 1, 'en')]
+    assert _lines(tmpdir.join("dt=2021-03-27", "hour=07", "lang=fr", "tweets-shard-2.json")) == \
+        [_record(SEVEN, 2, 'fr')]
+    assert _lines(tmpdir.join("dt=2021-03-27", "hour=08", "lang=en", "tweets-shard-3.json")) == \
+        [_record(EIGHT, 3, 'en')]
+    assert _lines(seven_en.join("tweets-shard-4.json")) == [_record(SEVEN, 4, 'en')]
+
+def test_open_partition_shards_are_recovered_from_the_shared_manifest(tmpdir):
+    layout = PartitionLayout(['dt', 'hour'])
+    shards = ShardManifest(str(tmpdir))
+    writer = PartitionedShardWriter(str(tmpdir), TEMPLATE, layout, manifest=shards)
+    writer.write(_record(SEVEN, 1, 'en') + _record(EIGHT, 2, 'en'))
+    writer.flush()
+    # Crash, leaving a record after the last flush
+    writer.write(_record(EIGHT, 3, 'en'))
+    for partition_writer, _ in writer._partitions.values():
+        partition_writer._current_writer.flush()
+    shards.close()
+
+    seven = str(tmpdir.join("dt=2021-03-27", "hour=07", "tweets-shard-1.json"))
+    eight = str(tmpdir.join("dt=2021-03-27", "hour=08", "tweets-shard-2.json"))
+    assert open_shards(str(tmpdir)) == [seven, eight]
+
+    shards = ShardManifest(str(tmpdir))
+    writer = PartitionedShardWriter(str(tmpdir), TEMPLATE, layout, manifest=shards)
+    writer.recover()
+    assert open_shards(str(tmpdir)) == []
+    assert shards.get(eight)['state'] == manifest.SEALED
+    assert _lines(eight) == [_record(EIGHT, 2, 'en')]
+    # Numbering carries on across partitions
+    writer.write(_record(SEVEN, 4, 'en'))
+    writer.close()
+    assert os.path.exists(str(tmpdir.join("dt=2021-03-27", "hour=07", "tweets-shard-3.json")))
@@ -0,0 +1,89 @@
+import glob
+import json
+import os
+import time
+
+from twitter_scraping.dedup import LRUDedup
+from twitter_scraping.email import DummyEmailer
+from twitter_scraping.scraper import QuotaOptions, ScraperStreamListener
+
+BASE_ID = 1300000000000000000
+
+
+def _id(n):
+    return str(BASE_ID + (n << 22))
+
+
+def _status(n, retweet_of=None):
+    status = {'created_at': "Sat Mar 27 12:00:00 +0000 2021", 'id': int(_id(n)), 'id_str': _id(n),
+              'text': "tweet {}".format(n), 'in_reply_to_status_id': None,
+              'user': {'id': n, 'id_str': str(n), 'screen_name': "user{}".format(n)}}
+    if retweet_of is not None:
+        status['retweeted_status'] = json.loads(_status(retweet_of))
+    return json.dumps(status, separators=(',', ':'))
+
+
+def _listener(output_dir, **kwargs):
+    kwargs.setdefault('emailer', DummyEmailer())
+    kwargs.setdefault('raw', True)
+    return ScraperStreamListener(str(output_dir), **kwargs)
+
+
+def _written(output_dir):
+    ret = []
+    for filename in sorted(glob.glob(os.path.join(str(output_dir), "tweets-shard-*[0-9].json"))):
+        with open(filename) as f:
+            ret.extend(json.loads(line) for line in f)
+    return ret
+
+
+def test_raw_mode_writes_records_verbatim_and_drops_duplicates(tmpdir):
+    with _listener(tmpdir) as listener:
+        for message in [_status(1), _status(2), _status(1), _status(3, retweet_of=2), _status(4, retweet_of=5)]:
+            listener.on_data(message + "\r\n")
+    with open(str(tmpdir.join("tweets-shard-1.json"))) as f:
+        lines = f.read().splitlines()
+    # Originals are written as received; retweets are flattened to their originals
+    assert lines[:2] == [_status(1), _status(2)]
+    assert [json.loads(line)['id_str'] for line in lines] == [_id(1), _id(2), _id(5)]
+    assert listener.metrics.totals()['tweets_received_total'][2] == 5
+    assert listener.metrics.totals()['tweets_written_total'][2] == 3
+
+
+def test_raw_and_parsed_modes_write_the_same_tweets(tmpdir):
+    messages = [_status(1), _status(2, retweet_of=1), _status(3, retweet_of=4), _status(3)]
+    for raw in (True, False):
+        output_dir = tmpdir.mkdir(str(raw))
+        with _listener(output_dir, raw=raw) as listener:
+            for message in messages:
+                listener.on_data(message)
+        assert [s['id_str'] for s in _written(output_dir)] == [_id(1), _id(4), _id(3)]
+
+
+def test_dedup_snapshot_survives_restart(tmpdir):
+    snapshot = str(tmpdir.join("dedup.snapshot"))
+    with _listener(tmpdir.mkdir("first"), dedup_snapshot=snapshot) as listener:
+        listener.on_data(_status(1))
+    dedup = LRUDedup.load(snapshot)
+    output_dir = tmpdir.mkdir("second")
+    with _listener(output_dir, dedup=dedup) as listener:
+        listener.on_data(_status(1))
+        listener.on_data(_status(2))
+    assert [s['id_str'] for s in _written(output_dir)] == [_id(2)]
+
+
+def test_tweets_shed_while_paused_are_not_marked_seen(tmpdir):
+    dedup = LRUDedup()
+    # A one-byte budget is over the hard watermark from the first check
+    with _listener(tmpdir, dedup=dedup, quota=QuotaOptions(1)) as listener:
+        deadline = time.time() + 10
+        while not listener._quota.paused and time.time() < deadline:
+            time.sleep(0.01)
+        assert listener._quota.paused
+        listener.on_data(_status(1))
+        listener.on_data(_status(2, retweet_of=3))
+    assert _written(tmpdir) == []
+    assert _id(1) not in dedup and _id(3) not in dedup
+    assert listener.metrics.totals()['tweets_shed_total'][2] == 2
+    with open(str(tmpdir.join("gaps.jsonl"))) as f:
+        assert json.loads(f.readline())['reason'] == "paused: over the disk budget"
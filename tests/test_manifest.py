@@ -0,0 +1,132 @@
+import json
+import os
+
+from twitter_scraping import manifest
+from twitter_scraping.compression import get_codec
+from twitter_scraping.file_utils import ShardedFileWriter, ShardListener
+from twitter_scraping.manifest import ShardManifest, open_shards
+from twitter_scraping.shard_index import ShardReader
+
+TEMPLATE = "tweets-shard-{n}.json"
+
+
+def _record(n):
+    return json.dumps({'id_str': str(1300000000000000000 + (n << 22)), 'n': n}) + "\n"
+
+
+def _crash(directory, codec='none'):
+    # Writes two shards and part of a third, then stops without sealing it,
+    # leaving a record after the last checkpoint
+    writer = ShardedFileWriter(str(directory), TEMPLATE, codec=get_codec(codec), max_records=3,
+                               manifest=ShardManifest(str(directory)), index=True)
+    writer.next_shard()
+    for n in range(8):
+        writer.write(_record(n))
+    writer.flush()
+    writer.write(_record(8)[:10])
+    writer._current_writer.flush()
+    writer._manifest.close()
+
+
+def _resume(directory, codec='none'):
+    writer = ShardedFileWriter(str(directory), TEMPLATE, codec=get_codec(codec), max_records=3,
+                               manifest=ShardManifest(str(directory)), index=True)
+    handed_on = []
+    writer.wrap_listener(lambda downstream: _Collect(handed_on))
+    writer.recover()
+    return writer, handed_on
+
+
+class _Collect(ShardListener):
+    def __init__(self, handed_on):
+        self._handed_on = handed_on
+
+    def handle_shard(self, filename):
+        self._handed_on.append(os.path.basename(filename))
+
+
+def test_recovery_truncates_and_seals_the_open_shard(tmpdir):
+    _crash(tmpdir)
+    assert open_shards(str(tmpdir)) == [str(tmpdir.join("tweets-shard-3.json"))]
+    writer, handed_on = _resume(tmpdir)
+    with open(str(tmpdir.join("tweets-shard-3.json"))) as f:
+        assert f.read() == _record(6) + _record(7)
+    assert open_shards(str(tmpdir)) == []
+    # Sealed shards are handed on again, in order, since nothing took them
+    assert handed_on == ["tweets-shard-1.json", "tweets-shard-2.json", "tweets-shard-3.json"]
+    # The shard that was open gets the index it never had
+    with ShardReader(str(tmpdir.join("tweets-shard-3.json"))) as reader:
+        assert len(reader) == 2
+    # Numbering carries on after it
+    writer.next_shard()
+    assert os.path.basename(writer.current_filename) == "tweets-shard-4.json"
+    writer.close()
+
+
+def test_recovery_of_compressed_shards(tmpdir):
+    _crash(tmpdir, codec='gzip')
+    writer, _ = _resume(tmpdir, codec='gzip')
+    writer.close()
+    with open(str(tmpdir.join("tweets-shard-3.json.gz")), "rb") as raw:
+        assert get_codec('gzip').open_reader(raw).read() == (_record(6) + _record(7)).encode('utf-8')
+
+
+def test_empty_open_shards_are_discarded(tmpdir):
+    shards = ShardManifest(str(tmpdir))
+    shards.record(str(tmpdir.join("tweets-shard-1.json")), manifest.SEALED, n=1, offset=0, records=0)
+    shards.record(str(tmpdir.join("tweets-shard-2.json")), manifest.OPEN, n=2, offset=0, records=0)
+    tmpdir.join("tweets-shard-2.json").write("")
+    shards.close()
+
+    shards = ShardManifest(str(tmpdir))
+    assert shards.recover(TEMPLATE) == 2
+    assert not tmpdir.join("tweets-shard-2.json").exists()
+    assert shards.get(str(tmpdir.join("tweets-shard-2.json")))['state'] == manifest.DISCARDED
+    shards.close()
+
+
+def test_numbering_skips_shards_written_without_a_manifest(tmpdir):
+    tmpdir.join("tweets-shard-7.json").write(_record(1))
+    shards = ShardManifest(str(tmpdir))
+    assert shards.recover(TEMPLATE) == 7
+    shards.close()
+
+
+def test_log_keeps_the_latest_entry_and_survives_a_torn_line(tmpdir):
+    shards = ShardManifest(str(tmpdir))
+    filename = str(tmpdir.join("tweets-shard-1.json"))
+    shards.record(filename, manifest.OPEN, n=1, offset=0, records=0)
+    shards.record(filename, manifest.OPEN, offset=100, records=3)
+    shards.close()
+    with open(str(tmpdir.join("manifest.jsonl")), "a") as f:
+        f.write('{"shard": "tweets-shard-1.json", "sta')
+
+    shards = ShardManifest(str(tmpdir))
+    assert shards.get(filename)['offset'] == 100
+    assert shards.shards_in_state(manifest.OPEN) == [filename]
+    shards.close()
+    with open(str(tmpdir.join("manifest.jsonl"))) as f:
+        assert len(f.readlines()) == 1
+
+
+def test_unchanged_entries_are_skipped_and_the_log_is_compacted_while_running(tmpdir):
+    shards = ShardManifest(str(tmpdir), compact_every=5)
+    path = str(tmpdir.join("manifest.jsonl"))
+    filename = str(tmpdir.join("tweets-shard-1.json"))
+    shards.record(filename, manifest.OPEN, n=1, offset=0, records=0)
+    for _ in range(3):
+        shards.record(filename, manifest.OPEN, offset=0, records=0)
+    with open(path) as f:
+        assert len(f.readlines()) == 1
+
+    for n in range(1, 20):
+        shards.record(filename, manifest.OPEN, offset=n * 10, records=n)
+    with open(path) as f:
+        assert len(f.readlines()) < 5
+    shards.record(filename, manifest.SEALED)
+    shards.close()
+
+    shards = ShardManifest(str(tmpdir))
+    assert shards.get(filename)['state'] == manifest.SEALED
+    assert shards.get(filename)['records'] == 19
+    shards.close()
@@ -0,0 +1,62 @@
+import threading
+import time
+
+import pytest
+
+from twitter_scraping.metrics import MetricsRegistry
+
+
+def test_each_output_reports_its_own_gauge():
+    metrics = MetricsRegistry()
+    depths = {'tweets': 3, 'users': 5}
+    for output in depths:
+        metrics.gauge('writer_queue_depth', "Records waiting", labels=('output',))\
+            .labels(output, fn=lambda output=output: depths[output])
+    rendered = metrics.render_prometheus()
+    assert 'writer_queue_depth{output="tweets"} 3' in rendered
+    assert 'writer_queue_depth{output="users"} 5' in rendered
+    assert metrics.totals()['writer_queue_depth'][2] == 8
+
+
+def test_conflicting_registrations_are_refused():
+    metrics = MetricsRegistry()
+    metrics.gauge('depth', "Depth", fn=lambda: 1)
+    with pytest.raises(ValueError):
+        metrics.gauge('depth', "Depth", fn=lambda: 2)
+    with pytest.raises(ValueError):
+        metrics.counter('depth', "Depth")
+    family = metrics.gauge('labelled', "Labelled", labels=('output',))
+    family.labels('tweets', fn=lambda: 1)
+    with pytest.raises(ValueError):
+        family.labels('tweets', fn=lambda: 2)
+
+
+def test_counters_without_fn_are_shared():
+    metrics = MetricsRegistry()
+    metrics.counter('bytes_total', "Bytes").inc(2)
+    metrics.counter('bytes_total', "Bytes").inc(3)
+    assert metrics.get('bytes_total').value == 5
+
+
+
+class _Yielding(object):
+    # An amount whose addition lets other threads run halfway through, as a
+    # preemption between reading and writing the count would
+    def __radd__(self, other):
+        time.sleep(0)
+        return other + 1
+
+
+def test_counter_increments_from_several_threads_are_not_lost():
+    counter = MetricsRegistry().counter('uploads_total', "Uploads")
+
+    def inc():
+        for _ in range(500):
+            counter.inc(_Yielding())
+
+    threads = [threading.Thread(target=inc) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.value == 8 * 500
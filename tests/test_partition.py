@@ -0,0 +1,39 @@
+import multiprocessing
+
+from twitter_scraping.email import BackgroundEmailer, DummyEmailer
+from twitter_scraping.partition import Supervisor, partition_filters
+from twitter_scraping.scraper import ScraperBuilder
+
+
+class _NoAuth(object):
+    def apply_auth(self):
+        return None
+
+
+def test_filters_are_dealt_out_evenly():
+    parts = partition_filters(2, follow=["1", "2", "3"], track=["a"], locations=[0, 0, 1, 1, 2, 2, 3, 3])
+    assert parts == [{'follow': ["1", "3"], 'track': None, 'locations': [0, 0, 1, 1]},
+                     {'follow': ["2"], 'track': ["a"], 'locations': [2, 2, 3, 3]}]
+
+
+def test_workers_start_when_spawned(tmpdir):
+    # Spawning (the default on macOS and Windows) pickles the worker's
+    # arguments, which forking doesn't
+    start_method = multiprocessing.get_start_method()
+    multiprocessing.set_start_method('spawn', force=True)
+    emailer = BackgroundEmailer(DummyEmailer())
+    builder = ScraperBuilder().track(["a", "b"]).output_dir(str(tmpdir)).emailer(emailer).auth(_NoAuth()) \
+        .stream_url("http://127.0.0.1:9")
+    supervisor = Supervisor(builder, 2)
+    try:
+        supervisor._start_worker(0)
+        # Still trying to connect, rather than having failed to unpickle
+        supervisor._processes[0].join(3)
+        assert supervisor._processes[0].is_alive()
+    finally:
+        for process in supervisor._processes.values():
+            process.terminate()
+            process.join()
+        emailer.close()
+        multiprocessing.set_start_method(start_method, force=True)
+    assert builder._emailer is emailer
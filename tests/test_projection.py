@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+from twitter_scraping.email import DummyEmailer
+from twitter_scraping.projection import RecordSelector
+from twitter_scraping.scraper import ScraperStreamListener, SelectOptions
+
+BASE_ID = 1300000000000000000
+
+PREDICATES = [
+    {'field': 'lang', 'in': ['en', 'fr'], 'name': 'lang'},
+    {'field': 'user.followers_count', 'gte': 100, 'name': 'followers'},
+    {'field': 'is_quote_status', 'eq': False},
+    {'field': 'text', 'regex': r'(?i)\bcats?\b'},
+]
+
+
+def _status(n, lang='en', followers=500, quote=False, text="I like cats"):
+    return {'id': BASE_ID + (n << 22), 'id_str': str(BASE_ID + (n << 22)), 'lang': lang, 'is_quote_status': quote,
+            'text': text, 'in_reply_to_status_id': None, 'entities': {'hashtags': [{'text': "cats", 'indices': [0, 5]}]},
+            'user': {'id_str': str(n), 'screen_name': "user{}".format(n), 'followers_count': followers}}
+
+
+def test_predicates_reject_and_count_against_the_first_failure():
+    selector = RecordSelector(predicates=PREDICATES)
+    assert selector(_status(1)) == _status(1)
+    assert selector(_status(2, lang='de', followers=1)) is None
+    assert selector(_status(3, followers=None)) is None
+    assert selector({'id_str': "4", 'lang': 'en'}) is None
+    assert selector(_status(5, quote=True)) is None
+    assert selector(_status(6, text="Dogs only")) is None
+    assert selector.dropped == {'lang': 1, 'followers': 2, 'is_quote_status eq false': 1,
+                                'text regex "(?i)\\\\bcats?\\\\b"': 1}
+
+
+def test_keep_and_drop_paths_reach_into_lists_and_always_keep_ids():
+    keep = RecordSelector(keep=['text', 'user.screen_name', 'entities.hashtags.text'])
+    assert keep(_status(1)) == {'id': BASE_ID + (1 << 22), 'id_str': str(BASE_ID + (1 << 22)), 'text': "I like cats",
+                                'entities': {'hashtags': [{'text': "cats"}]}, 'user': {'screen_name': "user1"}}
+    drop = RecordSelector(drop=['id', 'user', 'entities.hashtags.indices'])
+    selected = drop(_status(1))
+    assert 'user' not in selected and selected['id'] == BASE_ID + (1 << 22)
+    assert selected['entities'] == {'hashtags': [{'text': "cats"}]}
+
+
+def test_bad_predicates_are_refused_when_compiled():
+    with pytest.raises(ValueError):
+        RecordSelector(predicates=[{'field': 'lang', 'like': 'en'}])
+    with pytest.raises(ValueError):
+        RecordSelector(predicates=[{'field': 'lang', 'in': 'en'}])
+
+
+def test_the_listener_writes_only_the_selected_slice(tmpdir):
+    select = SelectOptions(keep_fields=['text'], predicates=PREDICATES[:1])
+    with ScraperStreamListener(str(tmpdir), emailer=DummyEmailer(), raw=True, select=select) as listener:
+        for status in [_status(1), _status(2, lang='de'), _status(3, lang='fr')]:
+            listener.on_data(json.dumps(status))
+        dropped = listener.metrics.get('records_filtered_total').labels('lang').value
+    with open(str(tmpdir.join("tweets-shard-1.json"))) as f:
+        written = [json.loads(line) for line in f]
+    assert written == [{'id': status['id'], 'id_str': status['id_str'], 'text': "I like cats"}
+                       for status in [_status(1), _status(3)]]
+    assert dropped == 1
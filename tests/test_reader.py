@@ -0,0 +1,87 @@
+import json
+
+from twitter_scraping.compression import get_codec
+from twitter_scraping.file_utils import ShardedFileWriter
+from twitter_scraping.reader import RecordFilter, ShardQuery
+from twitter_scraping.shard_index import ShardReader, created_at_ms
+from twitter_scraping.storage import LocalStorage
+
+BASE_ID = 1300000000000000000
+
+
+def _id(n):
+    return BASE_ID + (n << 22)
+
+
+def _tweet(n):
+    # Written the way Twitter serializes, with "/" escaped
+    tweet = {'id_str': str(_id(n)), 'lang': "en" if n % 2 else "ja", 'text': "tweet {}".format(n),
+             'user': {'screen_name': "user{}".format(n % 3)}, 'source': "https://example.com/{}".format(n % 5)}
+    return json.dumps(tweet, separators=(',', ':')).replace("/", "\\/")
+
+
+def _write_shards(directory, numbers, codec='none', max_records=10):
+    writer = ShardedFileWriter(str(directory), "tweets-shard-{n}.json", codec=get_codec(codec),
+                               max_records=max_records, index=True, index_block_bytes=256)
+    writer.next_shard()
+    for n in numbers:
+        writer.write(_tweet(n) + "\n")
+    writer.seal()
+
+
+def _query(directory, processes=1, **kwargs):
+    query = ShardQuery(LocalStorage(str(directory)), record_filter=RecordFilter(**kwargs), processes=processes)
+    return query, sorted(int(r['id_str']) for r in query)
+
+
+def test_reader_looks_up_records_by_id_and_time(tmpdir):
+    for codec in ('none', 'gzip'):
+        directory = tmpdir.mkdir(codec)
+        _write_shards(directory, [5, 3, 9, 1, 7, 20, 11, 13, 15, 17], codec=codec)
+        filename = str(directory.join("tweets-shard-1.json" + get_codec(codec).extension))
+        with ShardReader(filename) as reader:
+            assert len(reader) == 10
+            assert list(reader.ids) == sorted(_id(n) for n in [5, 3, 9, 1, 7, 20, 11, 13, 15, 17])
+            assert reader.get(_id(9)) == _tweet(9).encode('utf-8')
+            assert reader.get(_id(2)) is None
+            assert _id(20) in reader and _id(21) not in reader
+            # In file order, not id order
+            assert list(reader.ids_between(_id(3), _id(9))) == [_tweet(n).encode('utf-8') for n in (5, 3, 9, 7)]
+            assert list(reader.range(created_at_ms(_id(15)), created_at_ms(_id(20)))) == \
+                [_tweet(n).encode('utf-8') for n in (15, 17)]
+            assert reader.min_created_ms == created_at_ms(_id(1))
+            assert reader.max_created_ms == created_at_ms(_id(20))
+
+
+def test_id_bounds_skip_shards_by_their_index(tmpdir):
+    _write_shards(tmpdir, range(30))
+    query, ids = _query(tmpdir, min_id=_id(12), max_id=_id(17))
+    assert ids == [_id(n) for n in range(12, 18)]
+    assert query.shards_read == 1
+    # The other two, and the empty shard left open by the last rotation
+    assert query.shards_skipped == 3
+    _, ids = _query(tmpdir, since=created_at_ms(_id(25)) / 1000.0)
+    assert ids == [_id(n) for n in range(25, 30)]
+
+
+def test_field_filters_match_escaped_values(tmpdir):
+    _write_shards(tmpdir, range(30))
+    expected = [_id(n) for n in range(30) if n % 2 and n % 5 == 2]
+    for processes in (1, 2):
+        _, ids = _query(tmpdir, processes=processes, languages=["en"], where={'source': "https://example.com/2"})
+        assert ids == expected
+    _, ids = _query(tmpdir, where={'user.screen_name': "user1", 'lang': "ja"})
+    assert ids == [_id(n) for n in range(30) if n % 3 == 1 and n % 2 == 0]
+    # Not every value can be searched for in the raw bytes
+    _, ids = _query(tmpdir, where={'text': "tweet \"7\""})
+    assert ids == []
+
+
+def test_raw_rejection_never_drops_matches():
+    line = _tweet(2).encode('utf-8')
+    record = json.loads(line.decode('utf-8'))
+    for where in [{'source': "https://example.com/2"}, {'lang': "ja"}, {'user.screen_name': "user2"}]:
+        record_filter = RecordFilter(where=where)
+        assert record_filter.accepts_raw(line)
+        assert record_filter.accepts(record)
+    assert not RecordFilter(where={'source': "https://example.com/3"}).accepts_raw(line)
@@ -0,0 +1,80 @@
+import glob
+import json
+import os
+
+import pytest
+
+from twitter_scraping.reconnect import ReconnectSupervisor
+from twitter_scraping.scraper import ScraperStreamListener
+
+BASE_ID = 1300000000000000000
+
+
+def _status(n):
+    return json.dumps({'created_at': "Sat Mar 27 12:00:00 +0000 2021", 'id': BASE_ID + (n << 22),
+                       'id_str': str(BASE_ID + (n << 22)), 'text': "tweet {}".format(n), 'in_reply_to_status_id': None,
+                       'user': {'id': n, 'id_str': str(n), 'screen_name': "user{}".format(n)}})
+
+
+class _Emailer(object):
+    def __init__(self):
+        self.sent = []
+
+    def send_text(self, message, subject=None):
+        self.sent.append((subject, message))
+
+
+class _DroppingStream(object):
+    # Each connection delivers a status (and a duplicate of the one before)
+    # then drops, until `failures` have happened
+    def __init__(self, listener, failures):
+        self._listener = listener
+        self._failures = failures
+        self.num_connects = 0
+
+    def filter(self):
+        self.num_connects += 1
+        self._listener.on_connect()
+        self._listener.on_data(_status(self.num_connects - 1))
+        self._listener.on_data(_status(self.num_connects))
+        if self.num_connects <= self._failures:
+            e = IOError("connection reset")
+            self._listener.on_exception(e)
+            raise e
+
+
+def _written(output_dir):
+    ret = []
+    for filename in sorted(glob.glob(os.path.join(output_dir, "tweets-shard-*.json"))):
+        with open(filename) as f:
+            ret.extend(json.loads(line)['id'] for line in f)
+    return ret
+
+
+def test_dropped_connections_are_resumed_and_their_gaps_logged(tmpdir):
+    emailer = _Emailer()
+    with ScraperStreamListener(str(tmpdir), emailer=emailer, raw=True) as listener:
+        stream = _DroppingStream(listener, failures=2)
+        ReconnectSupervisor(stream.filter, listener, step=0.01).run()
+        assert stream.num_connects == 3
+        assert listener.num_connections == 3
+    # One shard sequence and one dedup index throughout
+    assert _written(str(tmpdir)) == [BASE_ID + (n << 22) for n in range(4)]
+    with open(str(tmpdir.join("gaps.jsonl"))) as f:
+        gaps = [json.loads(line) for line in f]
+    assert [gap['reason'] for gap in gaps] == ["OSError: connection reset"] * 2
+    assert all(gap['resumed'] and gap['end'] >= gap['start'] for gap in gaps)
+    assert len([message for _, message in emailer.sent if "Reconnected" in message]) == 2
+
+
+def test_gives_up_after_max_retries_without_connecting(tmpdir):
+    attempts = []
+
+    def connect():
+        attempts.append(1)
+        raise IOError("connection refused")
+
+    with ScraperStreamListener(str(tmpdir), emailer=_Emailer(), raw=True) as listener:
+        with pytest.raises(IOError):
+            ReconnectSupervisor(connect, listener, step=0.01, max_retries=2).run()
+    assert len(attempts) == 3
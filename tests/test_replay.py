@@ -0,0 +1,36 @@
+import glob
+import json
+import os
+
+import pytest
+
+from twitter_scraping.benchmark import run_benchmark
+from twitter_scraping.replay import synthetic_tweets
+from twitter_scraping.scraper import ENGINE_ASYNCIO, ENGINE_TWEEPY, ScraperBuilder
+
+COUNT = 500
+
+
+def _originals(count):
+    # Retweets are written as their originals, once each
+    ret = set()
+    for message in synthetic_tweets(count):
+        status = json.loads(message.decode('utf-8'))
+        ret.add(status.get('retweeted_status', status)['text'])
+    return ret
+
+
+@pytest.mark.parametrize('engine', [ENGINE_TWEEPY, ENGINE_ASYNCIO])
+@pytest.mark.parametrize('raw', [True, False])
+def test_replayed_stream_is_written_once_per_original(tmpdir, engine, raw):
+    output_dir = str(tmpdir)
+    report = run_benchmark(ScraperBuilder().engine(engine).raw(raw), count=COUNT, output_dir=output_dir)
+
+    texts = []
+    for filename in glob.glob(os.path.join(output_dir, "tweets-shard-*[0-9].json")):
+        with open(filename) as f:
+            texts.extend(json.loads(line)['text'] for line in f)
+    assert report['received'] == COUNT
+    assert report['written'] == len(texts)
+    # The synthetic tweets' ids depend on when they're generated, their text doesn't
+    assert sorted(texts) == sorted(_originals(COUNT))
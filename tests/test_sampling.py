@@ -0,0 +1,69 @@
+import glob
+import json
+import time
+
+from twitter_scraping.email import DummyEmailer
+from twitter_scraping.quota import SAMPLE
+from twitter_scraping.sampling import HashSampler, in_sample
+from twitter_scraping.scraper import QuotaOptions, ScraperStreamListener
+
+BASE_ID = 1300000000000000000
+
+
+def _id(n):
+    return BASE_ID + (n << 22)
+
+
+def _status(n, retweet_of=None):
+    status = {'created_at': "Sat Mar 27 12:00:00 +0000 2021", 'id': _id(n), 'id_str': str(_id(n)),
+              'text': "tweet {}".format(n), 'in_reply_to_status_id': None,
+              'user': {'id': 1, 'id_str': "1", 'screen_name': "user1"}}
+    if retweet_of is not None:
+        status['retweeted_status'] = json.loads(_status(retweet_of))
+    return json.dumps(status)
+
+
+def test_samples_at_lower_rates_are_subsets():
+    ids = [_id(n) for n in range(10000)]
+    kept = dict((rate, set(i for i in ids if in_sample(i, rate))) for rate in (0.05, 0.2, 0.5, 1.0))
+    assert kept[0.05] <= kept[0.2] <= kept[0.5] <= kept[1.0] == set(ids)
+    for rate in (0.05, 0.2, 0.5):
+        assert abs(len(kept[rate]) / float(len(ids)) - rate) < 0.02
+
+
+def test_limit_caps_the_rate():
+    limit = [1.0]
+    sampler = HashSampler(rate=0.5, limit_fn=lambda: limit[0], interval=0)
+    assert [sampler.keep(_id(n)) for n in range(100)] == [in_sample(_id(n), 0.5) for n in range(100)]
+    limit[0] = 0.1
+    assert [sampler.keep(_id(n)) for n in range(100)] == [in_sample(_id(n), 0.1) for n in range(100)]
+    assert sampler.rate == 0.1
+    limit[0] = 1.0
+    sampler.keep(_id(0))
+    assert sampler.rate == 0.5
+
+
+def test_disk_budget_samples_through_the_listener(tmpdir):
+    # Every fourth status is a retweet of the one before, which is kept or
+    # not with its original
+    originals = [n - 1 if n % 4 == 3 else n for n in range(400)]
+    # A one-byte budget is over both watermarks from the first check
+    with ScraperStreamListener(str(tmpdir), emailer=DummyEmailer(), raw=True,
+                               quota=QuotaOptions(1, soft_policy=SAMPLE, hard_policy=SAMPLE, sample_rate=0.25)) as listener:
+        deadline = time.time() + 10
+        while listener._quota.sample_rate == 1.0 and time.time() < deadline:
+            time.sleep(0.01)
+        assert not listener._quota.paused
+        for n, original in enumerate(originals):
+            listener.on_data(_status(n, retweet_of=original if original != n else None))
+    kept = [n for n in originals if in_sample(_id(n), 0.25)]
+    ids = []
+    for filename in glob.glob(str(tmpdir.join("tweets-shard-*[0-9].json"))):
+        with open(filename) as f:
+            ids.extend(json.loads(line)['id'] for line in f)
+    assert sorted(ids) == sorted(set(_id(n) for n in kept))
+    with open(str(tmpdir.join("tweets-shard-1.json.sample.json"))) as f:
+        sample = json.load(f)
+    assert sample['min_rate'] == 0.25
+    assert sample['seen'] == 400
+    assert sample['kept'] == len(kept)
@@ -0,0 +1,51 @@
+from six.moves import queue
+
+from twitter_scraping.trends import TrendTracker
+
+
+def _stalled_tracker(directory, queue_size):
+    # A tracker whose counter has stopped taking tasks off a full queue
+    tracker = TrendTracker(str(directory), batch_size=1, queue_size=queue_size)
+    tracker._process.terminate()
+    tracker._process.join()
+    tracker._tasks = queue.Queue(maxsize=queue_size)
+    return tracker
+
+
+def _drain(tasks):
+    ret = []
+    while not tasks.empty():
+        ret.append(tasks.get_nowait())
+    return ret
+
+
+def test_seals_wait_for_room_in_the_queue_in_order(tmpdir):
+    tracker = _stalled_tracker(tmpdir, queue_size=3)
+    tracker.add("a")
+    tracker.add("b")
+    tracker.shard_sealed("shard-1")
+    tracker.shard_sealed("shard-2")
+    # Fills the queue, so the seals wait without holding up the stream
+    tracker.add("c")
+    assert tracker.num_dropped == 0
+    # ...and the next batch is dropped rather than sent ahead of them
+    tracker.add("d")
+    assert tracker.num_dropped == 1
+    assert _drain(tracker._tasks) == [["a"], ["b"], ["c"]]
+    tracker.add("e")
+    assert _drain(tracker._tasks) == [('sealed', "shard-1"), ('sealed', "shard-2"), ["e"]]
+    assert tracker.num_seals_dropped == 0
+
+
+def test_oldest_seals_are_dropped_past_the_queue_size(tmpdir):
+    tracker = _stalled_tracker(tmpdir, queue_size=2)
+    tracker._tasks.put(None)
+    tracker._tasks.put(None)
+    for n in range(5):
+        tracker.shard_sealed("shard-{}".format(n))
+        tracker.add("message")
+    assert tracker.num_seals_dropped == 3
+    assert tracker.num_dropped == 5
+    _drain(tracker._tasks)
+    tracker.add("message")
+    assert _drain(tracker._tasks) == [('sealed', "shard-3"), ('sealed', "shard-4")]
@@ -0,0 +1,78 @@
+import os
+import threading
+import time
+
+from twitter_scraping.file_utils import ShardUploader
+from twitter_scraping.metrics import MetricsRegistry
+from twitter_scraping.storage import LocalStorage
+
+
+class _FlakyStorage(LocalStorage):
+    # Fails the first `failures` uploads, and records how many ran at once
+    def __init__(self, root, failures=0):
+        super(_FlakyStorage, self).__init__(root)
+        self.failures = failures
+        self.running = 0
+        self.most_running = 0
+        self._lock = threading.Lock()
+
+    def upload(self, filename, key):
+        with self._lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+            fail = self.failures > 0
+            self.failures -= 1
+        try:
+            if fail:
+                raise IOError("connection reset")
+            super(_FlakyStorage, self).upload(filename, key)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+def _shards(directory, count):
+    filenames = []
+    for n in range(1, count + 1):
+        path = directory.join("tweets-shard-{}.json".format(n))
+        path.write('{{"n": {}}}\n'.format(n))
+        filenames.append(str(path))
+    return filenames
+
+
+def test_uploads_are_retried_from_a_bounded_pool(tmpdir):
+    storage = _FlakyStorage(str(tmpdir.mkdir("storage")), failures=3)
+    metrics = MetricsRegistry()
+    uploader = ShardUploader(storage, str(tmpdir.mkdir("out")), root="tweets", workers=2, retry_delay=0.01,
+                             metrics=metrics)
+    filenames = _shards(tmpdir.join("out"), 10)
+    for filename in filenames:
+        uploader.handle_shard(filename)
+    uploader.close()
+
+    assert storage.most_running <= 2
+    assert uploader.pending() == {'queued': [], 'uploading': [], 'failed': []}
+    for n, filename in enumerate(filenames, 1):
+        assert not os.path.exists(filename)
+        assert tmpdir.join("storage", "tweets", os.path.basename(filename)).read() == '{{"n": {}}}\n'.format(n)
+    uploads = metrics.get('shard_uploads_total')
+    assert uploads.labels('retried').value == 3
+    assert uploads.labels('uploaded').value == 10
+
+
+def test_shards_which_keep_failing_are_kept_until_retried(tmpdir):
+    storage = _FlakyStorage(str(tmpdir.mkdir("storage")), failures=3)
+    uploader = ShardUploader(storage, str(tmpdir.mkdir("out")), root="tweets", workers=1, retries=2,
+                             retry_delay=0.01)
+    filename, = _shards(tmpdir.join("out"), 1)
+    uploader.handle_shard(filename)
+    deadline = time.time() + 5
+    while not uploader.pending()['failed'] and time.time() < deadline:
+        time.sleep(0.01)
+    assert uploader.pending()['failed'] == [filename]
+    assert os.path.exists(filename)
+
+    assert uploader.retry_failed() == 1
+    uploader.close()
+    assert not os.path.exists(filename)
+    assert tmpdir.join("storage", "tweets", "tweets-shard-1.json").exists()
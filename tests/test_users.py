@@ -0,0 +1,59 @@
+import json
+import os
+
+import pytest
+
+from twitter_scraping import cli
+from twitter_scraping.email import DummyEmailer
+from twitter_scraping.scraper import ScraperStreamListener, UserOptions
+from twitter_scraping.storage import LocalStorage
+from twitter_scraping.users import USERS_DIRECTORY, ProfileStore, UserNormalizer
+
+BASE_ID = 1300000000000000000
+
+
+def _status(n, user_id):
+    return {'created_at': "Sat Mar 27 12:00:00 +0000 2021", 'id': BASE_ID + (n << 22), 'id_str': str(BASE_ID + (n << 22)),
+            'text': "tweet {}".format(n), 'in_reply_to_status_id': None,
+            'user': {'id': user_id, 'id_str': str(user_id), 'screen_name': "user{}".format(user_id),
+                     'description': "about user {}".format(user_id), 'followers_count': n}}
+
+
+def _collect(output_dir, statuses):
+    with ScraperStreamListener(str(output_dir), emailer=DummyEmailer(), raw=True, users=UserOptions()) as listener:
+        for status in statuses:
+            listener.on_data(json.dumps(status))
+
+
+def test_references_keep_identity_and_volatile_fields():
+    profiles = []
+    normalizer = UserNormalizer(profiles.append)
+    first = normalizer.normalize(_status(1, 7))
+    second = normalizer.normalize(_status(2, 7))
+    assert first['user'] == {'id_str': "7", 'profile': first['user']['profile'], 'id': 7,
+                             'screen_name': "user7", 'followers_count': 1}
+    assert second['user']['profile'] == first['user']['profile']
+    assert len(profiles) == 1 and normalizer.num_reused == 1
+
+
+def test_rebuild_restores_user_objects(tmpdir):
+    _collect(tmpdir, [_status(1, 7), _status(2, 8), _status(3, 7)])
+    store = ProfileStore.load(LocalStorage(str(tmpdir)))
+    assert len(store) == 2
+    with open(str(tmpdir.join("tweets-shard-1.json"))) as f:
+        statuses = [store.rebuild(json.loads(line)) for line in f]
+    assert [s['user'] for s in statuses] == [_status(n, u)['user'] for n, u in [(1, 7), (2, 8), (3, 7)]]
+
+
+def test_convert_keeps_users_of_normalized_tweets(tmpdir):
+    pq = pytest.importorskip("pyarrow.parquet")
+    for join_users in (False, True):
+        output_dir = tmpdir.mkdir(str(join_users))
+        _collect(output_dir, [_status(1, 7), _status(2, 8)])
+        argv = [str(output_dir)] + (["--join-users"] if join_users else [])
+        cli.convert(argv)
+        table = pq.read_table(str(output_dir.join("tweets-shard-1.parquet")))
+        assert table.column('user_id').to_pylist() == [7, 8]
+        assert table.column('user_screen_name').to_pylist() == ["user7", "user8"]
+    # The profiles themselves are not converted
+    assert not os.path.exists(str(tmpdir.join("True", USERS_DIRECTORY, "users-shard-1.parquet")))
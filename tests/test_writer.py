@@ -0,0 +1,108 @@
+import json
+import random
+import threading
+import time
+import zlib
+
+from twitter_scraping.compression import get_codec
+from twitter_scraping.file_utils import BackgroundShardWriter, ShardedFileWriter, ShardUploader
+from twitter_scraping.manifest import OPEN, RECOMPRESSED, SEALED, ShardManifest
+from twitter_scraping.quota import aggressive_codec
+from twitter_scraping.storage import LocalStorage
+
+
+def _gzip_members(data):
+    count = 0
+    while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decompressor.decompress(data)
+        data = decompressor.unused_data
+        count += 1
+    return count
+
+
+def test_group_commits_end_blocks_only_at_checkpoints(tmpdir):
+    shards = ShardManifest(str(tmpdir))
+    writer = ShardedFileWriter(str(tmpdir), "tweets-shard-{n}.json", codec=get_codec('gzip'), manifest=shards,
+                               checkpoint_interval=0.2)
+    background = BackgroundShardWriter(writer, flush_bytes=1, flush_interval=0.01)
+    background.next_shard()
+    for n in range(100):
+        background.write('{{"n": {}}}\n'.format(n))
+        time.sleep(0.002)
+    # Flushed and checkpointed while idle, without another write
+    time.sleep(0.5)
+    filename = str(tmpdir.join("tweets-shard-1.json.gz"))
+    assert shards.get(filename)['records'] == 100
+    background.close()
+
+    with open(filename, "rb") as f:
+        assert get_codec('gzip').open_reader(f).read().count(b"\n") == 100
+        f.seek(0)
+        data = f.read()
+    # About one per checkpoint, rather than one per group commit
+    assert _gzip_members(data) <= 10
+
+
+class _HeldStorage(LocalStorage):
+    # Uploads wait until released, leaving the rest of the queue waiting
+    def __init__(self, root):
+        super(_HeldStorage, self).__init__(root)
+        self.release = threading.Event()
+
+    def upload(self, filename, key):
+        self.release.wait()
+        super(_HeldStorage, self).upload(filename, key)
+
+
+def test_recompressing_waiting_gzip_shards_saves_bytes(tmpdir):
+    shards = ShardManifest(str(tmpdir.mkdir("out")))
+    storage = _HeldStorage(str(tmpdir.mkdir("storage")))
+    uploader = ShardUploader(storage, str(tmpdir.join("out")), workers=1, manifest=shards)
+    writer = ShardedFileWriter(str(tmpdir.join("out")), "tweets-shard-{n}.json", codec=get_codec('gzip'),
+                               manifest=shards, max_records=2000)
+    writer.wrap_listener(lambda _: uploader)
+    writer.next_shard()
+    rand = random.Random(0)
+    for n in range(6000):
+        writer.write(json.dumps({'id': n, 'text': " ".join(rand.choice(["cats", "dogs", "birds", "#news"])
+                                                         for _ in range(12))}) + "\n")
+    # The first shard is being uploaded, the other two wait behind it
+    time.sleep(0.2)
+    waiting = uploader.pending()['queued']
+    assert len(waiting) == 2
+    before = [shards.get(f)['level'] for f in waiting]
+
+    saved = uploader.recompress_pending(aggressive_codec('gzip'))
+    assert saved > 0
+    assert before == [6, 6] and [shards.get(f)['level'] for f in waiting] == [9, 9]
+    assert sorted(uploader.pending()['queued']) == sorted(waiting)
+    # Already as compact as asked for
+    assert uploader.recompress_pending(aggressive_codec('gzip')) == 0
+    assert uploader.recompress_pending(get_codec('gzip', level=1)) == 0
+    assert all(shards.get(f)['state'] != RECOMPRESSED for f in waiting)
+
+    storage.release.set()
+    writer.close()
+    uploader.close()
+    for filename in waiting:
+        with open(str(tmpdir.join("storage", uploader.key_for(filename))), "rb") as f:
+            assert get_codec('gzip').open_reader(f).read().count(b"\n") == 2000
+
+
+def test_shards_are_rotated_on_age_without_another_write(tmpdir):
+    shards = ShardManifest(str(tmpdir))
+    writer = ShardedFileWriter(str(tmpdir), "tweets-shard-{n}.json", manifest=shards, max_age=0.3)
+    background = BackgroundShardWriter(writer, flush_bytes=1, flush_interval=0.01)
+    background.next_shard()
+    for n in range(10):
+        background.write('{{"n": {}}}\n'.format(n))
+    time.sleep(0.5)
+    first = str(tmpdir.join("tweets-shard-1.json"))
+    assert shards.get(first)['state'] == SEALED
+    assert shards.get(first)['records'] == 10
+    # The empty shard that replaced it is left open however long it waits
+    time.sleep(0.5)
+    assert shards.get(str(tmpdir.join("tweets-shard-2.json")))['state'] == OPEN
+    assert not tmpdir.join("tweets-shard-3.json").exists()
+    background.close()
@@ -0,0 +1,211 @@
+import asyncio
+import re
+import ssl
+import sys
+
+import requests
+import six
+
+from .log import get_logger
+
+_LOG = get_logger('async_stream')
+
+_STREAM_VERSION = '1.1'
+_CHARSET_RE = re.compile(r'charset=(?P<enc>\S*)')
+
+
+class AsyncStream(object):
+    """
+    asyncio counterpart to tweepy.Stream which feeds the same listener
+    callbacks (on_connect, on_data, on_error, on_timeout, on_exception), so
+    that several connections can share one event loop.
+
+    The response is read incrementally (chunked or not) and split into
+    messages on newlines; blank keep-alive lines only count as activity. If
+    nothing at all arrives for `stall_timeout` seconds the connection is
+    treated as stalled and re-established. Reconnects back off the same way
+    tweepy does: linearly after network errors, exponentially after HTTP
+    errors, starting at a minute for 420s.
+    """
+    def __init__(self, auth, listener, host='stream.twitter.com', secure=True, stall_timeout=90.0,
+                 retry_count=None, retry_time_start=5.0, retry_420_start=60.0, retry_time_cap=320.0,
+                 snooze_time_step=0.25, snooze_time_cap=16.0, chunk_size=1 << 16):
+        self.auth = auth
+        self.listener = listener
+        self.host = host
+        self.running = False
+        self._secure = secure
+        self._stall_timeout = stall_timeout
+        self._retry_count = retry_count
+        self._retry_time_start = retry_time_start
+        self._retry_420_start = retry_420_start
+        self._retry_time_cap = retry_time_cap
+        self._snooze_time_step = snooze_time_step
+        self._snooze_time_cap = snooze_time_cap
+        self._chunk_size = chunk_size
+        self._writer = None
+
+    @property
+    def _address(self):
+        host, _, port = self.host.partition(":")
+        return host, int(port) if port else (443 if self._secure else 80)
+
+    def _request(self, path, body):
+        url = "{}://{}{}".format("https" if self._secure else "http", self.host, path)
+        # requests does the form encoding and OAuth signing; only the bytes are sent
+        prepared = requests.Request('POST', url, data=body, auth=self.auth.apply_auth()).prepare()
+        headers = [
+            ("Host", self.host),
+            ("User-Agent", "twitter-scraping"),
+            ("Accept-Encoding", "identity"),
+            ("Connection", "close"),
+        ] + [(k, v) for k, v in prepared.headers.items() if k.lower() not in ("host", "connection")]
+        head = "POST {} HTTP/1.1\r\n{}\r\n\r\n".format(prepared.path_url, "\r\n".join("{}: {}".format(k, v) for k, v in headers))
+        body = prepared.body or b""
+        if isinstance(body, six.text_type):
+            body = body.encode("utf-8")
+        return head.encode("latin-1") + body
+
+    def _read(self, awaitable):
+        return asyncio.wait_for(awaitable, self._stall_timeout)
+
+    async def _read_head(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed before a response was received")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                return status, headers
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+    def _feed(self, buf, encoding):
+        start = 0
+        while self.running:
+            end = buf.find(b"\n", start)
+            if end < 0:
+                break
+            line = bytes(buf[start:end]).strip()
+            start = end + 1
+            # Skip keep-alives, and length prefixes in case the server sends them
+            if line and not line.isdigit():
+                if self.listener.on_data(line.decode(encoding)) is False:
+                    self.running = False
+        del buf[:start]
+
+    async def _read_loop(self, reader, headers):
+        match = _CHARSET_RE.search(headers.get('content-type', ''))
+        encoding = match.group('enc') if match is not None else 'utf-8'
+        chunked = headers.get('transfer-encoding', '').lower() == 'chunked'
+        buf = bytearray()
+        while self.running:
+            if chunked:
+                size_line = await self._read(reader.readline())
+                if not size_line:
+                    raise ConnectionError("Connection closed in the middle of the response")
+                size = int(size_line.split(b";")[0], 16)
+                if size == 0:
+                    return
+                data = (await self._read(reader.readexactly(size + 2)))[:-2]
+            else:
+                data = await self._read(reader.read(self._chunk_size))
+                if not data:
+                    return
+            buf += data
+            self._feed(buf, encoding)
+
+    async def _run(self, path, body):
+        error_counter = 0
+        retry_time = self._retry_time_start
+        snooze_time = self._snooze_time_step
+        exc_info = None
+        self.running = True
+        while self.running:
+            if self._retry_count is not None and error_counter > self._retry_count:
+                break
+            writer = None
+            try:
+                host, port = self._address
+                reader, writer = await self._read(asyncio.open_connection(
+                    host, port, ssl=ssl.create_default_context() if self._secure else None))
+                self._writer = writer
+                writer.write(self._request(path, body))
+                await writer.drain()
+                status, headers = await self._read(self._read_head(reader))
+                if status != 200:
+                    if self.listener.on_error(status) is False:
+                        break
+                    error_counter += 1
+                    if status == 420:
+                        retry_time = max(self._retry_420_start, retry_time)
+                    await asyncio.sleep(retry_time)
+                    retry_time = min(retry_time * 2, self._retry_time_cap)
+                else:
+                    error_counter = 0
+                    retry_time = self._retry_time_start
+                    snooze_time = self._snooze_time_step
+                    self.listener.on_connect()
+                    await self._read_loop(reader, headers)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ssl.SSLError, OSError) as e:
+                # Stalled or dropped connections are retried, like tweepy's timeouts
+                _LOG.warning("Stream connection to {} lost ({!r}); reconnecting.".format(self.host, e))
+                if self.listener.on_timeout() is False or not self.running:
+                    break
+                await asyncio.sleep(snooze_time)
+                snooze_time = min(snooze_time + self._snooze_time_step, self._snooze_time_cap)
+            except Exception:
+                # Anything else is fatal
+                exc_info = sys.exc_info()
+                break
+            finally:
+                self._writer = None
+                if writer is not None:
+                    writer.close()
+        self.running = False
+        if exc_info is not None:
+            self.listener.on_exception(exc_info[1])
+            six.reraise(*exc_info)
+
+    async def filter(self, follow=None, track=None, locations=None, stall_warnings=False,
+                     languages=None, encoding='utf8', filter_level=None):
+        if self.running:
+            raise RuntimeError("Stream object already connected!")
+        body = {}
+        if follow:
+            body['follow'] = u','.join(follow).encode(encoding)
+        if track:
+            body['track'] = u','.join(track).encode(encoding)
+        if locations:
+            if len(locations) % 4 != 0:
+                raise ValueError("Wrong number of locations points, it has to be a multiple of 4")
+            body['locations'] = u','.join(['%.4f' % l for l in locations])
+        if stall_warnings:
+            body['stall_warnings'] = 'true'
+        if languages:
+            body['language'] = u','.join(map(str, languages))
+        if filter_level:
+            body['filter_level'] = filter_level.encode(encoding)
+        await self._run('/{}/statuses/filter.json'.format(_STREAM_VERSION), body)
+
+    def disconnect(self):
+        self.running = False
+        if self._writer is not None:
+            self._writer.close()
+
+
+def run(*coroutines):
+    """
+    Runs stream coroutines (e.g. several `AsyncStream.filter()` calls) to
+    completion on a fresh event loop.
+    """
+    async def gather():
+        return await asyncio.gather(*coroutines)
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(gather())
+    finally:
+        loop.close()
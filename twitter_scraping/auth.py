@@ -39,7 +39,7 @@ def get_auth():
         if len(in_environment) > 0:
             not_in_environment = env_vars.difference(in_environment)
             is_are = "is" if len(not_in_environment) == 1 else "are"
-            _LOG.warn("Warning: Variables {} in environment, but {} {} missing".format(", ".join(in_environment), ", ".join(not_in_environment), is_are))
+            _LOG.warning("Warning: Variables {} in environment, but {} {} missing".format(", ".join(in_environment), ", ".join(not_in_environment), is_are))
         _LOG.info("Authentication information not found. Prompting.")
         cfg = {}
     prompted_any = False
@@ -0,0 +1,245 @@
+import json
+import requests
+import threading
+import time
+
+from six.moves import queue
+
+from .log import get_logger
+from .metrics import MetricsRegistry
+from .shard_index import first_id_at
+
+_LOG = get_logger('backfill')
+
+DEFAULT_API_URL = "https://api.twitter.com/1.1"
+SEARCH = 'search/tweets'
+USER_TIMELINE = 'statuses/user_timeline'
+
+# Requests allowed per rate limit window with user auth, used until an
+# endpoint's response headers say otherwise
+DEFAULT_LIMITS = {SEARCH: 180, USER_TIMELINE: 900}
+_WINDOW_SECONDS = 15 * 60
+_PAGE_SIZES = {SEARCH: 100, USER_TIMELINE: 200}
+# Responses which mean the query itself can't succeed (e.g. a protected user)
+_FATAL_STATUS_CODES = (400, 401, 403, 404)
+_DONE = object()
+
+
+class TokenBucket(object):
+    """
+    Blocks `acquire` callers to at most `rate` per second, with bursts of up
+    to `capacity`. `update` brings it in line with what the server reports:
+    the bucket never holds more tokens than requests remain, and once none
+    remain it stays empty until the window resets.
+    """
+    def __init__(self, rate, capacity):
+        assert rate > 0, "rate must be greater than zero"
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.time()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self._capacity, self._tokens + max(0.0, now - self._updated) * self._rate)
+        self._updated = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                if now >= self._paused_until:
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self._rate
+                else:
+                    wait = self._paused_until - now
+            time.sleep(wait)
+
+    def pause_until(self, until):
+        with self._lock:
+            self._paused_until = max(self._paused_until, until)
+            self._tokens = 0.0
+            self._updated = max(self._updated, until)
+
+    def update(self, limit, remaining, reset):
+        now = time.time()
+        if remaining <= 0:
+            self.pause_until(reset)
+            return
+        with self._lock:
+            self._refill(now)
+            self._capacity = limit
+            self._tokens = min(self._tokens, remaining)
+            # Spread what's left over the rest of the window
+            if reset > now:
+                self._rate = max(remaining / (reset - now), 1.0 / _WINDOW_SECONDS)
+
+
+class RateLimiter(object):
+    """
+    A TokenBucket per endpoint, starting from `limits` (requests per 15
+    minute window, by default DEFAULT_LIMITS) and following the
+    x-rate-limit-* headers of each response.
+    """
+    def __init__(self, limits=None):
+        self._limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, endpoint):
+        with self._lock:
+            bucket = self._buckets.get(endpoint)
+            if bucket is None:
+                limit = self._limits.get(endpoint, 15)
+                bucket = self._buckets[endpoint] = TokenBucket(limit / float(_WINDOW_SECONDS), limit)
+            return bucket
+
+    def update(self, endpoint, headers):
+        try:
+            limit = int(headers['x-rate-limit-limit'])
+            remaining = int(headers['x-rate-limit-remaining'])
+            reset = float(headers['x-rate-limit-reset'])
+        except (KeyError, ValueError):
+            return
+        self.bucket(endpoint).update(limit, remaining, reset)
+
+
+def backfill_queries(track=None, follow=None):
+    """
+    The (endpoint, parameters) queries which cover a stream's `track` terms
+    (through search) and `follow` user ids (through their timelines).
+    """
+    queries = [(SEARCH, {'q': term, 'result_type': 'recent'}) for term in track or []]
+    queries += [(USER_TIMELINE, {'user_id': user_id, 'include_rts': 'true'}) for user_id in follow or []]
+    return queries
+
+
+class Backfill(object):
+    """
+    Fetches the tweets posted during each of `ranges` ((since, until) in
+    seconds since the epoch) for each of `queries` (see backfill_queries),
+    paging back through the REST API at `api_url` with `workers` concurrent
+    requests, under a RateLimiter.
+
+    Tweet ids are snowflakes, so time ranges are turned into since_id and
+    max_id bounds and each page continues below the smallest id seen. Pages
+    are handed to `run`'s callback as raw JSON from the calling thread, so it
+    can feed a ScraperStreamListener, which dedups and writes them exactly as
+    it would the stream. Failed requests are retried `max_retries` times
+    with exponential backoff; a query which still fails is abandoned.
+    """
+    def __init__(self, auth, queries, ranges, api_url=None, workers=4, limiter=None, max_retries=5,
+                 retry_delay=1.0, metrics=None):
+        assert workers > 0, "workers must be greater than zero"
+        self._auth = auth.apply_auth() if auth is not None else None
+        self._queries = queries
+        self._ranges = ranges
+        self._api_url = (api_url or DEFAULT_API_URL).rstrip("/")
+        self._workers = workers
+        self._limiter = limiter or RateLimiter()
+        self._max_retries = max_retries
+        self._retry_delay = retry_delay
+        metrics = metrics or MetricsRegistry()
+        self._requests = metrics.counter('backfill_requests_total', "REST requests made by backfill, by endpoint and status",
+                                         labels=('endpoint', 'status'))
+        self._fetched = metrics.counter('backfill_statuses_total', "Statuses fetched by backfill")
+        self.num_fetched = 0
+        self.num_failed = 0
+
+    def _get(self, session, endpoint, params):
+        bucket = self._limiter.bucket(endpoint)
+        delay = self._retry_delay
+        failures = 0
+        while True:
+            bucket.acquire()
+            try:
+                response = session.get("{}/{}.json".format(self._api_url, endpoint), params=params,
+                                       auth=self._auth, timeout=60)
+            except requests.RequestException as e:
+                self._requests.labels(endpoint, 'error').inc()
+                _LOG.warning("Backfill request to {} failed: {}".format(endpoint, e))
+            else:
+                self._requests.labels(endpoint, response.status_code).inc()
+                self._limiter.update(endpoint, response.headers)
+                if response.status_code == 200:
+                    return response.json()
+                if response.status_code == 429:
+                    # Not a failure: wait for the window to reset and go again
+                    reset = response.headers.get('x-rate-limit-reset')
+                    bucket.pause_until(float(reset) if reset else time.time() + _WINDOW_SECONDS)
+                    _LOG.warning("Rate limited on {}; waiting for the window to reset.".format(endpoint))
+                    continue
+                if response.status_code in _FATAL_STATUS_CODES:
+                    raise ValueError("{} {}: HTTP {}".format(endpoint, params, response.status_code))
+                _LOG.warning("Backfill request to {} returned {}".format(endpoint, response.status_code))
+            failures += 1
+            if failures > self._max_retries:
+                raise IOError("{} {}: giving up after {} attempts".format(endpoint, params, failures))
+            time.sleep(delay)
+            delay *= 2
+
+    def _pages(self, session, endpoint, params, since, until):
+        params = dict(params, count=_PAGE_SIZES.get(endpoint, 100),
+                      since_id=max(0, first_id_at(int(since * 1000)) - 1))
+        max_id = first_id_at(int(until * 1000)) - 1 if until is not None else None
+        while True:
+            if max_id is not None:
+                params['max_id'] = max_id
+            body = self._get(session, endpoint, params)
+            statuses = body['statuses'] if isinstance(body, dict) else body
+            if not statuses:
+                return
+            yield statuses
+            max_id = min(status['id'] for status in statuses) - 1
+
+    def _work(self, tasks, results):
+        session = requests.Session()
+        while True:
+            try:
+                endpoint, params, since, until = tasks.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                for statuses in self._pages(session, endpoint, params, since, until):
+                    results.put(statuses)
+            except Exception as e:
+                _LOG.error("Abandoning backfill of {} {}: {}".format(endpoint, params, e))
+                self.num_failed += 1
+        results.put(_DONE)
+
+    def run(self, handle):
+        """
+        Calls `handle` with each status fetched, as raw JSON. Returns the
+        number of statuses fetched.
+        """
+        tasks = queue.Queue()
+        for since, until in self._ranges:
+            for endpoint, params in self._queries:
+                tasks.put((endpoint, params, since, until))
+        num_workers = min(self._workers, tasks.qsize())
+        # Bounded, so that fetching waits for writing
+        results = queue.Queue(maxsize=num_workers * 4)
+        workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(name='backfill_{}'.format(i), target=self._work, args=(tasks, results))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        running = num_workers
+        while running:
+            statuses = results.get()
+            if statuses is _DONE:
+                running -= 1
+                continue
+            for status in statuses:
+                handle(json.dumps(status, separators=(',', ':')))
+            self.num_fetched += len(statuses)
+            self._fetched.inc(len(statuses))
+        for worker in workers:
+            worker.join()
+        _LOG.info("Backfill fetched {:,} statuses ({} queries abandoned).".format(self.num_fetched, self.num_failed))
+        return self.num_fetched
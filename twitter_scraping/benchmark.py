@@ -0,0 +1,161 @@
+import multiprocessing
+import re
+import resource
+import shutil
+import tempfile
+import time
+
+from .email import DummyEmailer
+from .log import get_logger
+from .replay import ReplayServer, load_tweets, synthetic_tweets
+from .scraper import ScraperBuilder, ScraperStreamListener
+
+_LOG = get_logger('benchmark')
+
+_TIMESTAMP_RE = re.compile(r'"timestamp_ms":\s*"(\d+)"')
+
+
+class _NoAuth(object):
+    def apply_auth(self):
+        return None
+
+
+class _BenchmarkListener(ScraperStreamListener):
+    """
+    Records when each message arrived and how long after being sent by the
+    replay server it had been handed to the writer.
+    """
+    def __init__(self, *args, **kwargs):
+        super(_BenchmarkListener, self).__init__(*args, **kwargs)
+        self.latencies_ms = []
+        self.first_received = None
+        self.last_received = None
+        self.num_received = 0
+
+    def on_data(self, raw_data):
+        if self.first_received is None:
+            self.first_received = time.time()
+        ret = super(_BenchmarkListener, self).on_data(raw_data)
+        now = time.time()
+        self.last_received = now
+        match = _TIMESTAMP_RE.search(raw_data)
+        if match is not None:
+            # Only tweets are timestamped, so this skips control messages
+            self.num_received += 1
+            self.latencies_ms.append(now * 1000 - int(match.group(1)))
+        return ret
+
+    def on_disconnect(self, notice):
+        # The replay server sends a disconnect notice once it's done
+        return False
+
+    @property
+    def num_written(self):
+        return self._num_written
+
+
+def _serve(conn, files, count, rate, retweet_ratio, loop):
+    if files:
+        tweets = load_tweets(files)
+    else:
+        tweets = list(synthetic_tweets(count, retweet_ratio=retweet_ratio))
+    server = ReplayServer(tweets, rate=rate, count=count, loop=loop)
+    conn.send(server.url)
+    server.serve_forever()
+
+
+def _percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+def _current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        return None
+
+
+def run_benchmark(builder=None, count=100000, rate=None, files=None, retweet_ratio=0.5, output_dir=None):
+    """
+    Replays `count` tweets (synthetic, or read from `files`) through the
+    pipeline configured by `builder` and measures how it keeps up. The replay
+    server runs in its own process so that it doesn't compete with the
+    pipeline for the interpreter.
+    """
+    builder = builder or ScraperBuilder()
+    cleanup = output_dir is None
+    output_dir = output_dir or tempfile.mkdtemp(prefix="twitter-scraping-benchmark-")
+    parent_conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=_serve,
+                                     args=(child_conn, files, count, rate, retweet_ratio, bool(files)))
+    server.daemon = True
+    server.start()
+    listeners = []
+
+    def make_listener(*args, **kwargs):
+        listener = _BenchmarkListener(*args, **kwargs)
+        listeners.append(listener)
+        return listener
+
+    try:
+        url = parent_conn.recv()
+        builder.ignore_none(False)\
+               .stream_url(url)\
+               .auth(_NoAuth())\
+               .listener_class(make_listener)\
+               .output_dir(output_dir)\
+               .emailer(DummyEmailer())
+        # The replay server ignores filters, but the builder requires one
+        builder.track(['benchmark'])
+        usage_before = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.time()
+        with builder.build():
+            pass
+        end = time.time()
+        usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        server.terminate()
+        server.join()
+        if cleanup:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    listener = listeners[0]
+    latencies = sorted(listener.latencies_ms)
+    cpu_seconds = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    # From the first message to everything being on disk
+    elapsed = end - (listener.first_received or start)
+    return {
+        'received': listener.num_received,
+        'written': listener.num_written,
+        'seconds': elapsed,
+        'received_per_second': listener.num_received / elapsed if elapsed > 0 else None,
+        'written_per_second': listener.num_written / elapsed if elapsed > 0 else None,
+        'latency_ms': {
+            'p50': _percentile(latencies, 50),
+            'p90': _percentile(latencies, 90),
+            'p99': _percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None,
+        },
+        'cpu_seconds': cpu_seconds,
+        'cpu_percent': 100.0 * cpu_seconds / (end - start) if end > start else None,
+        # ru_maxrss is in kilobytes on Linux
+        'max_rss_bytes': usage_after.ru_maxrss * 1024,
+        'rss_bytes': _current_rss(),
+    }
+
+
+def format_report(report):
+    latency = report['latency_ms']
+    lines = [
+        "Received {:,} tweets and wrote {:,} in {:.2f}s".format(report['received'], report['written'], report['seconds']),
+        "Throughput: {:,.0f} received/s, {:,.0f} written/s".format(report['received_per_second'] or 0, report['written_per_second'] or 0),
+    ]
+    if latency['p50'] is not None:
+        lines.append("Latency (ms): p50={:.1f} p90={:.1f} p99={:.1f} max={:.1f}".format(
+            latency['p50'], latency['p90'], latency['p99'], latency['max']))
+    lines.append("CPU: {:.2f}s ({:.0f}% of one core)".format(report['cpu_seconds'], report['cpu_percent'] or 0))
+    lines.append("Peak RSS: {:,.1f}MB".format(report['max_rss_bytes'] / float(1 << 20)))
+    return "\n".join(lines)
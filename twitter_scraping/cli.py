@@ -1,5 +1,7 @@
 import argparse
+import json
 import logging
+import os
 import sys
 
 from . import email
@@ -8,7 +10,13 @@ from . import scraper
 
 _LOG = log.get_logger('cli')
 
-def twitter_scraping():
+def twitter_scraping(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) > 0 and argv[0] in _SUBCOMMANDS:
+        return _SUBCOMMANDS[argv[0]](argv[1:])
+    return scrape(argv)
+
+def scrape(argv):
     parser = argparse.ArgumentParser(description="Run a twitter scraper")
     parser.add_argument("--follow", action='append', help="User to track (overwrites config)")
     parser.add_argument("--track", action='append', help="Query to track (overwrites config)")
@@ -20,11 +28,75 @@ def twitter_scraping():
     parser.add_argument('--hours', type=int, help="Notification frequency (in hours)")
     parser.add_argument('-n', '--notify-every', type=int, help="Notification frequency (in tweets)", dest='notify_count')
     parser.add_argument('--no-email', action='store_false', help="Disable emailing", dest='email')
+    parser.add_argument('--smtp-server', type=str, help="Send email through this host:port without SSL or login (e.g. a local sink) instead of Gmail", dest='smtp_server')
+    parser.add_argument('--email-digest-seconds', type=float, default=10.0, help="Coalesce emails with the same subject sent within this many seconds", dest='email_digest_seconds')
+    parser.add_argument('--email-min-interval', type=float, default=300.0, help="Minimum seconds between emails with the same subject", dest='email_min_interval')
     parser.add_argument('--s3-bucket', type=str, help="S3 Bucket to offload data onto", dest='s3_bucket')
     parser.add_argument('--shard-size', type=int, help="Size of sharded data files", dest='shard_max')
     parser.add_argument('--s3-root', type=str, help="Root prefix on S3 to upload with", dest='s3_root')
+    parser.add_argument('--storage-dir', type=str, help="Local directory to offload data into (instead of S3)", dest='storage_dir')
+    parser.add_argument('--upload-workers', type=int, help="Number of concurrent shard uploads", dest='upload_workers')
+    parser.add_argument('--upload-retries', type=int, help="Number of times to retry a failed shard upload", dest='upload_retries')
+    parser.add_argument('--background-writer', action='store_true', default=None, help="Write shards from a background thread", dest='background_writer')
+    parser.add_argument('--writer-queue-size', type=int, help="Maximum number of tweets queued for the background writer", dest='writer_queue_size')
+    parser.add_argument('--flush-bytes', type=int, help="Bytes to batch up before the background writer flushes", dest='flush_bytes')
+    parser.add_argument('--flush-interval', type=float, help="Maximum seconds between background writer flushes", dest='flush_interval')
+    parser.add_argument('--backpressure', choices=scraper.BACKPRESSURE_POLICIES, help="What to do when the background writer falls behind")
+    parser.add_argument('--dedup', choices=sorted(scraper.DEDUP_KINDS), help="Kind of index used to drop duplicate tweets")
+    parser.add_argument('--dedup-snapshot', type=str, help="File to persist the dedup index to between runs", dest='dedup_snapshot')
+    parser.add_argument('--codec', choices=sorted(scraper.CODECS), help="Compression used for shards")
+    parser.add_argument('--compression-level', type=int, help="Compression level for the shard codec", dest='compression_level')
+    parser.add_argument('--shard-max-bytes', type=int, help="Rotate shards after this many uncompressed bytes", dest='shard_max_bytes')
+    parser.add_argument('--shard-max-compressed-bytes', type=int, help="Rotate shards after this many bytes on disk", dest='shard_max_compressed_bytes')
+    parser.add_argument('--shard-max-age', type=int, help="Rotate shards after this many seconds", dest='shard_max_age')
+    parser.add_argument('--no-shard-index', action='store_false', default=None, help="Don't write an id/offset index alongside each shard", dest='shard_index')
+    parser.add_argument('--index-block-bytes', type=int, help="Uncompressed bytes per independently readable block of an indexed compressed shard", dest='index_block_bytes')
+    parser.add_argument('--columnar', action='store_true', default=None, help="Convert sealed shards to Parquet before uploading them (requires pyarrow)")
+    parser.add_argument('--drop-json', action='store_false', default=None, help="With --columnar, keep only the Parquet copy of each shard", dest='keep_json')
+    parser.add_argument('--normalize-users', action='store_true', default=None, help="Replace user objects with references to profiles stored once each under users/", dest='normalize_users')
+    parser.add_argument('--user-cache-size', type=int, help="Number of users whose latest profile is remembered when normalizing", dest='user_cache_size')
+    parser.add_argument('--keep-field', type=str, action='append', help="Write only these dotted paths of each tweet (repeatable)", dest='keep_fields')
+    parser.add_argument('--drop-field', type=str, action='append', help="Leave this dotted path out of each tweet (repeatable)", dest='drop_fields')
+    parser.add_argument('--predicate', type=json.loads, action='append', help="Only write tweets matching this JSON predicate, e.g. '{\"field\": \"lang\", \"in\": [\"en\"]}' (repeatable)", dest='predicates')
+    parser.add_argument('--engagement', action='store_true', default=None, help="Count retweets and quotes of each original, written periodically under engagement/")
+    parser.add_argument('--engagement-capacity', type=int, help="Most originals counted in memory at once", dest='engagement_capacity')
+    parser.add_argument('--engagement-flush-interval', type=float, help="Seconds between writes of engagement counts", dest='engagement_flush_interval')
+    parser.add_argument('--trends', action='store_true', default=None, help="Keep top hashtags, mentions, URL domains and tracked terms per window and per shard, under trends/")
+    parser.add_argument('--trends-window', type=float, help="Seconds per trends window", dest='trends_window')
+    parser.add_argument('--trends-capacity', type=int, help="Items counted per trends category", dest='trends_capacity')
+    parser.add_argument('--trends-top', type=int, help="Items written per trends category", dest='trends_top')
+    parser.add_argument('--trends-in-notify', action='store_true', default=None, help="Include the top trends in notifications", dest='trends_in_notify')
+    parser.add_argument('--partition-by', type=str, action='append', help="Write tweets into a directory per value of this field, nested in the order given: 'dt' and 'hour' (when created, UTC) or a dotted path such as lang (repeatable)", dest='partition_by')
+    parser.add_argument('--max-open-partitions', type=int, help="Most partitions with a shard open at once", dest='max_open_partitions')
+    parser.add_argument('--partition-idle-seconds', type=float, help="Seal a partition's shard after this many seconds without a write", dest='partition_idle_seconds')
+    parser.add_argument('--disk-budget', type=int, help="Bytes the output directory may use before the disk policies apply", dest='disk_budget')
+    parser.add_argument('--disk-soft-watermark', type=float, help="Share of the disk budget at which the soft policy applies", dest='disk_soft_watermark')
+    parser.add_argument('--disk-hard-watermark', type=float, help="Share of the disk budget at which the hard policy applies as well", dest='disk_hard_watermark')
+    parser.add_argument('--disk-soft-policy', choices=scraper.QUOTA_POLICIES, help="What to do over the soft watermark", dest='disk_soft_policy')
+    parser.add_argument('--disk-hard-policy', choices=scraper.QUOTA_POLICIES, help="What to do over the hard watermark", dest='disk_hard_policy')
+    parser.add_argument('--disk-sample-rate', type=float, help="Share of tweets kept by the 'sample' disk policy", dest='disk_sample_rate')
+    parser.add_argument('--disk-recompress-codec', choices=sorted(scraper.CODECS), help="Codec the 'recompress' disk policy rewrites waiting shards with", dest='disk_recompress_codec')
+    parser.add_argument('--sample-rate', type=float, help="Share of tweets to keep, chosen by a hash of their id so that every collector keeps the same ones", dest='sample_rate')
+    parser.add_argument('--adaptive-sampling', action='store_true', default=None, help="Lower the sample rate while falling behind the stream, and raise it again once caught up", dest='adaptive_sampling')
+    parser.add_argument('--min-sample-rate', type=float, help="Lowest rate adaptive sampling goes down to", dest='min_sample_rate')
+    parser.add_argument('--sampling-target-lag', type=float, help="Seconds behind the stream adaptive sampling tolerates before lowering the rate", dest='sampling_target_lag')
+    parser.add_argument('--hot-reload', action='store_true', default=None, help="Switch to new filters when the config file changes or on SIGHUP, without restarting", dest='hot_reload')
+    parser.add_argument('--control-socket', type=str, help="Unix socket accepting 'reload', 'status' or a JSON object of new filters", dest='control_socket')
+    parser.add_argument('--handoff-timeout', type=float, help="Seconds to wait for a new connection to deliver before keeping the old one", dest='handoff_timeout')
+    parser.add_argument('--no-manifest', action='store_false', default=None, help="Disable the shard manifest used to resume after a crash", dest='manifest')
+    parser.add_argument('--raw', action='store_true', default=None, help="Write raw stream messages without re-serializing them")
+    parser.add_argument('--engine', choices=scraper.ENGINES, help="Streaming client to use")
+    parser.add_argument('--stall-timeout', type=float, help="Reconnect after this many seconds without data (asyncio engine)", dest='stall_timeout')
+    parser.add_argument('--gaps-log', type=str, help="File to record coverage gaps in (default: gaps.jsonl in the output directory)", dest='gaps_log')
+    parser.add_argument('--max-errors', type=int, help="Give up after this many HTTP errors in a row (default: keep retrying)", dest='max_errors')
+    parser.add_argument('--max-reconnects', type=int, help="Give up after this many failed reconnects in a row (default: keep retrying)", dest='max_reconnects')
+    parser.add_argument('--workers', type=int, help="Split the filters across this many worker processes, each with its own connection", dest='workers')
+    parser.add_argument('--shared-dedup-capacity', type=int, help="Slots in the dedup table shared by workers (a power of two)", dest='shared_dedup_capacity')
+    parser.add_argument('--metrics-port', type=int, help="Serve Prometheus metrics on this local port", dest='metrics_port')
+    parser.add_argument('--metrics-snapshot', type=str, help="File to append JSON metrics snapshots to", dest='metrics_snapshot')
+    parser.add_argument('--metrics-snapshot-interval', type=float, help="Seconds between JSON metrics snapshots", dest='metrics_snapshot_interval')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if len([x for x in [args.seconds, args.minutes, args.hours] if x is not None]) > 1:
         print("Options are mutually exclusive: --seconds, --minutes, and --hours.")
@@ -38,10 +110,18 @@ def twitter_scraping():
     if args.hours is not None:
         notify_seconds = args.hours * 3600
 
-    if args.email:
-        emailer = email.Emailer()
-    else:
+    if not args.email:
         emailer = email.DummyEmailer()
+    elif args.smtp_server is not None:
+        host, _, port = args.smtp_server.partition(":")
+        emailer = email.Emailer(host=host, port=int(port or 25), use_ssl=False,
+                                credentials={'username': 'twitter-scraping@{}'.format(host)})
+    else:
+        emailer = email.Emailer()
+    # Sending happens on a background thread so it never holds up collection
+    emailer = email.BackgroundEmailer(emailer,
+                                      digest_window=args.email_digest_seconds,
+                                      min_interval=args.email_min_interval)
     
     if args.config is None:
         builder = scraper.ScraperBuilder()
@@ -57,7 +137,68 @@ def twitter_scraping():
               .emailer(emailer)\
               .s3_bucket(args.s3_bucket)\
               .s3_root(args.s3_root)\
-              .shard_max(args.shard_max)
+              .storage_dir(args.storage_dir)\
+              .upload_workers(args.upload_workers)\
+              .upload_retries(args.upload_retries)\
+              .shard_max(args.shard_max)\
+              .raw(args.raw)\
+              .manifest(args.manifest)\
+              .background_writer(args.background_writer)\
+              .writer_queue_size(args.writer_queue_size)\
+              .flush_bytes(args.flush_bytes)\
+              .flush_interval(args.flush_interval)\
+              .backpressure(args.backpressure)\
+              .dedup(args.dedup)\
+              .dedup_snapshot(args.dedup_snapshot)\
+              .codec(args.codec)\
+              .compression_level(args.compression_level)\
+              .shard_max_bytes(args.shard_max_bytes)\
+              .shard_max_compressed_bytes(args.shard_max_compressed_bytes)\
+              .shard_max_age(args.shard_max_age)\
+              .shard_index(args.shard_index)\
+              .index_block_bytes(args.index_block_bytes)\
+              .columnar(args.columnar)\
+              .keep_json(args.keep_json)\
+              .normalize_users(args.normalize_users)\
+              .user_cache_size(args.user_cache_size)\
+              .keep_fields(args.keep_fields)\
+              .drop_fields(args.drop_fields)\
+              .predicates(args.predicates)\
+              .engagement(args.engagement)\
+              .engagement_capacity(args.engagement_capacity)\
+              .engagement_flush_interval(args.engagement_flush_interval)\
+              .trends(args.trends)\
+              .trends_window(args.trends_window)\
+              .trends_capacity(args.trends_capacity)\
+              .trends_top(args.trends_top)\
+              .trends_in_notify(args.trends_in_notify)\
+              .partition_by(args.partition_by)\
+              .max_open_partitions(args.max_open_partitions)\
+              .partition_idle_seconds(args.partition_idle_seconds)\
+              .disk_budget(args.disk_budget)\
+              .disk_soft_watermark(args.disk_soft_watermark)\
+              .disk_hard_watermark(args.disk_hard_watermark)\
+              .disk_soft_policy(args.disk_soft_policy)\
+              .disk_hard_policy(args.disk_hard_policy)\
+              .disk_sample_rate(args.disk_sample_rate)\
+              .disk_recompress_codec(args.disk_recompress_codec)\
+              .sample_rate(args.sample_rate)\
+              .adaptive_sampling(args.adaptive_sampling)\
+              .min_sample_rate(args.min_sample_rate)\
+              .sampling_target_lag(args.sampling_target_lag)\
+              .hot_reload(args.hot_reload)\
+              .control_socket(args.control_socket)\
+              .handoff_timeout(args.handoff_timeout)\
+              .engine(args.engine)\
+              .stall_timeout(args.stall_timeout)\
+              .gaps_log(args.gaps_log)\
+              .max_errors(args.max_errors)\
+              .max_reconnects(args.max_reconnects)\
+              .workers(args.workers)\
+              .shared_dedup_capacity(args.shared_dedup_capacity)\
+              .metrics_port(args.metrics_port)\
+              .metrics_snapshot(args.metrics_snapshot)\
+              .metrics_snapshot_interval(args.metrics_snapshot_interval)
     try:
         with builder.build() as s:
             # Context manages things like files
@@ -71,3 +212,370 @@ def twitter_scraping():
         emailer.send_text(message="The run ended in failure:\n{}".format(errmsg),
                           subject="[ERROR] {default_subject}")
         return 1
+    finally:
+        emailer.close()
+
+def replay(argv):
+    from .replay import MockApiServer, ReplayServer, load_tweets, synthetic_tweets
+    parser = argparse.ArgumentParser(prog="scrape-twitter replay", description="Serve recorded or synthetic tweets over the streaming protocol")
+    parser.add_argument("files", nargs='*', help="Shards to replay (synthetic tweets are generated if omitted)")
+    parser.add_argument("--host", type=str, default='127.0.0.1', help="Address to listen on")
+    parser.add_argument("-p", "--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("-r", "--rate", type=float, help="Tweets per second (default: as fast as possible)")
+    parser.add_argument("-n", "--count", type=int, help="Number of tweets to send per connection")
+    parser.add_argument("--loop", action='store_true', help="Replay the input repeatedly")
+    parser.add_argument("--error-code", type=int, action='append', help="Status code to refuse the next connection with (repeatable)", dest='error_codes')
+    parser.add_argument("--retweet-ratio", type=float, default=0.5, help="Share of synthetic tweets which are retweets", dest='retweet_ratio')
+    parser.add_argument("--api", action='store_true', help="Answer REST search and user timeline requests (for backfill) instead of streaming")
+    args = parser.parse_args(argv)
+
+    if args.files:
+        tweets = load_tweets(args.files)
+    else:
+        tweets = list(synthetic_tweets(args.count or 100000, retweet_ratio=args.retweet_ratio))
+    if args.api:
+        server = MockApiServer(tweets, host=args.host, port=args.port, error_codes=args.error_codes)
+    else:
+        server = ReplayServer(tweets, host=args.host, port=args.port, rate=args.rate, count=args.count,
+                              loop=args.loop, error_codes=args.error_codes)
+    _LOG.info("Replaying {:,} tweets on {}".format(len(tweets), server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+def benchmark(argv):
+    from .benchmark import format_report, run_benchmark
+    parser = argparse.ArgumentParser(prog="scrape-twitter benchmark", description="Measure pipeline throughput against a local replay server")
+    parser.add_argument("files", nargs='*', help="Shards to replay (synthetic tweets are generated if omitted)")
+    parser.add_argument("-c", "--config", type=str, help="JSON configuration for the pipeline under test")
+    parser.add_argument("-n", "--count", type=int, default=100000, help="Number of tweets to replay")
+    parser.add_argument("-r", "--rate", type=float, help="Tweets per second (default: as fast as possible)")
+    parser.add_argument("-o", "--output-dir", type=str, help="Keep output in this directory", dest='output_dir')
+    parser.add_argument("--retweet-ratio", type=float, default=0.5, help="Share of synthetic tweets which are retweets", dest='retweet_ratio')
+    parser.add_argument('--raw', action='store_true', default=None, help="Write raw stream messages without re-serializing them")
+    parser.add_argument('--background-writer', action='store_true', default=None, help="Write shards from a background thread", dest='background_writer')
+    parser.add_argument('--codec', choices=sorted(scraper.CODECS), help="Compression used for shards")
+    parser.add_argument('--engine', choices=scraper.ENGINES, help="Streaming client to use")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    if args.config is None:
+        builder = scraper.ScraperBuilder()
+    else:
+        builder = scraper.ScraperBuilder.load_config(args.config)
+    builder = builder.ignore_none()\
+              .raw(args.raw)\
+              .background_writer(args.background_writer)\
+              .codec(args.codec)\
+              .engine(args.engine)
+    report = run_benchmark(builder, count=args.count, rate=args.rate, files=args.files,
+                           retweet_ratio=args.retweet_ratio, output_dir=args.output_dir)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report))
+    return 0
+
+def smtp_sink(argv):
+    import time
+    parser = argparse.ArgumentParser(prog="scrape-twitter smtp-sink", description="Run a local SMTP server which logs notification emails instead of sending them")
+    parser.add_argument("--host", type=str, default='127.0.0.1', help="Address to listen on")
+    parser.add_argument("-p", "--port", type=int, default=8025, help="Port to listen on")
+    args = parser.parse_args(argv)
+
+    sink = email.SMTPSink(host=args.host, port=args.port).start()
+    _LOG.info("SMTP sink listening on {}:{} (use --smtp-server {}:{})".format(args.host, sink.port, args.host, sink.port))
+    seen = 0
+    try:
+        while True:
+            time.sleep(0.5)
+            for message in sink.messages[seen:]:
+                print("Subject: {}\n\n{}\n".format(message['Subject'], message.get_payload()))
+            seen = len(sink.messages)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.stop()
+    return 0
+
+def _parse_time(value):
+    """
+    Seconds since the epoch, given either as a number or as a UTC date/time.
+    """
+    import calendar
+    import datetime
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return calendar.timegm(datetime.datetime.strptime(value, fmt).timetuple())
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("not a timestamp or YYYY-MM-DD[THH:MM[:SS]] date: {}".format(value))
+
+def _parse_where(value):
+    field, sep, expected = value.partition("=")
+    if not sep or not field:
+        raise argparse.ArgumentTypeError("expected FIELD=VALUE: {}".format(value))
+    return field, expected
+
+def read(argv):
+    from .layout import PartitionLayout
+    from .reader import DEFAULT_PATTERN, RecordFilter, ShardQuery
+    from .storage import LocalStorage, S3Storage
+    parser = argparse.ArgumentParser(prog="scrape-twitter read", description="Print the collected tweets matching some filters, one JSON object per line")
+    parser.add_argument("source", nargs='?', default='.', help="Output or storage directory to read shards from, or s3://<bucket>/<prefix>")
+    parser.add_argument("--pattern", type=str, default=DEFAULT_PATTERN, help="Filename pattern of the shards to read")
+    parser.add_argument("--partition-by", type=str, action='append', help="Partition fields the shards were written with, in order, so that only matching partitions are listed (repeatable)", dest='partition_by')
+    parser.add_argument("--min-id", type=int, help="Smallest tweet id to include", dest='min_id')
+    parser.add_argument("--max-id", type=int, help="Largest tweet id to include", dest='max_id')
+    parser.add_argument("--since", type=_parse_time, help="Include tweets created at or after this time (UTC)")
+    parser.add_argument("--until", type=_parse_time, help="Include tweets created before this time (UTC)")
+    parser.add_argument("--lang", type=str, action='append', help="Include tweets in this language (repeatable)", dest='languages')
+    parser.add_argument("--where", type=_parse_where, action='append', help="Include tweets whose FIELD (e.g. user.screen_name) equals VALUE (repeatable)")
+    parser.add_argument("-j", "--processes", type=int, help="Number of processes reading shards (default: one per CPU)")
+    parser.add_argument("-n", "--limit", type=int, help="Stop after this many tweets")
+    parser.add_argument("--count", action='store_true', help="Print only the number of matching tweets")
+    parser.add_argument("--join-users", action='store_true', help="Restore the user objects of tweets collected with --normalize-users", dest='join_users')
+    args = parser.parse_args(argv)
+
+    if args.source.startswith("s3://"):
+        bucket, _, prefix = args.source[len("s3://"):].partition("/")
+        storage = S3Storage(bucket, create_bucket=False)
+    else:
+        storage, prefix = LocalStorage(args.source), ""
+    record_filter = RecordFilter(min_id=args.min_id, max_id=args.max_id, since=args.since, until=args.until,
+                                 languages=args.languages, where=dict(args.where or []))
+    layout = PartitionLayout(args.partition_by) if args.partition_by else None
+    query = ShardQuery(storage, prefix=prefix, record_filter=record_filter, processes=args.processes, raw=True,
+                       pattern=args.pattern, layout=layout)
+    profiles = None
+    if args.join_users:
+        from .users import USERS_DIRECTORY, ProfileStore
+        profiles = ProfileStore.load(storage, prefix="/".join(p for p in [prefix.rstrip("/"), USERS_DIRECTORY] if p),
+                                     processes=args.processes)
+        _LOG.info("Loaded {:,} user profiles.".format(len(profiles)))
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    records = iter(query)
+    count = 0
+    try:
+        for line in records:
+            if args.limit is not None and count >= args.limit:
+                break
+            count += 1
+            if args.count:
+                continue
+            if profiles is not None:
+                line = json.dumps(profiles.rebuild(json.loads(line.decode('utf-8')))).encode('utf-8')
+            out.write(line + b"\n")
+    except KeyboardInterrupt:
+        return 1
+    finally:
+        records.close()
+        out.flush()
+    if args.count:
+        print(count)
+    _LOG.info("Read {:,} tweets from {:,} shards ({:,} skipped using their indexes).".format(
+        count, query.shards_read, query.shards_skipped))
+    return 1 if query.shards_failed else 0
+
+# Profile stores loaded by this process, by users directory
+_PROFILE_STORES = {}
+
+def _profiles_in(users_dir):
+    from .users import ProfileStore
+    from .storage import LocalStorage
+    if users_dir not in _PROFILE_STORES:
+        _PROFILE_STORES[users_dir] = ProfileStore.load(LocalStorage(users_dir), prefix="")
+    return _PROFILE_STORES[users_dir]
+
+def _users_dir(filename, root):
+    # The users directory of the run which wrote `filename`, looking upwards
+    # as far as `root` (through worker and partition directories)
+    from .users import USERS_DIRECTORY
+    directory = os.path.dirname(os.path.abspath(filename))
+    root = os.path.abspath(root)
+    while True:
+        if os.path.isdir(os.path.join(directory, USERS_DIRECTORY)):
+            return os.path.join(directory, USERS_DIRECTORY)
+        if directory == root or os.path.dirname(directory) == directory:
+            return None
+        directory = os.path.dirname(directory)
+
+def _convert_one(args):
+    import tempfile
+    from .columnar import convert_shard
+    from .file_utils import columnar_filename, move_sidecars, sidecars_for
+    filename, keep_json, users_dir = args
+    dest = columnar_filename(filename)
+    if users_dir is None:
+        num_records = convert_shard(filename, dest=dest)
+    else:
+        fd, joined = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        try:
+            _profiles_in(users_dir).rebuild_shard(filename, joined)
+            num_records = convert_shard(joined, dest=dest)
+        finally:
+            os.remove(joined)
+    if not keep_json:
+        # As ColumnarConverter does: the sidecars describing the records go
+        # with the Parquet file, and the rest (the index) with the shard
+        move_sidecars(filename, dest)
+        for path in [filename] + [s for s in sidecars_for(filename) if s != dest]:
+            os.remove(path)
+    return filename, num_records
+
+def convert(argv):
+    import multiprocessing
+    from .reader import DEFAULT_PATTERN, list_shards
+    from .storage import LocalStorage
+    parser = argparse.ArgumentParser(prog="scrape-twitter convert", description="Convert JSON shards to Parquet files alongside them")
+    parser.add_argument("paths", nargs='+', help="Shards, or directories to convert every shard under")
+    parser.add_argument("--pattern", type=str, default=DEFAULT_PATTERN, help="Filename pattern of the shards to convert in directories")
+    parser.add_argument("--drop-json", action='store_false', help="Delete each JSON shard (and its index) once it's converted", dest='keep_json')
+    parser.add_argument("-j", "--processes", type=int, default=1, help="Number of shards to convert at once")
+    parser.add_argument("--join-users", action='store_true', help="Restore the user objects of tweets collected with --normalize-users before converting", dest='join_users')
+    args = parser.parse_args(argv)
+
+    tasks = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            filenames = [os.path.join(path, key) for key in list_shards(LocalStorage(path), pattern=args.pattern)]
+        else:
+            filenames = [path]
+        for filename in filenames:
+            users_dir = None
+            if args.join_users:
+                users_dir = _users_dir(filename, path if os.path.isdir(path) else os.path.dirname(path))
+                if users_dir is None:
+                    _LOG.warning("No users directory for {}; converting it as it is.".format(filename))
+            tasks.append((filename, args.keep_json, users_dir))
+    filenames = [task[0] for task in tasks]
+    pool = multiprocessing.Pool(args.processes) if args.processes > 1 else None
+    try:
+        results = pool.imap_unordered(_convert_one, tasks) if pool is not None else map(_convert_one, tasks)
+        total = 0
+        for filename, num_records in results:
+            _LOG.info("Converted {} ({:,} records)".format(filename, num_records))
+            total += num_records
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    _LOG.info("Converted {:,} records in {:,} shards.".format(total, len(filenames)))
+    return 0
+
+def compact(argv):
+    from .compaction import SORT_ORDERS, CompactionError, ShardCompactor, format_report
+    from .compression import get_codec
+    from .reader import DEFAULT_PATTERN
+    from .storage import LocalStorage, S3Storage
+    parser = argparse.ArgumentParser(prog="scrape-twitter compact", description="Rewrite shards into fewer, evenly sized ones, sorted and with every tweet only once")
+    parser.add_argument("source", help="Output or storage directory to compact shards from, or s3://<bucket>/<prefix>")
+    parser.add_argument("-o", "--output-dir", type=str, required=True, help="Directory to write the compacted shards to", dest='output_dir')
+    parser.add_argument("--pattern", type=str, default=DEFAULT_PATTERN, help="Filename pattern of the shards to compact")
+    parser.add_argument("--sort", choices=SORT_ORDERS, default=SORT_ORDERS[0], help="Order to write tweets in: by id, or by when they were created")
+    parser.add_argument("--codec", choices=sorted(scraper.CODECS), default='none', help="Compression used for the compacted shards")
+    parser.add_argument("--compression-level", type=int, help="Compression level for the codec", dest='compression_level')
+    parser.add_argument("--shard-max", type=int, help="Maximum number of tweets per shard", dest='shard_max')
+    parser.add_argument("--shard-max-bytes", type=int, help="Maximum uncompressed bytes per shard", dest='shard_max_bytes')
+    parser.add_argument("--shard-max-compressed-bytes", type=int, help="Maximum bytes on disk per shard (default: 128MB, unless another limit is given)", dest='shard_max_compressed_bytes')
+    parser.add_argument("--memory", type=int, default=256 << 20, help="Bytes of records to sort in memory before spilling to disk, across all processes")
+    parser.add_argument("--temp-dir", type=str, help="Where to spill sorted runs (default: inside the output directory)", dest='temp_dir')
+    parser.add_argument("-j", "--processes", type=int, help="Number of processes sorting and merging (default: one per CPU)")
+    parser.add_argument("--delete-source", action='store_true', help="Delete the source shards once the compacted ones are written (local sources only)", dest='delete_source')
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    if args.source.startswith("s3://"):
+        if args.delete_source:
+            parser.error("--delete-source only works on local directories")
+        bucket, _, prefix = args.source[len("s3://"):].partition("/")
+        storage = S3Storage(bucket, create_bucket=False)
+    else:
+        storage, prefix = LocalStorage(args.source), ""
+    max_compressed_bytes = args.shard_max_compressed_bytes
+    if max_compressed_bytes is None and args.shard_max is None and args.shard_max_bytes is None:
+        max_compressed_bytes = 128 << 20
+    compactor = ShardCompactor(storage, args.output_dir, prefix=prefix, pattern=args.pattern, order=args.sort,
+                               codec=get_codec(args.codec, level=args.compression_level),
+                               max_records=args.shard_max, max_bytes=args.shard_max_bytes,
+                               max_compressed_bytes=max_compressed_bytes, memory_bytes=args.memory,
+                               processes=args.processes, temp_dir=args.temp_dir, delete_source=args.delete_source)
+    try:
+        report = compactor.run()
+    except CompactionError as e:
+        _LOG.error(str(e))
+        return 1
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report))
+    return 0
+
+def _read_gaps(path):
+    ranges = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                gap = json.loads(line)
+                ranges.append((gap['start'], gap['end']))
+    return ranges
+
+def backfill(argv):
+    from .manifest import ManifestLocked
+    parser = argparse.ArgumentParser(prog="scrape-twitter backfill", description="Fetch tweets missed by the stream from the REST API")
+    parser.add_argument("--follow", action='append', help="User to fetch (overwrites config)")
+    parser.add_argument("--track", action='append', help="Query to search for (overwrites config)")
+    parser.add_argument("-c", "--config", type=str, help="JSON configuration")
+    parser.add_argument("-o", "--output-dir", type=str, required=True, help="Output directory, separate from the stream's", dest='output_dir')
+    parser.add_argument("--since", type=_parse_time, help="Start of the range to fetch (epoch seconds or UTC date/time)")
+    parser.add_argument("--until", type=_parse_time, help="End of the range to fetch (default: now)")
+    parser.add_argument("--gaps", type=str, help="Fetch each gap recorded in this gaps log", dest='gaps_log')
+    parser.add_argument("-j", "--workers", type=int, default=4, help="Concurrent requests")
+    parser.add_argument("--api-url", type=str, help="REST API to use instead of Twitter's, e.g. a mock server", dest='api_url')
+    parser.add_argument('--dedup-snapshot', type=str, help="Dedup snapshot to skip the tweets in (only read; a running stream's holds the ids from when it last exited)", dest='dedup_snapshot')
+    args = parser.parse_args(argv)
+
+    ranges = []
+    if args.gaps_log is not None:
+        ranges.extend(_read_gaps(args.gaps_log))
+    if args.since is not None:
+        ranges.append((args.since, args.until))
+    if not ranges:
+        parser.error("--since or --gaps is required")
+    if args.config is None:
+        builder = scraper.ScraperBuilder()
+    else:
+        builder = scraper.ScraperBuilder.load_config(args.config)
+    builder = builder.ignore_none()\
+              .follow(args.follow)\
+              .track(args.track)\
+              .output_dir(args.output_dir)\
+              .api_url(args.api_url)\
+              .dedup_snapshot(args.dedup_snapshot)\
+              .emailer(email.DummyEmailer())
+    try:
+        with builder.backfill(ranges, workers=args.workers) as num_fetched:
+            _LOG.info("Fetched {:,} statuses over {} range(s).".format(num_fetched, len(ranges)))
+    except ManifestLocked as e:
+        _LOG.error("{} Backfill into a separate directory.".format(e))
+        return 1
+    return 0
+
+_SUBCOMMANDS = {
+    'replay': replay,
+    'benchmark': benchmark,
+    'smtp-sink': smtp_sink,
+    'read': read,
+    'convert': convert,
+    'backfill': backfill,
+    'compact': compact,
+}
@@ -0,0 +1,193 @@
+import os
+import six
+import threading
+import time
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.json
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from . import manifest
+from .compression import codec_for_filename
+from .file_utils import ShardListener, columnar_filename, is_columnar, move_sidecars, sidecars_for
+from .log import get_logger
+from .metrics import MetricsRegistry
+from .shard_index import created_at_ms
+
+_LOG = get_logger('columnar')
+
+_STOP = object()
+
+
+def _require_pyarrow():
+    if pyarrow is None:
+        raise ValueError("Columnar output requires the 'pyarrow' package")
+
+
+def _json_schema():
+    # Just the fields which are kept; everything else is skipped by the parser
+    return pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('text', pyarrow.string()),
+        ('lang', pyarrow.string()),
+        ('in_reply_to_status_id', pyarrow.int64()),
+        ('user', pyarrow.struct([('id', pyarrow.int64()), ('screen_name', pyarrow.string())])),
+        ('entities', pyarrow.struct([('hashtags', pyarrow.list_(pyarrow.struct([('text', pyarrow.string())])))])),
+        ('extended_tweet', pyarrow.struct([('full_text', pyarrow.string())])),
+    ])
+
+
+def schema():
+    """
+    The flattened schema of columnar shards. `created_at` comes from the
+    tweet id, so it's exact to the millisecond; `text` is the full text of
+    extended tweets.
+    """
+    _require_pyarrow()
+    return pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('created_at', pyarrow.timestamp('ms', tz='UTC')),
+        ('user_id', pyarrow.int64()),
+        ('user_screen_name', pyarrow.string()),
+        ('lang', pyarrow.string()),
+        ('text', pyarrow.string()),
+        ('in_reply_to_status_id', pyarrow.int64()),
+        ('hashtags', pyarrow.list_(pyarrow.string())),
+    ])
+
+
+def _flatten(batch):
+    compute = pyarrow.compute
+    ids = batch.column('id')
+    created_at = compute.add(compute.shift_right(ids, 22), created_at_ms(0))
+    user = batch.column('user')
+    text = compute.coalesce(compute.struct_field(batch.column('extended_tweet'), 'full_text'), batch.column('text'))
+    hashtags = compute.struct_field(batch.column('entities'), 'hashtags')
+    # Null entities leave empty offsets, so they come out as empty lists
+    hashtags = pyarrow.ListArray.from_arrays(hashtags.offsets, compute.struct_field(hashtags.values, 'text'))
+    return pyarrow.RecordBatch.from_arrays([
+        ids,
+        created_at.cast(pyarrow.timestamp('ms', tz='UTC')),
+        compute.struct_field(user, 'id'),
+        compute.struct_field(user, 'screen_name'),
+        batch.column('lang'),
+        text,
+        batch.column('in_reply_to_status_id'),
+        hashtags,
+    ], schema=schema())
+
+
+def convert_shard(filename, dest=None, block_bytes=16 << 20, compression='zstd'):
+    """
+    Converts a JSON shard into a Parquet file (by default `columnar_filename`
+    of it) with the flattened `schema()`. The shard is decompressed and
+    parsed `block_bytes` at a time by Arrow's JSON reader, and each block is
+    flattened with vectorized kernels. Returns the number of records.
+    """
+    _require_pyarrow()
+    dest = dest or columnar_filename(filename)
+    tmp_dest = "{}.tmp".format(dest)
+    read_options = pyarrow.json.ReadOptions(block_size=block_bytes)
+    parse_options = pyarrow.json.ParseOptions(explicit_schema=_json_schema(), unexpected_field_behavior='ignore')
+    num_records = 0
+    with open(filename, "rb") as raw:
+        stream = codec_for_filename(filename).open_reader(raw)
+        with pyarrow.parquet.ParquetWriter(tmp_dest, schema(), compression=compression) as writer:
+            # Arrow refuses empty input, but an empty shard still gets an (empty) file
+            if stream.peek(1):
+                reader = pyarrow.json.open_json(stream, read_options=read_options, parse_options=parse_options)
+                for batch in reader:
+                    writer.write_batch(_flatten(batch))
+                    num_records += batch.num_rows
+    os.rename(tmp_dest, dest)
+    return num_records
+
+
+class ColumnarConverter(ShardListener):
+    """
+    Converts each sealed shard into a Parquet file (see `convert_shard`) on
+    `workers` background threads, then hands the shard on to `downstream`
+    (such as a ShardUploader).
+
+    With `keep_json` the Parquet file travels alongside the JSON shard as a
+    sidecar. Otherwise it replaces it: the JSON shard and its index are
+    deleted, the manifest marks the shard as converted, and the Parquet file
+    is handed on in its place. Shards which fail to convert are handed on as
+    they are.
+    """
+    def __init__(self, downstream=None, keep_json=True, workers=1, block_bytes=16 << 20, manifest=None, metrics=None):
+        _require_pyarrow()
+        assert workers > 0, "workers must be greater than zero"
+        metrics = metrics or MetricsRegistry()
+        self._conversion_seconds = metrics.histogram('shard_conversion_seconds', "Time taken to convert a shard to Parquet")
+        self._conversions = metrics.counter('shard_conversions_total', "Shard conversions by outcome", labels=('result',))
+        self._downstream = downstream
+        self._keep_json = keep_json
+        self._block_bytes = block_bytes
+        self._manifest = manifest
+        self._queue = six.moves.queue.Queue()
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(name='converter_{}'.format(i), target=self._run)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _hand_on(self, filename):
+        if self._downstream is not None:
+            self._downstream.handle_shard(filename)
+
+    def convert(self, filename):
+        if is_columnar(filename):
+            # Converted before a restart, but never uploaded
+            self._hand_on(filename)
+            return
+        start = time.time()
+        try:
+            num_records = convert_shard(filename, block_bytes=self._block_bytes)
+        except Exception:
+            _LOG.exception("Failed to convert {}; keeping it as JSON.".format(filename))
+            self._conversions.labels('failed').inc()
+            self._hand_on(filename)
+            return
+        dest = columnar_filename(filename)
+        _LOG.info("Converted {} to {} ({:,} records).".format(filename, dest, num_records))
+        self._conversions.labels('converted').inc()
+        self._conversion_seconds.observe(time.time() - start)
+        if self._keep_json:
+            self._hand_on(filename)
+            return
+        if self._manifest is not None:
+            entry = self._manifest.get(filename) or {}
+            self._manifest.record(dest, manifest.SEALED, n=entry.get('n') or 0, records=num_records)
+            self._manifest.record(filename, manifest.CONVERTED)
+        move_sidecars(filename, dest)
+        for path in [filename] + [s for s in sidecars_for(filename) if s != dest]:
+            os.remove(path)
+        self._hand_on(dest)
+
+    def _run(self):
+        while True:
+            filename = self._queue.get()
+            if filename is _STOP:
+                return
+            try:
+                self.convert(filename)
+            except Exception:
+                _LOG.exception("Converter failed on {}".format(filename))
+
+    def handle_shard(self, filename):
+        self._queue.put(filename)
+
+    def close(self):
+        for _ in self._workers:
+            self._queue.put(_STOP)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        if self._downstream is not None:
+            self._downstream.close()
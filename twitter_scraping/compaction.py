@@ -0,0 +1,441 @@
+import bisect
+import calendar
+import heapq
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from six.moves import queue
+
+from .compression import codec_for_filename
+from .file_utils import SIDECAR_EXTENSIONS, ShardedFileWriter, ShardListener
+from .log import get_logger
+from .reader import DEFAULT_PATTERN, list_shards, read_lines
+from .shard_index import created_at_ms, index_filename, record_id
+from .storage import LocalStorage
+
+_LOG = get_logger('compaction')
+
+SORT_ID = 'id'
+SORT_TIME = 'time'
+SORT_ORDERS = (SORT_ID, SORT_TIME)
+
+OUTPUT_TEMPLATE = "tweets-shard-{n}.json"
+
+_CHUNK_SIZE = 1 << 20
+# Keys are fixed-width digits, so that sorting records by their bytes sorts
+# them by key: the id, or when the tweet was created (ms) then the id. Each
+# is followed by a rank, which puts complete copies of a record ahead of
+# ones cut short by a crash.
+_ID_WIDTH = 20
+_KEY_WIDTHS = {SORT_ID: _ID_WIDTH, SORT_TIME: 15 + _ID_WIDTH}
+_NO_ID = b"0" * _ID_WIDTH
+_COMPLETE = b"0"
+_INCOMPLETE = b"1"
+# Ids from before snowflakes (November 2010) were sequential, and far smaller
+_FIRST_SNOWFLAKE = 1 << 40
+_CREATED_AT_FORMAT = "%a %b %d %H:%M:%S +0000 %Y"
+# Every run notes the key and offset of a record about this often, to find
+# where a range of keys starts and as a sample of how the keys are spread
+_MARK_BYTES = 1 << 20
+# Beyond this many runs, they're merged in rounds
+_MAX_FAN_IN = 128
+
+_RUN = 'run'
+_SHARD_DONE = 'shard_done'
+_ERROR = 'error'
+_EXIT = 'exit'
+
+
+class CompactionError(Exception):
+    pass
+
+
+def _created_ms(line, tweet_id):
+    if tweet_id >= _FIRST_SNOWFLAKE:
+        return created_at_ms(tweet_id)
+    try:
+        return calendar.timegm(time.strptime(json.loads(line.decode('utf-8'))['created_at'], _CREATED_AT_FORMAT)) * 1000
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+
+def sort_key(line, order=SORT_ID):
+    """
+    The key which orders a raw record under `order`, as bytes which compare
+    the same way. Records without an id get an id of zero.
+    """
+    tweet_id = record_id(line) or 0
+    if order == SORT_ID:
+        return b"%020d" % tweet_id
+    return b"%015d%020d" % (_created_ms(line, tweet_id), tweet_id)
+
+
+def _rank(line):
+    try:
+        json.loads(line.decode('utf-8'))
+    except ValueError:
+        return _INCOMPLETE
+    return _COMPLETE
+
+
+def _entry(line, order):
+    return b"".join([sort_key(line, order), _rank(line), b" ", line, b"\n"])
+
+
+def _record(entry, width):
+    return entry[width + 2:]
+
+
+class _Dedup(object):
+    # Drops all but the first of each run of copies of a tweet from sorted
+    # entries. Copies share a key, so they're next to each other, complete
+    # ones first; records without an id only count as copies if they're
+    # identical.
+    def __init__(self, width):
+        self.width = width
+        self.num_dropped = 0
+
+    def __call__(self, entries):
+        width = self.width
+        previous = None
+        for entry in entries:
+            if previous is not None and entry[:width] == previous[:width] \
+                    and (entry[width - _ID_WIDTH:width] != _NO_ID or entry == previous):
+                self.num_dropped += 1
+                continue
+            previous = entry
+            yield entry
+
+
+class _Run(object):
+    # A sorted file of "<key><rank> <record>\n" entries, without duplicates
+    def __init__(self, path, marks, num_records):
+        self.path = path
+        self.marks = marks
+        self.num_records = num_records
+
+    def entries(self, width, lo=None, hi=None):
+        """
+        The entries with keys in [lo, hi).
+        """
+        offset = 0
+        if lo is not None:
+            i = bisect.bisect_left([key for key, _ in self.marks], lo)
+            if i > 0:
+                offset = self.marks[i - 1][1]
+        with open(self.path, "rb", _CHUNK_SIZE) as f:
+            f.seek(offset)
+            for entry in f:
+                key = entry[:width]
+                if lo is not None and key < lo:
+                    continue
+                if hi is not None and key >= hi:
+                    break
+                yield entry
+
+
+def _write_run(path, entries, dedup):
+    marks = []
+    offset = 0
+    next_mark = 0
+    num_records = 0
+    width = dedup.width
+    with open(path, "wb", _CHUNK_SIZE) as f:
+        for entry in dedup(entries):
+            if offset >= next_mark:
+                marks.append((entry[:width], offset))
+                next_mark = offset + _MARK_BYTES
+            f.write(entry)
+            offset += len(entry)
+            num_records += 1
+    return _Run(path, marks, num_records)
+
+
+class _CountingStream(object):
+    def __init__(self, stream):
+        self._stream = stream
+        self.num_bytes = 0
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self.num_bytes += len(data)
+        return data
+
+    def close(self):
+        self._stream.close()
+
+
+def _sort_worker(storage, tasks, results, run_dir, worker, order, run_bytes):
+    # Reads shards until told to stop, spilling sorted runs of about
+    # `run_bytes` as it goes
+    width = _KEY_WIDTHS[order]
+    dedup = _Dedup(width)
+    entries = []
+    size = 0
+    num_runs = 0
+
+    def spill():
+        path = os.path.join(run_dir, "run-{}-{}".format(worker, num_runs))
+        entries.sort()
+        run = _write_run(path, entries, dedup)
+        del entries[:]
+        results.put((_RUN, run))
+
+    while True:
+        key = tasks.get()
+        if key is None:
+            break
+        try:
+            stream = _CountingStream(storage.open(key))
+            num_records = 0
+            try:
+                for line in read_lines(codec_for_filename(key).open_reader(stream)):
+                    entry = _entry(line, order)
+                    entries.append(entry)
+                    size += len(entry)
+                    num_records += 1
+                    if size >= run_bytes:
+                        spill()
+                        num_runs += 1
+                        size = 0
+            finally:
+                stream.close()
+            results.put((_SHARD_DONE, (key, num_records, stream.num_bytes)))
+        except Exception as e:
+            results.put((_ERROR, (key, repr(e))))
+    if entries:
+        spill()
+    results.put((_EXIT, dedup.num_dropped))
+
+
+def _merge_runs(args):
+    runs, path, width = args
+    dedup = _Dedup(width)
+    merged = _write_run(path, heapq.merge(*[run.entries(width) for run in runs]), dedup)
+    for run in runs:
+        os.remove(run.path)
+    return merged, dedup.num_dropped
+
+
+class _SealedShards(ShardListener):
+    def __init__(self):
+        self.filenames = []
+
+    def handle_shard(self, filename):
+        self.filenames.append(filename)
+
+
+def _merge_range(args):
+    # Writes the records of every run with keys in [lo, hi) into shards
+    runs, lo, hi, stage_dir, part, width, writer_options = args
+    dedup = _Dedup(width)
+    sealed = _SealedShards()
+    writer = ShardedFileWriter(stage_dir, "part-{:05d}-{{n}}.json".format(part), index=True, **writer_options)
+    writer.wrap_listener(lambda downstream: sealed)
+    writer.next_shard()
+    batch = []
+    batch_bytes = 0
+    num_records = 0
+    for entry in dedup(heapq.merge(*[run.entries(width, lo, hi) for run in runs])):
+        batch.append(_record(entry, width))
+        batch_bytes += len(entry)
+        num_records += 1
+        if batch_bytes >= _CHUNK_SIZE:
+            writer.write(b"".join(batch))
+            batch = []
+            batch_bytes = 0
+    if batch:
+        writer.write(b"".join(batch))
+    # Rotation leaves an empty shard behind when the last one fills exactly
+    empty = writer.current_filename if writer.num_records == 0 else None
+    writer.close()
+    filenames = []
+    for filename in sealed.filenames:
+        if filename == empty:
+            os.remove(filename)
+            os.remove(index_filename(filename))
+        else:
+            filenames.append(filename)
+    return filenames, num_records, dedup.num_dropped
+
+
+def _splitters(runs, n):
+    # Keys which split the runs into `n` ranges of about as many bytes
+    keys = sorted(key for run in runs for key, _ in run.marks)
+    if not keys:
+        return []
+    return sorted(set(keys[len(keys) * i // n] for i in range(1, n)))
+
+
+class ShardCompactor(object):
+    """
+    Rewrites the shards under `prefix` in `storage` into `output_dir` with
+    every tweet exactly once, ordered by id or by when it was created
+    (`order`), in shards of `max_records` records, `max_bytes` uncompressed
+    bytes or `max_compressed_bytes` bytes on disk, compressed with `codec`.
+
+    Duplicates are found with an external merge sort, so memory stays at
+    around `memory_bytes` whatever the size of the input: `processes` workers
+    read shards, spilling sorted runs to `temp_dir` (by default inside
+    `output_dir`, which needs room for about the uncompressed size of the
+    input); the runs are then split into one range of keys per worker, and
+    each range merged into its own shards. The last shard of each range may
+    be undersized. Of several copies of a tweet, one is kept, the same one
+    whatever order the shards are listed in, and never one cut short by a
+    crash if there's a complete one.
+
+    With `delete_source` (local storage only), the input shards and their
+    sidecars are deleted once the output is complete.
+    """
+    def __init__(self, storage, output_dir, prefix="", pattern=DEFAULT_PATTERN, order=SORT_ID, codec=None,
+                 max_records=None, max_bytes=None, max_compressed_bytes=128 << 20, memory_bytes=256 << 20,
+                 processes=None, temp_dir=None, delete_source=False):
+        assert order in SORT_ORDERS, "order must be one of: {}".format(", ".join(SORT_ORDERS))
+        assert memory_bytes > 0, "memory_bytes must be greater than zero"
+        assert processes is None or processes > 0, "processes must be greater than zero"
+        assert not delete_source or hasattr(storage, 'path'), "delete_source needs local storage"
+        self._storage = storage
+        self._output_dir = output_dir
+        self._prefix = prefix
+        self._pattern = pattern
+        self._order = order
+        self._width = _KEY_WIDTHS[order]
+        self._writer_options = dict(codec=codec, max_records=max_records, max_bytes=max_bytes,
+                                    max_compressed_bytes=max_compressed_bytes)
+        self._processes = processes or multiprocessing.cpu_count()
+        self._run_bytes = max(1, memory_bytes // self._processes)
+        self._temp_dir = temp_dir
+        self._delete_source = delete_source
+
+    def _sort(self, keys, run_dir, report):
+        # Returns the runs spilled from every shard in `keys`
+        num_workers = min(self._processes, len(keys))
+        args = (run_dir, 0, self._order, self._run_bytes)
+        if num_workers <= 1:
+            tasks, results = queue.Queue(), queue.Queue()
+            for key in keys + [None]:
+                tasks.put(key)
+            _sort_worker(self._storage, tasks, results, *args)
+            workers = []
+        else:
+            tasks, results = multiprocessing.Queue(), multiprocessing.Queue()
+            for key in keys:
+                tasks.put(key)
+            workers = []
+            for i in range(num_workers):
+                tasks.put(None)
+                worker = multiprocessing.Process(name='shard_sorter_{}'.format(i), target=_sort_worker,
+                                                 args=(self._storage, tasks, results, run_dir, i) + args[2:])
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+        runs = []
+        failed = []
+        running = max(1, len(workers))
+        try:
+            while running:
+                try:
+                    kind, payload = results.get(timeout=1.0)
+                except queue.Empty:
+                    if not any(worker.is_alive() for worker in workers):
+                        raise CompactionError("Shard sorters exited unexpectedly.")
+                    continue
+                if kind == _RUN:
+                    runs.append(payload)
+                elif kind == _SHARD_DONE:
+                    report['shards_read'] += 1
+                    report['records_read'] += payload[1]
+                    report['bytes_read'] += payload[2]
+                elif kind == _ERROR:
+                    failed.append(payload[0])
+                    _LOG.error("Failed to read {}: {}".format(self._storage.describe(payload[0]), payload[1]))
+                else:
+                    report['duplicates_dropped'] += payload
+                    running -= 1
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+        if failed:
+            raise CompactionError("Failed to read {:,} shards; the output would be missing their tweets.".format(len(failed)))
+        return runs
+
+    def _map(self, pool, fn, tasks):
+        return pool.map(fn, tasks) if pool is not None else [fn(task) for task in tasks]
+
+    def run(self):
+        """
+        Compacts the shards, and returns a report of what was read, written
+        and reclaimed.
+        """
+        start = time.time()
+        if not os.path.exists(self._output_dir):
+            os.makedirs(self._output_dir)
+        if list_shards(LocalStorage(self._output_dir)):
+            raise CompactionError("{} already holds shards.".format(self._output_dir))
+        keys = list_shards(self._storage, self._prefix, self._pattern)
+        report = dict.fromkeys(['shards_read', 'records_read', 'bytes_read', 'duplicates_dropped', 'runs',
+                                'shards_written', 'records_written', 'bytes_written'], 0)
+        work_dir = tempfile.mkdtemp(prefix="compaction-", dir=self._temp_dir or self._output_dir)
+        pool = None
+        try:
+            _LOG.info("Sorting {:,} shards with {} processes.".format(len(keys), self._processes))
+            runs = self._sort(keys, work_dir, report)
+            report['runs'] = len(runs)
+            if self._processes > 1:
+                pool = multiprocessing.Pool(self._processes)
+            merges = 0
+            while len(runs) > _MAX_FAN_IN:
+                _LOG.info("Merging {:,} runs in groups of {}.".format(len(runs), _MAX_FAN_IN))
+                tasks = []
+                for i in range(0, len(runs), _MAX_FAN_IN):
+                    tasks.append((runs[i:i + _MAX_FAN_IN], os.path.join(work_dir, "merged-{}".format(merges)), self._width))
+                    merges += 1
+                runs = []
+                for run, num_dropped in self._map(pool, _merge_runs, tasks):
+                    runs.append(run)
+                    report['duplicates_dropped'] += num_dropped
+            bounds = [None] + _splitters(runs, self._processes) + [None]
+            tasks = [(runs, lo, hi, work_dir, part, self._width, self._writer_options)
+                     for part, (lo, hi) in enumerate(zip(bounds, bounds[1:]))]
+            _LOG.info("Merging {:,} runs into {} ranges of {}.".format(len(runs), len(tasks), self._order))
+            parts = self._map(pool, _merge_range, tasks)
+            for filenames, num_records, num_dropped in parts:
+                report['records_written'] += num_records
+                report['duplicates_dropped'] += num_dropped
+                for filename in filenames:
+                    report['shards_written'] += 1
+                    dest = os.path.join(self._output_dir, OUTPUT_TEMPLATE.format(n=report['shards_written'])
+                                        + codec_for_filename(filename).extension)
+                    os.rename(filename, dest)
+                    os.rename(index_filename(filename), index_filename(dest))
+                    report['bytes_written'] += os.path.getsize(dest)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            shutil.rmtree(work_dir, ignore_errors=True)
+        if self._delete_source:
+            for key in keys:
+                path = self._storage.path(key)
+                for filename in [path] + [path + ext for ext in SIDECAR_EXTENSIONS]:
+                    if os.path.exists(filename):
+                        os.remove(filename)
+            _LOG.info("Deleted {:,} source shards.".format(len(keys)))
+        report['bytes_reclaimed'] = report['bytes_read'] - report['bytes_written']
+        report['seconds'] = time.time() - start
+        _LOG.info(format_report(report))
+        return report
+
+
+def format_report(report):
+    return "Compacted {:,} records in {:,} shards ({:,}B) into {:,} records in {:,} shards ({:,}B), " \
+           "dropping {:,} duplicates and reclaiming {:,}B in {:.1f}s.".format(
+               report['records_read'], report['shards_read'], report['bytes_read'], report['records_written'],
+               report['shards_written'], report['bytes_written'], report['duplicates_dropped'],
+               report['bytes_reclaimed'], report['seconds'])
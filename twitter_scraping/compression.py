@@ -0,0 +1,84 @@
+import gzip
+import io
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Codec(object):
+    """
+    Streams shard data through a compressor. `extension` is appended to shard
+    filenames so that readers can pick the matching codec. Closing a writer
+    must leave `fileobj` open, and its output must be valid when concatenated
+    with the output of another writer (gzip members, zstd frames).
+    """
+    name = 'none'
+    extension = ''
+    default_level = None
+
+    def __init__(self, level=None):
+        self.level = level
+
+    @property
+    def effective_level(self):
+        """
+        The level the codec compresses at: `level`, or the default if None.
+        """
+        return self.level if self.level is not None else self.default_level
+
+    def open_writer(self, fileobj):
+        return fileobj
+
+    def open_reader(self, fileobj):
+        return fileobj
+
+
+class GzipCodec(Codec):
+    name = 'gzip'
+    extension = '.gz'
+    default_level = 6
+
+    def open_writer(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=self.effective_level)
+
+    def open_reader(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    extension = '.zst'
+    default_level = 3
+
+    def __init__(self, level=None):
+        if zstandard is None:
+            raise ValueError("zstd compression requires the 'zstandard' package")
+        super(ZstdCodec, self).__init__(level=level)
+
+    def open_writer(self, fileobj):
+        compressor = zstandard.ZstdCompressor(level=self.effective_level)
+        return compressor.stream_writer(fileobj, closefd=False)
+
+    def open_reader(self, fileobj):
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=False, read_across_frames=True))
+
+
+CODECS = dict((cls.name, cls) for cls in [Codec, GzipCodec, ZstdCodec])
+
+
+def get_codec(name='none', level=None):
+    if name not in CODECS:
+        raise ValueError("codec must be one of: {}".format(", ".join(sorted(CODECS))))
+    return CODECS[name](level=level)
+
+
+def codec_for_filename(filename):
+    """
+    Returns the codec which wrote the given shard.
+    """
+    for cls in [GzipCodec, ZstdCodec]:
+        if filename.endswith(cls.extension):
+            return cls()
+    return Codec()
@@ -0,0 +1,521 @@
+import abc
+import array
+import bisect
+import ctypes
+import heapq
+import math
+import mmap
+import multiprocessing
+import os
+import six
+import struct
+import sys
+import tempfile
+import time
+
+from cachetools import LRUCache
+
+from .log import get_logger
+
+_LOG = get_logger('dedup')
+
+_MAGIC = b'TSDD'
+_VERSION = 1
+# magic, version, kind, number of entries in the table which follows
+_HEADER = struct.Struct('=4sHHQ')
+# Windowed ID sets: segment creation time, number of ids
+_SEGMENT = struct.Struct('=dQ')
+# Bloom filters: number of bits, number of hashes, number of items, capacity
+_FILTER = struct.Struct('=QQQQ')
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix64(x):
+    # splitmix64 finalizer; spreads sequential tweet ids over the whole range
+    x = (x + 0x9e3779b97f4a7c15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _MASK64
+    return x ^ (x >> 31)
+
+
+def _read_header(buf, kind):
+    magic, version, file_kind, count = _HEADER.unpack_from(buf, 0)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError("Not a dedup snapshot")
+    if file_kind != kind:
+        raise ValueError("Snapshot was written by a different kind of dedup index")
+    return count
+
+
+def _write_atomic(path, chunks):
+    # A temporary file of its own, so that concurrent saves can't mix
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+@six.add_metaclass(abc.ABCMeta)
+class DedupIndex(object):
+    """
+    Remembers which tweet ids have been written. Implementations trade off
+    memory, how long ids are remembered, and exactness.
+    """
+    kind = None
+
+    def __init__(self):
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    @abc.abstractproperty
+    def memory_bytes(self):
+        """
+        Approximate number of bytes used to store the index.
+        """
+        pass
+
+    @abc.abstractmethod
+    def _check_and_add(self, id_str):
+        pass
+
+    def check_and_add(self, id_str):
+        """
+        Records `id_str` as seen. Returns True if it had already been seen.
+        """
+        if self._check_and_add(id_str):
+            self._hits += 1
+            return True
+        self._misses += 1
+        return False
+
+    def __contains__(self, id_str):
+        return self._contains(id_str)
+
+    @abc.abstractmethod
+    def _contains(self, id_str):
+        pass
+
+    @abc.abstractmethod
+    def save(self, path):
+        pass
+
+    @classmethod
+    def load(cls, path, **options):
+        raise NotImplementedError("{} does not support snapshots".format(cls.__name__))
+
+    def stats(self):
+        return {
+            'kind': self.kind,
+            'size': len(self),
+            'hits': self._hits,
+            'misses': self._misses,
+            'memory_bytes': self.memory_bytes,
+        }
+
+    def close(self):
+        pass
+
+
+class LRUDedup(DedupIndex):
+    """
+    Remembers the most recently seen `maxsize` ids.
+    """
+    kind = 'lru'
+    _KIND_CODE = 1
+
+    def __init__(self, maxsize=1000):
+        super(LRUDedup, self).__init__()
+        self._cache = LRUCache(maxsize=maxsize)
+
+    def __len__(self):
+        return len(self._cache)
+
+    @property
+    def memory_bytes(self):
+        # Dictionary slot + key string + linked list entry, roughly
+        return len(self._cache) * 200
+
+    def _contains(self, id_str):
+        return id_str in self._cache
+
+    def _check_and_add(self, id_str):
+        if id_str in self._cache:
+            return True
+        self._cache[id_str] = True
+        return False
+
+    def save(self, path):
+        ids = array.array('q', (int(k) for k in self._cache))
+        _write_atomic(path, [_HEADER.pack(_MAGIC, _VERSION, self._KIND_CODE, len(ids)),
+                             ids.tostring() if six.PY2 else ids.tobytes()])
+
+    @classmethod
+    def load(cls, path, maxsize=1000):
+        with open(path, "rb") as f:
+            buf = f.read()
+        count = _read_header(buf, cls._KIND_CODE)
+        ids = array.array('q')
+        if six.PY2:
+            ids.fromstring(buf[_HEADER.size:_HEADER.size + count * ids.itemsize])
+        else:
+            ids.frombytes(buf[_HEADER.size:_HEADER.size + count * ids.itemsize])
+        ret = cls(maxsize=maxsize)
+        for i in ids:
+            ret._cache[str(i)] = True
+        return ret
+
+
+class WindowedIdSet(DedupIndex):
+    """
+    Exact set of ids seen in the last `window_seconds`.
+
+    New ids go into a small hash set which is periodically frozen into a sorted
+    array of int64s (8 bytes per id). Each frozen segment is dropped as a whole
+    once everything in it is older than the window, and the oldest segments are
+    merged together when there are more than `max_segments` of them.
+    """
+    kind = 'window'
+    _KIND_CODE = 2
+
+    def __init__(self, window_seconds=86400, segment_size=100000, segment_seconds=600, max_segments=32):
+        super(WindowedIdSet, self).__init__()
+        self._window_seconds = window_seconds
+        self._segment_size = segment_size
+        self._segment_seconds = segment_seconds
+        self._max_segments = max_segments
+        self._active = set()
+        self._active_start = time.time()
+        # (time the segment was frozen, sorted ids), oldest first
+        self._segments = []
+        # The mapped snapshot (see load) and the view the segments are cut from
+        self._snapshot = None
+        self._view = None
+
+    def __len__(self):
+        return len(self._active) + sum(len(ids) for _, ids in self._segments)
+
+    @property
+    def memory_bytes(self):
+        # Segments which are still backed by a snapshot live in the page cache
+        # rather than the heap, but count them anyway so the index can be sized.
+        active = sys.getsizeof(self._active) + len(self._active) * 32
+        return active + sum(len(ids) * 8 for _, ids in self._segments)
+
+    def _contains(self, id_str):
+        tweet_id = int(id_str)
+        if tweet_id in self._active:
+            return True
+        for _, ids in reversed(self._segments):
+            i = bisect.bisect_left(ids, tweet_id)
+            if i < len(ids) and ids[i] == tweet_id:
+                return True
+        return False
+
+    def _check_and_add(self, id_str):
+        if self._contains(id_str):
+            return True
+        self._active.add(int(id_str))
+        if len(self._active) >= self._segment_size \
+           or time.time() - self._active_start >= self._segment_seconds:
+            self._freeze()
+        return False
+
+    def _freeze(self):
+        now = time.time()
+        if self._active:
+            self._segments.append((now, array.array('q', sorted(self._active))))
+            self._active = set()
+        self._active_start = now
+        cutoff = now - self._window_seconds
+        self._segments = [(t, ids) for t, ids in self._segments if t >= cutoff]
+        while len(self._segments) > self._max_segments:
+            (_, older), (t, newer) = self._segments[0], self._segments[1]
+            merged = array.array('q', heapq.merge(older, newer))
+            # Keep the newer timestamp so that no id is evicted early
+            self._segments[0:2] = [(t, merged)]
+
+    def save(self, path):
+        self._freeze()
+        chunks = [_HEADER.pack(_MAGIC, _VERSION, self._KIND_CODE, len(self._segments))]
+        for t, ids in self._segments:
+            chunks.append(_SEGMENT.pack(t, len(ids)))
+        for _, ids in self._segments:
+            chunks.append(ids.tostring() if six.PY2 else bytes(memoryview(ids).cast('B')))
+        _write_atomic(path, chunks)
+
+    @classmethod
+    def load(cls, path, **options):
+        """
+        Memory-maps a snapshot. Segments are read straight out of the mapping,
+        so startup cost doesn't depend on the size of the snapshot (except on
+        Python 2, where memoryview can't be cast and they're copied).
+        """
+        ret = cls(**options)
+        with open(path, "rb") as f:
+            snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        count = _read_header(snapshot, cls._KIND_CODE)
+        offset = _HEADER.size + count * _SEGMENT.size
+        cutoff = time.time() - ret._window_seconds
+        view = None if six.PY2 else memoryview(snapshot)
+        for i in range(count):
+            t, n = _SEGMENT.unpack_from(snapshot, _HEADER.size + i * _SEGMENT.size)
+            if t >= cutoff:
+                if six.PY2:
+                    ids = array.array('q')
+                    ids.fromstring(snapshot[offset:offset + n * 8])
+                else:
+                    ids = view[offset:offset + n * 8].cast('q')
+                ret._segments.append((t, ids))
+            offset += n * 8
+        ret._snapshot = snapshot
+        ret._view = view
+        return ret
+
+    def close(self):
+        """
+        Unmaps the snapshot the index was loaded from, if any. Segments still
+        read from it are dropped, so the index can't be used afterwards.
+        """
+        if self._snapshot is not None:
+            # The mapping can't be closed while any view into it is still held
+            for _, ids in self._segments:
+                if isinstance(ids, memoryview):
+                    ids.release()
+            self._segments = []
+            if self._view is not None:
+                self._view.release()
+                self._view = None
+            self._snapshot.close()
+            self._snapshot = None
+        super(WindowedIdSet, self).close()
+
+
+class _BloomFilter(object):
+    def __init__(self, capacity, error_rate, bits=None, count=0):
+        self.capacity = capacity
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.num_hashes = max(1, int(round(self.num_bits / float(capacity) * math.log(2))))
+        self.bits = bits if bits is not None else bytearray((self.num_bits + 7) // 8)
+        self.count = count
+
+    def _positions(self, h):
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, h):
+        bits = self.bits
+        for pos in self._positions(h):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add(self, h):
+        bits = self.bits
+        for pos in self._positions(h):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+
+class ScalableBloomFilter(DedupIndex):
+    """
+    Probabilistic set with a bounded false-positive rate and no upper limit on
+    size (Almeida et al., 2007). Each time the newest filter fills up a larger
+    one is added with a tighter error rate, so that the compound rate stays
+    below `error_rate`. False positives mean a small fraction of new tweets
+    are dropped as duplicates; ids are never forgotten.
+    """
+    kind = 'bloom'
+    _KIND_CODE = 3
+    _GROWTH = 2
+    _TIGHTENING = 0.5
+
+    def __init__(self, initial_capacity=1000000, error_rate=0.0001):
+        super(ScalableBloomFilter, self).__init__()
+        assert 0 < error_rate < 1, "error_rate must be between 0 and 1"
+        self._initial_capacity = initial_capacity
+        self._error_rate = error_rate
+        self._filters = []
+
+    def __len__(self):
+        return sum(f.count for f in self._filters)
+
+    @property
+    def memory_bytes(self):
+        return sum(len(f.bits) for f in self._filters)
+
+    def _next_filter(self):
+        n = len(self._filters)
+        return _BloomFilter(self._initial_capacity * (self._GROWTH ** n),
+                            self._error_rate * (1 - self._TIGHTENING) * (self._TIGHTENING ** n))
+
+    def _contains(self, id_str):
+        h = _mix64(int(id_str))
+        return any(h in f for f in self._filters)
+
+    def _check_and_add(self, id_str):
+        h = _mix64(int(id_str))
+        if any(h in f for f in self._filters):
+            return True
+        if not self._filters or self._filters[-1].count >= self._filters[-1].capacity:
+            self._filters.append(self._next_filter())
+        self._filters[-1].add(h)
+        return False
+
+    def save(self, path):
+        chunks = [_HEADER.pack(_MAGIC, _VERSION, self._KIND_CODE, len(self._filters))]
+        for f in self._filters:
+            chunks.append(_FILTER.pack(f.num_bits, f.num_hashes, f.count, f.capacity))
+        for f in self._filters:
+            chunks.append(bytes(f.bits))
+        _write_atomic(path, chunks)
+
+    @classmethod
+    def load(cls, path, **options):
+        ret = cls(**options)
+        with open(path, "rb") as f:
+            snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            count = _read_header(snapshot, cls._KIND_CODE)
+            offset = _HEADER.size + count * _FILTER.size
+            for i in range(count):
+                num_bits, num_hashes, n, capacity = _FILTER.unpack_from(snapshot, _HEADER.size + i * _FILTER.size)
+                size = (num_bits + 7) // 8
+                f = ret._next_filter()
+                if (f.num_bits, f.num_hashes) != (num_bits, num_hashes):
+                    raise ValueError("Snapshot was written with a different capacity or error rate")
+                f.bits = bytearray(snapshot[offset:offset + size])
+                f.count = n
+                ret._filters.append(f)
+                offset += size
+        finally:
+            snapshot.close()
+        return ret
+
+
+class SharedIdSet(DedupIndex):
+    """
+    Exact set of recent ids in shared memory, so that several worker
+    processes (created after it) can drop each other's duplicates.
+
+    Ids live in two open-addressing tables of `capacity` slots. New ids go
+    into the current table; once it's half full the other one is cleared and
+    becomes current, so at least the last `capacity / 2` ids are always
+    remembered. Every operation takes a single lock shared by all processes.
+    """
+    kind = 'shared'
+    _KIND_CODE = 4
+    # Slots in the state array
+    _CURRENT = 0
+    _COUNT = 1
+    _PREVIOUS_COUNT = 2
+
+    def __init__(self, capacity=1 << 20):
+        super(SharedIdSet, self).__init__()
+        assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be a power of two"
+        self._capacity = capacity
+        self._mask = capacity - 1
+        self._tables = [multiprocessing.RawArray('q', capacity), multiprocessing.RawArray('q', capacity)]
+        self._state = multiprocessing.RawArray('q', 3)
+        self._lock = multiprocessing.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return self._state[self._COUNT] + self._state[self._PREVIOUS_COUNT]
+
+    @property
+    def memory_bytes(self):
+        return 2 * self._capacity * 8
+
+    def _find(self, table, tweet_id, h):
+        # Returns (found, index of the id or of the empty slot where it belongs)
+        mask = self._mask
+        i = h & mask
+        while True:
+            x = table[i]
+            if x == tweet_id:
+                return True, i
+            if x == 0:
+                return False, i
+            i = (i + 1) & mask
+
+    def _contains(self, id_str):
+        tweet_id = int(id_str)
+        h = _mix64(tweet_id)
+        with self._lock:
+            return any(self._find(table, tweet_id, h)[0] for table in self._tables)
+
+    def _check_and_add(self, id_str):
+        tweet_id = int(id_str)
+        h = _mix64(tweet_id)
+        with self._lock:
+            state = self._state
+            current = self._tables[state[self._CURRENT]]
+            found, i = self._find(current, tweet_id, h)
+            if found or self._find(self._tables[1 - state[self._CURRENT]], tweet_id, h)[0]:
+                return True
+            current[i] = tweet_id
+            state[self._COUNT] += 1
+            if state[self._COUNT] >= self._capacity // 2:
+                other = 1 - state[self._CURRENT]
+                ctypes.memset(self._tables[other], 0, self._capacity * 8)
+                state[self._CURRENT] = other
+                state[self._PREVIOUS_COUNT] = state[self._COUNT]
+                state[self._COUNT] = 0
+            return False
+
+    def save(self, path):
+        with self._lock:
+            chunks = [_HEADER.pack(_MAGIC, _VERSION, self._KIND_CODE, self._capacity)]
+            chunks.extend(ctypes.string_at(array_, ctypes.sizeof(array_)) for array_ in [self._state] + self._tables)
+        _write_atomic(path, chunks)
+
+    @classmethod
+    def load(cls, path, **options):
+        ret = cls(**options)
+        with open(path, "rb") as f:
+            buf = f.read()
+        if _read_header(buf, cls._KIND_CODE) != ret._capacity:
+            raise ValueError("Snapshot was written with a different capacity")
+        offset = _HEADER.size
+        for array_ in [ret._state] + ret._tables:
+            size = ctypes.sizeof(array_)
+            ctypes.memmove(array_, buf[offset:offset + size], size)
+            offset += size
+        return ret
+
+
+DEDUP_KINDS = dict((cls.kind, cls) for cls in [LRUDedup, WindowedIdSet, ScalableBloomFilter])
+
+
+def make_dedup(kind='lru', snapshot=None, **options):
+    """
+    Creates a dedup index of the given kind, restoring it from `snapshot` if
+    that file exists.
+    """
+    assert kind in DEDUP_KINDS, "dedup kind must be one of: {}".format(", ".join(sorted(DEDUP_KINDS)))
+    cls = DEDUP_KINDS[kind]
+    if snapshot is not None and os.path.exists(snapshot):
+        try:
+            ret = cls.load(snapshot, **options)
+            _LOG.info("Loaded {:,} ids from dedup snapshot: {}".format(len(ret), snapshot))
+            return ret
+        except ValueError as e:
+            _LOG.warning("Ignoring dedup snapshot {}: {}".format(snapshot, e))
+    return cls(**options)
@@ -1,20 +1,39 @@
-import contextlib
+import collections
+import socket
+import threading
+import time
 
 import smtplib
 
 from email.mime.text import MIMEText
 from email.parser import Parser
+from six.moves import socketserver
 
 from .auth import get_gmail_info
+from .log import get_logger
+
+_LOG = get_logger('email')
 
 _DEFAULT_DEFAULT_SUBJECT = "Message from twitter-scraping"
+_GMAIL_HOST = "smtp.gmail.com"
 
 class Emailer(object):
-    def __init__(self, default_subject=None):
+    """
+    Sends mail through `host`, keeping the SMTP connection open between
+    messages (it's re-established if the server drops it). Gmail credentials
+    are used unless `credentials` are given; servers which don't need a login
+    (such as a local SMTPSink) can be used with `use_ssl=False` and
+    `credentials={'username': <address>}`.
+    """
+    def __init__(self, default_subject=None, host=_GMAIL_HOST, port=None, use_ssl=True, credentials=None):
         self._default_subject = default_subject or _DEFAULT_DEFAULT_SUBJECT
-        credentials = get_gmail_info()
+        self._host = host
+        self._port = port
+        self._use_ssl = use_ssl
+        self._server = None
+        credentials = credentials or get_gmail_info()
         self.email = credentials['username']
-        self.password = credentials['password']
+        self.password = credentials.get('password')
 
     @property
     def default_subject(self):
@@ -24,26 +43,44 @@ class Emailer(object):
     def set_default_subject(self, subject):
         self._default_subject = subject
 
-    @contextlib.contextmanager
-    def _server_connection(self):
-        server = smtplib.SMTP_SSL("smtp.gmail.com")
-        try:
+    def format_subject(self, subject=None):
+        # Allow passing of template strings as subject
+        return (subject or self.default_subject).format(default_subject=self.default_subject)
+
+    def _connect(self):
+        cls = smtplib.SMTP_SSL if self._use_ssl else smtplib.SMTP
+        server = cls(self._host, self._port or 0)
+        if self.password is not None:
             server.login(self.email, self.password)
-            yield server
-        finally:
-            server.quit()
-    
+        return server
+
+    def _send(self, message):
+        if self._server is None:
+            self._server = self._connect()
+        self._server.sendmail(message['From'], [message['To']], message.as_string())
+
     def send_message(self, message, subject=None):
-        with self._server_connection() as server:
-            # Allow passing of template strings as subject
-            message['Subject'] = (subject or self.default_subject).format(default_subject=self.default_subject)
-            message['From'] = self.email
-            message['To'] = self.email
-            server.sendmail(message['From'], [message['To']], message.as_string())
+        message['Subject'] = self.format_subject(subject)
+        message['From'] = self.email
+        message['To'] = self.email
+        try:
+            self._send(message)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            # The server closed the idle connection; reconnect once
+            self.close()
+            self._send(message)
 
     def send_text(self, message, subject=None):
         self.send_message(Parser().parsestr(message), subject=subject)
 
+    def close(self):
+        server, self._server = self._server, None
+        if server is not None:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+
 
 class DummyEmailer(object):
     def __init__(self, default_subject=None):
@@ -54,3 +91,220 @@ class DummyEmailer(object):
 
     def send_text(self, message, subject=None):
         pass
+
+    def close(self):
+        pass
+
+
+class BackgroundEmailer(object):
+    """
+    Wraps an Emailer so that sending never blocks the caller: messages are
+    queued and delivered from a dispatcher thread.
+
+    Messages with the same subject which arrive within `digest_window`
+    seconds of each other are coalesced into a single digest, and at most one
+    email per subject is sent every `min_interval` seconds; anything arriving
+    in between is held for the next digest. At most `max_pending` messages
+    are held per subject (the oldest are dropped after that). The connection
+    is closed after `idle_timeout` seconds without mail.
+    """
+    def __init__(self, emailer, digest_window=10.0, min_interval=300.0, max_pending=1000, idle_timeout=60.0):
+        self._emailer = emailer
+        self._digest_window = digest_window
+        self._min_interval = min_interval
+        self._max_pending = max_pending
+        self._idle_timeout = idle_timeout
+        self._pending = collections.OrderedDict()
+        self._last_sent = {}
+        self._last_activity = time.time()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._closing = False
+        self._num_dropped = 0
+        self._thread = threading.Thread(name='email_dispatcher', target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def default_subject(self):
+        return self._emailer.default_subject
+
+    @property
+    def num_dropped(self):
+        return self._num_dropped
+
+    def send_text(self, message, subject=None):
+        # Grouped by the unformatted subject, which the wrapped emailer formats
+        subject = subject or "{default_subject}"
+        with self._wakeup:
+            pending = self._pending.setdefault(subject, collections.deque())
+            if len(pending) >= self._max_pending:
+                pending.popleft()
+                self._num_dropped += 1
+            pending.append((time.time(), message))
+            self._wakeup.notify()
+
+    def send_message(self, message, subject=None):
+        self.send_text(message.get_payload(), subject=subject)
+
+    def _due(self, subject, pending, now):
+        if self._closing:
+            return now
+        first = pending[0][0]
+        return max(first + self._digest_window, self._last_sent.get(subject, 0) + self._min_interval)
+
+    def _take_due(self):
+        # Returns the (subject, messages) which are ready, or how long to wait
+        now = time.time()
+        ready = []
+        wait = self._idle_timeout
+        for subject, pending in list(self._pending.items()):
+            due = self._due(subject, pending, now)
+            if due <= now:
+                ready.append((subject, list(pending)))
+                del self._pending[subject]
+                self._last_sent[subject] = now
+            else:
+                wait = min(wait, due - now)
+        return ready, wait
+
+    def _format_digest(self, messages):
+        if len(messages) == 1:
+            return messages[0][1]
+        parts = ["{} notifications:".format(len(messages))]
+        for t, message in messages:
+            parts.append("[{}]\n{}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)), message))
+        return "\n\n----\n\n".join(parts)
+
+    def _deliver(self, subject, messages):
+        if len(messages) > 1:
+            digest_subject = "{} ({} notifications)".format(subject, len(messages))
+        else:
+            digest_subject = subject
+        try:
+            self._emailer.send_text(self._format_digest(messages), subject=digest_subject)
+        except Exception:
+            _LOG.exception("Failed to send email: {}".format(digest_subject))
+            with self._wakeup:
+                # Put them back to go out with the next digest
+                pending = self._pending.setdefault(subject, collections.deque())
+                pending.extendleft(reversed(messages))
+                while len(pending) > self._max_pending:
+                    pending.popleft()
+                    self._num_dropped += 1
+
+    def _run(self):
+        while True:
+            if time.time() - self._last_activity >= self._idle_timeout:
+                self._emailer.close()
+            with self._wakeup:
+                closing = self._closing
+                ready, wait = self._take_due()
+                if not ready:
+                    if closing:
+                        break
+                    self._wakeup.wait(wait)
+                    continue
+            for subject, messages in ready:
+                self._deliver(subject, messages)
+            self._last_activity = time.time()
+            if closing:
+                # Failures aren't retried on the way out
+                break
+        self._emailer.close()
+
+    def close(self, timeout=60.0):
+        """
+        Sends everything still pending, ignoring the rate limit, and stops.
+        """
+        with self._wakeup:
+            self._closing = True
+            self._wakeup.notify()
+        self._thread.join(timeout)
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write((line + "\r\n").encode('ascii'))
+
+    def handle(self):
+        self._reply("220 {} twitter-scraping SMTP sink".format(self.server.server_address[0]))
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ('HELO', 'EHLO'):
+                self._reply("250 OK")
+            elif verb == 'MAIL':
+                sender, recipients = command.split(":", 1)[1].strip(), []
+                self._reply("250 OK")
+            elif verb == 'RCPT':
+                recipients.append(command.split(":", 1)[1].strip())
+                self._reply("250 OK")
+            elif verb == 'DATA':
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data.rstrip(b"\r\n") == b".":
+                        break
+                    # Undo dot-stuffing
+                    lines.append(data[1:] if data.startswith(b"..") else data)
+                self.server.deliver(sender, recipients, b"".join(lines).decode('utf-8', 'replace'))
+                self._reply("250 OK")
+            elif verb in ('RSET', 'NOOP'):
+                self._reply("250 OK")
+            elif verb == 'QUIT':
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("502 Command not implemented")
+
+
+class SMTPSink(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    Minimal in-process SMTP server which accepts everything and keeps it in
+    `messages` (parsed email.message.Message objects), for testing
+    notifications without a real mail server.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        socketserver.TCPServer.__init__(self, (host, port), _SMTPHandler)
+        self.messages = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def emailer(self, default_subject=None):
+        """
+        Returns an Emailer which delivers to this sink.
+        """
+        return Emailer(default_subject=default_subject, host=self.server_address[0], port=self.port,
+                       use_ssl=False, credentials={'username': 'twitter-scraping@localhost'})
+
+    def deliver(self, sender, recipients, data):
+        message = Parser().parsestr(data)
+        with self._lock:
+            self.messages.append(message)
+        _LOG.info("Received email from {}: {}".format(sender, message['Subject']))
+
+    def start(self):
+        self._thread = threading.Thread(name='smtp_sink', target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
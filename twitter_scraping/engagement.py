@@ -0,0 +1,128 @@
+import collections
+import json
+import time
+
+from .log import get_logger
+from .shard_index import created_at_ms
+
+_LOG = get_logger('engagement')
+
+ENGAGEMENT_DIRECTORY = "engagement"
+ENGAGEMENT_TEMPLATE = "engagement-shard-{n}.json"
+ENGAGEMENT_PATTERN = "engagement-shard-*.json*"
+
+RETWEET = 'retweet'
+QUOTE = 'quote'
+
+# Indexes into an entry
+_RETWEETS, _QUOTES, _FIRST, _LAST = range(4)
+
+
+class EngagementAggregator(object):
+    """
+    Counts the retweets and quotes of each original seen on the stream,
+    with when the first and last of them were posted (read from the
+    snowflake ids, in ms since the epoch), and writes the counts out as
+    JSON lines through `write` every `flush_interval` seconds:
+
+        {"id_str", "retweets", "quotes", "first_seen_ms", "last_seen_ms",
+         "window_start_ms", "window_end_ms"}
+
+    Each record covers one window, so an original's totals are the sum of
+    its records (see `summarize`). At most `capacity` originals are held:
+    when there are more, the least engaged half is written out early and
+    forgotten, so that the popular originals, which make up most events,
+    keep accumulating in memory and nothing is lost.
+
+    Events aren't deduplicated, so a retweet delivered twice (e.g. either
+    side of a reconnection) counts twice.
+    """
+    def __init__(self, write, capacity=100000, flush_interval=300.0):
+        assert capacity > 1, "capacity must be greater than one"
+        assert flush_interval > 0, "flush_interval must be greater than zero"
+        self._write = write
+        self._capacity = capacity
+        self._flush_interval = flush_interval
+        self._entries = {}
+        self._window_start = time.time()
+        self.num_events = collections.Counter()
+        self.num_written = 0
+        self.num_evicted = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, original_id_str, event_id_str=None, kind=RETWEET):
+        """
+        Records that `original_id_str` was retweeted (or quoted, with `kind`
+        of QUOTE) by the status `event_id_str`.
+        """
+        ms = created_at_ms(int(event_id_str)) if event_id_str else int(time.time() * 1000)
+        entry = self._entries.get(original_id_str)
+        if entry is None:
+            if len(self._entries) >= self._capacity:
+                self._evict()
+            entry = self._entries[original_id_str] = [0, 0, ms, ms]
+        entry[_QUOTES if kind == QUOTE else _RETWEETS] += 1
+        if ms < entry[_FIRST]:
+            entry[_FIRST] = ms
+        elif ms > entry[_LAST]:
+            entry[_LAST] = ms
+        self.num_events[kind] += 1
+
+    def _record(self, id_str, entry, window_end):
+        return json.dumps(collections.OrderedDict([
+            ('id_str', id_str),
+            ('retweets', entry[_RETWEETS]),
+            ('quotes', entry[_QUOTES]),
+            ('first_seen_ms', entry[_FIRST]),
+            ('last_seen_ms', entry[_LAST]),
+            ('window_start_ms', int(self._window_start * 1000)),
+            ('window_end_ms', int(window_end * 1000)),
+        ]))
+
+    def _evict(self):
+        # Sorting is amortized over the capacity / 2 inserts until the next eviction
+        ranked = sorted(self._entries.items(), key=lambda item: item[1][_RETWEETS] + item[1][_QUOTES])
+        now = time.time()
+        for id_str, entry in ranked[:len(ranked) // 2]:
+            self._write(self._record(id_str, entry, now))
+            del self._entries[id_str]
+            self.num_written += 1
+            self.num_evicted += 1
+
+    def flush_if_needed(self):
+        if time.time() - self._window_start >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes out every original counted in the current window, and starts
+        a new one.
+        """
+        now = time.time()
+        for id_str, entry in self._entries.items():
+            self._write(self._record(id_str, entry, now))
+        self.num_written += len(self._entries)
+        _LOG.info("Wrote engagement for {:,} originals.".format(len(self._entries)))
+        self._entries = {}
+        self._window_start = now
+
+
+def summarize(records):
+    """
+    Totals the aggregate records (parsed) of each original across windows.
+    Returns a dict of id_str to {"retweets", "quotes", "first_seen_ms",
+    "last_seen_ms"}.
+    """
+    ret = {}
+    for record in records:
+        total = ret.get(record['id_str'])
+        if total is None:
+            ret[record['id_str']] = dict((k, record[k]) for k in ('retweets', 'quotes', 'first_seen_ms', 'last_seen_ms'))
+            continue
+        total['retweets'] += record['retweets']
+        total['quotes'] += record['quotes']
+        total['first_seen_ms'] = min(total['first_seen_ms'], record['first_seen_ms'])
+        total['last_seen_ms'] = max(total['last_seen_ms'], record['last_seen_ms'])
+    return ret
@@ -1,17 +1,81 @@
 import abc
-import boto3
+import collections
+import heapq
+import itertools
 import os
+import random
 import six
+import sys
 import threading
 import time
 
-from .auth import check_boto_credentials
+from . import manifest
+from .compression import Codec, codec_for_filename
 from .log import get_logger
+from .metrics import MetricsRegistry
+from .shard_index import INDEX_EXTENSION, ShardIndexBuilder, build_index, index_filename
+from .storage import S3Storage
 
 _LOG = get_logger('file_utils')
 
+_BUFFER_SIZE = 1 << 20
+# Files which travel with a shard, named by appending these to its filename
+SAMPLE_EXTENSION = '.sample.json'
+SIDECAR_EXTENSIONS = (INDEX_EXTENSION, SAMPLE_EXTENSION)
+COLUMNAR_EXTENSION = '.parquet'
+
+
+def default_root():
+    """
+    Prefix to upload a run's shards under when none is given.
+    """
+    return time.strftime("run_%Y-%m-%d_%H:%M:%S")
+
+
+def columnar_filename(filename):
+    """
+    Where the columnar copy of a shard goes: tweets-shard-1.json.gz becomes
+    tweets-shard-1.parquet.
+    """
+    base = filename[:-len(codec_for_filename(filename).extension) or None]
+    if base.endswith(".json"):
+        base = base[:-len(".json")]
+    return base + COLUMNAR_EXTENSION
+
+
+def is_columnar(filename):
+    return filename.endswith(COLUMNAR_EXTENSION)
+
+
+def sidecars_for(filename):
+    """
+    The files which exist alongside a shard and should be uploaded and
+    deleted with it.
+    """
+    candidates = [filename + ext for ext in SIDECAR_EXTENSIONS]
+    if not is_columnar(filename):
+        candidates.append(columnar_filename(filename))
+    return [c for c in candidates if os.path.exists(c)]
+
+
+def move_sidecars(filename, dest):
+    """
+    Renames the sidecars of `filename` which describe its records rather
+    than its bytes (everything but the index) to go with `dest`.
+    """
+    for ext in SIDECAR_EXTENSIONS:
+        if ext != INDEX_EXTENSION and os.path.exists(filename + ext):
+            os.rename(filename + ext, dest + ext)
+
+
 @six.add_metaclass(abc.ABCMeta)
 class ShardListener(object):
+    def shard_opened(self, filename):
+        """
+        Called when a shard is started.
+        """
+        pass
+
     def handle_shard(self, filename):
         """
         Called when a shard is finished being written to. 
@@ -21,80 +85,556 @@ class ShardListener(object):
     def close(self):
         pass
 
-class S3FileMover(ShardListener):
-    def __init__(self, bucket, base_dir, s3_root=None):
-        assert bucket is not None, "Bucket name must not be None."
-        check_boto_credentials()
-        self._s3 = boto3.resource('s3')
-        self._bucket_name = bucket
+_STOP = object()
+# Codecs from least to most compact
+_CODEC_STRENGTH = ('none', 'gzip', 'zstd')
+
+
+def _compactness(codec_name, level):
+    # Higher levels of the same codec are more compact
+    return _CODEC_STRENGTH.index(codec_name), level or 0
+
+
+def recompress_shard(filename, codec, shard_manifest=None, block_bytes=1 << 20):
+    """
+    Rewrites a sealed shard with `codec`, re-indexing it in blocks of
+    `block_bytes` if it had an index, and removes the original (noting the
+    swap in `shard_manifest`). Returns the new filename, which is the old
+    one if it already used `codec`'s extension; it's rewritten in place.
+    """
+    source = codec_for_filename(filename)
+    dest = filename[:len(filename) - len(source.extension)] + codec.extension
+    tmp_dest = "{}.tmp".format(dest)
+    indexed = os.path.exists(index_filename(filename))
+    shard = _ShardFile(tmp_dest, codec, index=ShardIndexBuilder() if indexed else None)
+    try:
+        with open(filename, "rb") as raw:
+            reader = source.open_reader(raw)
+            while True:
+                # Whole lines only, so that the index sees whole records
+                lines = reader.readlines(_BUFFER_SIZE)
+                if not lines:
+                    break
+                data = b"".join(lines)
+                shard.write(data, data.count(b"\n"))
+                if indexed and shard.num_bytes - shard.block_start >= block_bytes:
+                    shard.end_block()
+        shard.close()
+    except Exception:
+        shard.close()
+        os.remove(tmp_dest)
+        raise
+    os.rename(tmp_dest, dest)
+    if indexed:
+        shard.index.write(index_filename(dest))
+    if dest != filename:
+        if indexed:
+            os.remove(index_filename(filename))
+        move_sidecars(filename, dest)
+        os.remove(filename)
+    if shard_manifest is not None:
+        entry = shard_manifest.get(filename) or {}
+        shard_manifest.record(dest, manifest.SEALED, n=entry.get('n') or 0, records=shard.num_records,
+                              offset=shard.compressed_bytes, level=codec.effective_level)
+        if dest != filename:
+            shard_manifest.record(filename, manifest.RECOMPRESSED)
+    return dest
+
+
+class ShardUploader(ShardListener):
+    """
+    Uploads finished shards to `storage` from a fixed pool of `workers`
+    threads, deleting each local copy once its upload has been verified.
+    Failed uploads are retried up to `retries` times with exponential
+    backoff; shards which still fail are left on disk until `retry_failed`.
+
+    Waiting shards are uploaded oldest first (by when they were last
+    written), so that ones which failed and were re-queued, or were left by
+    a previous run, don't wait behind newer ones.
+
+    The queue depth is reported with an `output` label (by default the name
+    of `base_dir`), so that each uploader sharing `metrics` has its own.
+    """
+    def __init__(self, storage, base_dir, root=None, workers=2, retries=5, retry_delay=1.0, retry_delay_cap=60.0, manifest=None,
+                 metrics=None, output=None):
+        assert workers > 0, "workers must be greater than zero"
+        metrics = metrics or MetricsRegistry()
+        self._upload_seconds = metrics.histogram('shard_upload_seconds', "Time taken to upload a shard, including retries")
+        self._uploads = metrics.counter('shard_uploads_total', "Shard uploads by outcome", labels=('result',))
+        metrics.gauge('shard_upload_queue_depth', "Shards waiting to be uploaded", labels=('output',))\
+            .labels(output or os.path.basename(os.path.normpath(base_dir)), fn=lambda: self.queue_depth)
+        self._storage = storage
+        self._manifest = manifest
         self._base_dir = base_dir
-        self._s3_root = s3_root or time.strftime("run_%Y-%m-%d_%H:%M:%S")
-        self._uploader_threads = []
-        if not any(b['Name'] == bucket for b in boto3.client('s3').list_buckets()['Buckets']):
-            # Create the bucket if it doesn't exist
-            self._s3.create_bucket(self._bucket_name)
+        self._root = root or default_root()
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._retry_delay_cap = retry_delay_cap
+        self._queue = six.moves.queue.PriorityQueue()
+        # Breaks ties, so that filenames are never compared
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._uploading = set()
+        self._failed = []
+        # Taken out of the queue (or the failed list) to be recompressed
+        self._recompressing = None
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(name='uploader_{}'.format(i), target=self._run)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def key_for(self, filename):
+        return "/".join([self._root, os.path.relpath(filename, self._base_dir).replace(os.sep, "/")])
 
     def move_file(self, filename):
-        dest_filename = os.path.join(self._s3_root, os.path.relpath(filename, self._base_dir))
-        _LOG.info("Uploading file {} to s3://{}:{}".format(filename, self._bucket_name, dest_filename))
-        bucket = self._s3.Bucket(self._bucket_name)
-        bucket.upload_file(filename, dest_filename)
-        obj = self._s3.Object(self._bucket_name, dest_filename)
-        disk_size = os.stat(filename).st_size
-        if disk_size != obj.content_length:
-            _LOG.error("File {} failed to upload to S3! Expected size: {}B; Actual size: {}B. Local copy will not be deleted.".format(filename, disk_size, obj.content_length))
-        else:
-            # Successfully uploaded. Delete old file
-            _LOG.info("File successfully uploaded (local copy will be deleted): {}".format(filename))
-            os.remove(filename)
+        key = self.key_for(filename)
+        # Sidecars go first, so that any shard in storage has its index there too
+        sidecars = sidecars_for(filename)
+        delay = self._retry_delay
+        start = time.time()
+        if self._manifest is not None:
+            self._manifest.record(filename, manifest.UPLOADING)
+        for attempt in range(self._retries + 1):
+            _LOG.info("Uploading file {} to {}".format(filename, self._storage.describe(key)))
+            try:
+                for sidecar in sidecars:
+                    self._storage.upload(sidecar, self.key_for(sidecar))
+                self._storage.upload(filename, key)
+            except Exception as e:
+                if attempt == self._retries:
+                    _LOG.error("File {} failed to upload after {} attempts ({}). Local copy will not be deleted.".format(filename, attempt + 1, e))
+                    if self._manifest is not None:
+                        # Leave it to be retried on the next run
+                        self._manifest.record(filename, manifest.SEALED)
+                    self._uploads.labels('failed').inc()
+                    return False
+                _LOG.warning("Upload of {} failed ({}); retrying in {:.1f}s.".format(filename, e, delay))
+                self._uploads.labels('retried').inc()
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, self._retry_delay_cap)
+            else:
+                # Successfully uploaded. Delete old file
+                _LOG.info("File successfully uploaded (local copy will be deleted): {}".format(filename))
+                os.remove(filename)
+                for sidecar in sidecars:
+                    os.remove(sidecar)
+                if self._manifest is not None:
+                    self._manifest.record(filename, manifest.UPLOADED)
+                self._uploads.labels('uploaded').inc()
+                self._upload_seconds.observe(time.time() - start)
+                return True
+
+    def _run(self):
+        while True:
+            _, _, filename = self._queue.get()
+            if filename is _STOP:
+                return
+            with self._lock:
+                self._uploading.add(filename)
+            uploaded = False
+            try:
+                uploaded = self.move_file(filename)
+            except Exception:
+                _LOG.exception("Uploader failed on {}".format(filename))
+            with self._lock:
+                self._uploading.discard(filename)
+                if not uploaded and os.path.exists(filename):
+                    self._failed.append(filename)
+
+    def _put(self, filename):
+        try:
+            written = os.path.getmtime(filename)
+        except OSError:
+            written = time.time()
+        self._queue.put((written, next(self._sequence), filename))
 
     def handle_shard(self, filename):
-        new_thread = threading.Thread(name='uploader_{}'.format(os.path.basename(filename)),
-                                      target=self.move_file,
-                                      args=(filename,))
-        self._uploader_threads = [t for t in self._uploader_threads if t.is_alive()]
-        self._uploader_threads.append(new_thread)
-        new_thread.start()
+        self._put(filename)
+
+    def pending(self):
+        """
+        The shards not yet uploaded, as a dict of 'queued', 'uploading' and
+        'failed' to lists of filenames.
+        """
+        with self._queue.mutex:
+            queued = [filename for _, _, filename in self._queue.queue if filename is not _STOP]
+        with self._lock:
+            if self._recompressing is not None:
+                queued.append(self._recompressing)
+            return {'queued': queued, 'uploading': list(self._uploading), 'failed': list(self._failed)}
+
+    def retry_failed(self):
+        """
+        Re-queues the shards which failed to upload. Returns how many there were.
+        """
+        with self._lock:
+            failed, self._failed = self._failed, []
+        for filename in failed:
+            self._put(filename)
+        return len(failed)
+
+    def recompress_pending(self, codec):
+        """
+        Rewrites the JSON shards waiting to be uploaded (or which failed to
+        be) which were compressed less compactly than `codec` would, one at
+        a time: each is only out of the queue while it's being rewritten, so
+        the others can still be uploaded, and goes back in its place after.
+        Returns the number of bytes saved.
+        """
+        saved = 0
+        with self._queue.mutex:
+            queued = [item for item in self._queue.queue if item[2] is not _STOP]
+        # Newest first, since the oldest are the next to be uploaded
+        for item in sorted(queued, reverse=True):
+            if not self._needs_recompress(item[2], codec) or not self._claim(item):
+                continue
+            written, sequence, filename = item
+            try:
+                filename, saving = self._recompress(filename, codec)
+                saved += saving
+            finally:
+                with self._lock:
+                    self._recompressing = None
+                self._queue.put((written, sequence, filename))
+        with self._lock:
+            failed = list(self._failed)
+        for filename in failed:
+            if not self._needs_recompress(filename, codec):
+                continue
+            with self._lock:
+                if filename not in self._failed:
+                    # Retried meanwhile
+                    continue
+                self._failed.remove(filename)
+                self._recompressing = filename
+            try:
+                filename, saving = self._recompress(filename, codec)
+                saved += saving
+            finally:
+                with self._lock:
+                    self._recompressing = None
+                    self._failed.append(filename)
+        return saved
+
+    def _claim(self, item):
+        # Takes a waiting shard out of the queue, unless an upload worker
+        # got to it first
+        with self._queue.mutex:
+            try:
+                self._queue.queue.remove(item)
+            except ValueError:
+                return False
+            heapq.heapify(self._queue.queue)
+            with self._lock:
+                self._recompressing = item[2]
+        return True
+
+    def _needs_recompress(self, filename, codec):
+        if is_columnar(filename) or not os.path.exists(filename):
+            return False
+        source = codec_for_filename(filename)
+        entry = self._manifest.get(filename) if self._manifest is not None else None
+        # Shards written without a manifest are taken to be at the default
+        level = (entry or {}).get('level') or source.effective_level
+        return _compactness(source.name, level) < _compactness(codec.name, codec.effective_level)
+
+    def _recompress(self, filename, codec):
+        before = os.path.getsize(filename)
+        try:
+            dest = recompress_shard(filename, codec, shard_manifest=self._manifest)
+        except Exception:
+            _LOG.exception("Failed to recompress {}".format(filename))
+            return filename, 0
+        _LOG.info("Recompressed {} to {} ({:,}B to {:,}B).".format(filename, dest, before, os.path.getsize(dest)))
+        return dest, before - os.path.getsize(dest)
 
     def close(self):
-        for t in self._uploader_threads:
-            if t.is_alive():
-                t.join()
+        for _ in self._workers:
+            self._queue.put((float('inf'), next(self._sequence), _STOP))
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+
+class S3FileMover(ShardUploader):
+    def __init__(self, bucket, base_dir, s3_root=None, **kwargs):
+        super(S3FileMover, self).__init__(S3Storage(bucket), base_dir, root=s3_root, **kwargs)
+
+
+class _ShardFile(object):
+    def __init__(self, filename, codec, index=None):
+        self.filename = filename
+        self.opened = time.time()
+        self.num_bytes = 0
+        self.num_records = 0
+        self.block_start = 0
+        self.index = index
+        self._codec = codec
+        self._raw = open(filename, "wb", buffering=_BUFFER_SIZE)
+        self._stream = codec.open_writer(self._raw)
+        self._dirty = False
+        if index is not None and self._stream is not self._raw:
+            index.add_block(0, 0)
+
+    @property
+    def compressed_bytes(self):
+        if self._raw.closed:
+            return self._closed_size
+        return self._raw.tell()
+
+    def write(self, data, num_records):
+        if self._stream is None:
+            if self.index is not None:
+                self.index.add_block(self._raw.tell(), self.num_bytes)
+            self._stream = self._codec.open_writer(self._raw)
+            self.block_start = self.num_bytes
+        if self.index is not None:
+            self.index.add_records(data, self.num_bytes, num_records)
+        self._stream.write(data)
+        self.num_bytes += len(data)
+        self.num_records += num_records
+        self._dirty = True
+
+    def end_block(self):
+        # Finish the current gzip member/zstd frame, so that the file is valid
+        # if it's ever truncated back to this point, and so that it can be
+        # decompressed starting from the next one.
+        if self._stream is not self._raw and self._dirty:
+            self._stream.close()
+            # Reopened lazily so that the next member's header isn't counted
+            self._stream = None
+            self._dirty = False
+
+    def flush(self):
+        self.end_block()
+        self._raw.flush()
+        self._dirty = False
+
+    def close(self):
+        if self._stream is not None and self._stream is not self._raw:
+            self._stream.close()
+        self._closed_size = self._raw.tell()
+        self._raw.close()
+
+
+def _nth_newline(data, n):
+    pos = -1
+    for _ in range(n):
+        pos = data.find(b"\n", pos + 1)
+    return pos
 
 
 class ShardedFileWriter(object):
-    def __init__(self, directory, template):
+    """
+    Writes newline-delimited records into numbered shards, compressed with
+    `codec`. A new shard is started once the current one holds `max_records`
+    records, `max_bytes` uncompressed bytes, `max_compressed_bytes` bytes on
+    disk, or was opened `max_age` seconds ago, whichever happens first.
+
+    With a `manifest`, every shard's progress is logged so that `recover()`
+    can pick up where a crashed run left off. Data is flushed and checkpointed
+    at least every `checkpoint_interval` seconds.
+
+    Bytes written and rotations are counted in `metrics`.
+
+    With `index`, each sealed shard gets a sidecar index (see
+    shard_index.ShardReader) of its records' ids and offsets. Compressed
+    shards are then written in independently decompressible blocks of about
+    `index_block_bytes` uncompressed bytes, so a lookup only has to
+    decompress one block.
+
+    Shards are numbered from 1, or taken from the iterator `numbers` if
+    given, e.g. to share one sequence between writers.
+    """
+    def __init__(self, directory, template, codec=None, max_records=None, max_bytes=None,
+                 max_compressed_bytes=None, max_age=None, manifest=None, checkpoint_interval=1.0, metrics=None,
+                 index=False, index_block_bytes=1 << 20, numbers=None):
         self._directory = directory
         self._template = template
+        self._codec = codec or Codec()
+        self._max_records = max_records
+        self._max_bytes = max_bytes
+        self._max_compressed_bytes = max_compressed_bytes
+        self._max_age = max_age
+        self._manifest = manifest
+        self._checkpoint_interval = checkpoint_interval
+        self._last_checkpoint = time.time()
+        self._flushed_bytes = 0
         self._count = 0
+        self._numbers = numbers
         self._current_writer = None
         self._listener = None
+        self._uploader = None
+        self._index = index
+        self._index_block_bytes = index_block_bytes
+        self._metrics = metrics or MetricsRegistry()
+        self._bytes_written = self._metrics.counter('shard_bytes_written_total', "Uncompressed bytes written to shards")
+        self._rotations = self._metrics.counter('shard_rotations_total', "Shards which have been sealed")
 
     @property
     def current_filename(self):
-        return os.path.join(self._directory, self._template.format(n=self._count))
+        return os.path.join(self._directory, self._template.format(n=self._count) + self._codec.extension)
+
+    @property
+    def uploader(self):
+        """
+        The ShardUploader set up by `offload`, or None.
+        """
+        return self._uploader
+
+    def offload(self, storage, root=None, **kwargs):
+        self._listener = self._uploader = ShardUploader(storage, self._directory, root=root, manifest=self._manifest,
+                                                        metrics=self._metrics, **kwargs)
+
+    def offload_to_s3(self, bucket, s3_root=None, **kwargs):
+        self._listener = self._uploader = S3FileMover(bucket, self._directory, s3_root=s3_root, manifest=self._manifest,
+                                                      metrics=self._metrics, **kwargs)
+
+    def convert_to_columnar(self, keep_json=True, **kwargs):
+        """
+        Converts shards to Parquet as they're sealed, before they're handed
+        to any uploader set up with `offload`, which should be called first.
+        """
+        from .columnar import ColumnarConverter
+        self._listener = ColumnarConverter(downstream=self._listener, keep_json=keep_json, manifest=self._manifest,
+                                           metrics=self._metrics, **kwargs)
+
+    def wrap_listener(self, wrap):
+        """
+        Puts `wrap(listener)` in front of whatever sealed shards are currently
+        handed to (which may be None).
+        """
+        self._listener = wrap(self._listener)
+
+    def recover(self):
+        """
+        Continues shard numbering from the previous run and re-queues any of
+        its shards which were never uploaded.
+        """
+        if self._manifest is None:
+            return
+        self._count = self._manifest.recover(self._template)
+        for filename in self._manifest.shards_in_state(manifest.SEALED, manifest.UPLOADING):
+            if not os.path.exists(filename):
+                continue
+            if self._index and not is_columnar(filename) and not os.path.exists(index_filename(filename)):
+                # Most likely the shard that was open when the run stopped
+                _LOG.info("Indexing shard from previous run: {}".format(filename))
+                build_index(filename)
+            if self._listener is not None:
+                _LOG.info("Re-queueing shard from previous run: {}".format(filename))
+                self._listener.handle_shard(filename)
+        if self._count > 0:
+            _LOG.info("Resuming after shard {}.".format(self._count))
+
+    def _seal(self):
+        current = self._current_writer
+        current.close()
+        if current.index is not None:
+            current.index.write(index_filename(current.filename))
+        self._rotations.inc()
+        if self._manifest is not None:
+            self._manifest.record(current.filename, manifest.SEALED,
+                                  offset=current.compressed_bytes, records=current.num_records)
+        if self._listener is not None:
+            self._listener.handle_shard(current.filename)
 
-    def offload_to_s3(self, bucket, s3_root=None):
-        self._listener = S3FileMover(bucket, self._directory, s3_root=s3_root)
-    
     def next_shard(self):
         if self._current_writer is not None:
-            self._current_writer.close()
-            if self._listener is not None:
-                self._listener.handle_shard(self.current_filename)
+            self._seal()
         if not os.path.exists(self._directory):
             os.makedirs(self._directory)
-        self._count += 1
-        self._current_writer = open(self.current_filename, "w", encoding="utf-8")
+        self._count = next(self._numbers) if self._numbers is not None else self._count + 1
+        self._current_writer = _ShardFile(self.current_filename, self._codec,
+                                          index=ShardIndexBuilder() if self._index else None)
+        self._flushed_bytes = 0
+        if self._manifest is not None:
+            self._manifest.record(self.current_filename, manifest.OPEN, n=self._count, offset=0, records=0,
+                                  level=self._codec.effective_level)
+        if self._listener is not None:
+            self._listener.shard_opened(self.current_filename)
 
-    def close(self):
+    def flush(self):
+        current = self._current_writer
+        current.flush()
+        self._last_checkpoint = time.time()
+        self._flushed_bytes = current.num_bytes
+        if self._manifest is not None:
+            self._manifest.record(current.filename, manifest.OPEN,
+                                  offset=current.compressed_bytes, records=current.num_records)
+
+    def checkpoint(self):
+        """
+        Flushes the current shard if anything's been written to it since it
+        was last flushed, `checkpoint_interval` or more seconds ago. Each
+        flush ends a compressed block, so callers which write often should
+        use this rather than `flush`.
+
+        A shard holding records which is `max_age` or older is rotated
+        instead, so that it's sealed on time even if nothing more is written.
+        """
+        current = self._current_writer
+        if current is None:
+            return
+        if current.num_records and self._max_age is not None and time.time() - current.opened >= self._max_age:
+            self.next_shard()
+        elif current.num_bytes > self._flushed_bytes \
+                and time.time() - self._last_checkpoint >= self._checkpoint_interval:
+            self.flush()
+
+    def _should_rotate(self):
+        current = self._current_writer
+        return (self._max_bytes is not None and current.num_bytes >= self._max_bytes) \
+            or (self._max_compressed_bytes is not None and current.compressed_bytes >= self._max_compressed_bytes) \
+            or (self._max_age is not None and time.time() - current.opened >= self._max_age)
+
+    def write(self, data):
+        if isinstance(data, six.text_type):
+            data = data.encode("utf-8")
+        num_records = data.count(b"\n")
+        if self._max_records is not None:
+            # Split batches which straddle the record limit so shards stay exact
+            room = self._max_records - self._current_writer.num_records
+            while num_records >= room:
+                end = _nth_newline(data, room) + 1
+                self._current_writer.write(data[:end], room)
+                self._bytes_written.inc(end)
+                self.next_shard()
+                data = data[end:]
+                num_records -= room
+                room = self._max_records
+        if data:
+            self._current_writer.write(data, num_records)
+            self._bytes_written.inc(len(data))
+            current = self._current_writer
+            if current.index is not None and self._codec.extension \
+                    and current.num_bytes - current.block_start >= self._index_block_bytes:
+                current.end_block()
+        if self._should_rotate():
+            self.next_shard()
+        elif self._manifest is not None and time.time() - self._last_checkpoint >= self._checkpoint_interval:
+            self.flush()
+
+    def seal(self):
+        """
+        Seals the current shard, if any, without starting another.
+        """
         if self._current_writer is not None:
-            self._current_writer.close()
-            if self._listener is not None:
-                self._listener.handle_shard(self.current_filename)
+            self._seal()
         self._current_writer = None
+
+    def close(self):
+        self.seal()
         if self._listener is not None:
             self._listener.close()
+        if self._manifest is not None:
+            self._manifest.close()
 
     def __enter__(self):
         self.next_shard()
@@ -107,3 +647,414 @@ class ShardedFileWriter(object):
             return object.__getattribute__(self, attr)
         else:
             return getattr(self._current_writer, attr)
+
+
+class _PartitionListener(ShardListener):
+    # Hands partitions' shards to whatever the root writer hands its own to
+    def __init__(self, root):
+        self._root = root
+
+    def shard_opened(self, filename):
+        if self._root._listener is not None:
+            self._root._listener.shard_opened(filename)
+
+    def handle_shard(self, filename):
+        if self._root._listener is not None:
+            self._root._listener.handle_shard(filename)
+
+
+class PartitionedShardWriter(object):
+    """
+    Writes records into the partition directories of `layout` (see
+    layout.PartitionLayout) under `directory`, e.g.
+    dt=2020-01-31/hour=07/lang=en/, with a ShardedFileWriter per partition.
+    Each record goes to the partition it belongs to whenever it arrives, so
+    a late one reopens its partition with a new shard there.
+
+    At most `max_open` partitions have a shard open at once: opening another
+    seals the least recently written one's, as does going `idle_seconds`
+    without a write. Shards are numbered in one sequence across partitions
+    and share the `manifest` and whatever is set up by `offload` etc, so
+    uploaded keys keep the partition directories. The other arguments are as
+    for ShardedFileWriter, and apply to each partition's shards.
+    """
+    def __init__(self, directory, template, layout, max_open=64, idle_seconds=300.0, manifest=None, metrics=None,
+                 **kwargs):
+        assert max_open > 0, "max_open must be greater than zero"
+        self._directory = directory
+        self._template = template
+        self._layout = layout
+        self._max_open = max_open
+        self._idle_seconds = idle_seconds
+        self._manifest = manifest
+        self._metrics = metrics or MetricsRegistry()
+        self._kwargs = kwargs
+        # Never opens a shard itself: holds the listeners, and recovers the
+        # manifest of every partition
+        self._root = ShardedFileWriter(directory, template, manifest=manifest, metrics=self._metrics, **kwargs)
+        self._forward = _PartitionListener(self._root)
+        self._numbers = itertools.count(1)
+        # Open partitions' writers and when they were last written, least recent first
+        self._partitions = collections.OrderedDict()
+        self._dirty = set()
+        self._last_idle_check = time.time()
+        self._last_written = None
+        self._metrics.gauge('partitions_open', "Partitions with a shard open", fn=lambda: len(self._partitions))
+        self._evictions = self._metrics.counter('partition_evictions_total',
+                                                "Partition shards sealed early to stay within the open partition limit")
+
+    @property
+    def current_filename(self):
+        """
+        The shard most recently written to, or None.
+        """
+        entry = self._partitions.get(self._last_written)
+        return entry[0].current_filename if entry is not None else None
+
+    @property
+    def uploader(self):
+        return self._root.uploader
+
+    def offload(self, storage, root=None, **kwargs):
+        self._root.offload(storage, root=root, **kwargs)
+
+    def offload_to_s3(self, bucket, s3_root=None, **kwargs):
+        self._root.offload_to_s3(bucket, s3_root=s3_root, **kwargs)
+
+    def convert_to_columnar(self, keep_json=True, **kwargs):
+        self._root.convert_to_columnar(keep_json=keep_json, **kwargs)
+
+    def wrap_listener(self, wrap):
+        self._root.wrap_listener(wrap)
+
+    def recover(self):
+        self._root.recover()
+        self._numbers = itertools.count(self._root._count + 1)
+
+    def _writer_for(self, partition, now):
+        entry = self._partitions.pop(partition, None)
+        if entry is not None:
+            writer = entry[0]
+        else:
+            while len(self._partitions) >= self._max_open:
+                self._seal_partition(next(iter(self._partitions)))
+                self._evictions.inc()
+            writer = ShardedFileWriter(os.path.join(self._directory, *partition), self._template,
+                                       manifest=self._manifest, metrics=self._metrics, numbers=self._numbers,
+                                       **self._kwargs)
+            writer.wrap_listener(lambda _: self._forward)
+            writer.next_shard()
+        self._partitions[partition] = (writer, now)
+        return writer
+
+    def _seal_partition(self, partition):
+        writer, _ = self._partitions.pop(partition)
+        writer.seal()
+        self._dirty.discard(partition)
+
+    def _seal_idle(self, now):
+        self._last_idle_check = now
+        for partition, (_, last_write) in list(self._partitions.items()):
+            if now - last_write < self._idle_seconds:
+                # The rest were written more recently
+                break
+            self._seal_partition(partition)
+
+    def write(self, data):
+        if isinstance(data, six.text_type):
+            data = data.encode("utf-8")
+        lines = data.split(b"\n")
+        # Whatever follows the last newline is an incomplete record
+        tail = lines.pop()
+        partition = self._layout.partition
+        batches = collections.OrderedDict()
+        for line in lines:
+            batches.setdefault(partition(line), []).append(line + b"\n")
+        if tail:
+            batches.setdefault(partition(tail), []).append(tail)
+        now = time.time()
+        for key, batch in batches.items():
+            self._writer_for(key, now).write(b"".join(batch))
+            self._dirty.add(key)
+            self._last_written = key
+        if now - self._last_idle_check >= 1.0:
+            self._seal_idle(now)
+
+    def flush(self):
+        for partition in self._dirty:
+            self._partitions[partition][0].flush()
+        self._dirty.clear()
+        now = time.time()
+        if now - self._last_idle_check >= 1.0:
+            self._seal_idle(now)
+
+    def checkpoint(self):
+        """
+        Checkpoints (see ShardedFileWriter.checkpoint) each open partition.
+        """
+        for writer, _ in list(self._partitions.values()):
+            writer.checkpoint()
+        now = time.time()
+        if now - self._last_idle_check >= 1.0:
+            self._seal_idle(now)
+
+    def next_shard(self):
+        """
+        Seals every open partition's shard; each starts a new one when it's
+        next written to.
+        """
+        for partition in list(self._partitions):
+            self._seal_partition(partition)
+
+    def close(self):
+        self.next_shard()
+        self._root.close()
+
+    def __enter__(self):
+        self.next_shard()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+BACKPRESSURE_BLOCK = 'block'
+BACKPRESSURE_DROP_OLDEST = 'drop-oldest'
+BACKPRESSURE_SPILL = 'spill'
+BACKPRESSURE_POLICIES = (BACKPRESSURE_BLOCK, BACKPRESSURE_DROP_OLDEST, BACKPRESSURE_SPILL)
+
+_ROTATE = object()
+_CLOSE = object()
+
+
+class BackgroundShardWriter(object):
+    """
+    Wraps a ShardedFileWriter so that writes and shard rotation happen on a
+    dedicated thread. Records are queued (up to `queue_size` of them) and
+    written out in batches once `flush_bytes` have accumulated or
+    `flush_interval` seconds have passed, whichever comes first. Batches are
+    flushed to disk at the wrapped writer's checkpoints, rather than each
+    ending a compressed block of its own.
+
+    When the queue is full, `backpressure` decides what happens:
+    - 'block': the caller waits for the writer to catch up
+    - 'drop-oldest': the oldest queued record is discarded
+    - 'spill': the record is appended to a spill file in `spill_dir`, which is
+      copied into the current shard once the queue has drained. Spilled
+      records are therefore written out of order.
+
+    Its metrics are labelled with `output` (by default the name of the
+    writer's directory), as for ShardUploader.
+    """
+    def __init__(self, writer, queue_size=10000, flush_bytes=1 << 20, flush_interval=1.0,
+                 backpressure=BACKPRESSURE_BLOCK, spill_dir=None, metrics=None, output=None):
+        assert backpressure in BACKPRESSURE_POLICIES, \
+            "backpressure must be one of: {}".format(", ".join(BACKPRESSURE_POLICIES))
+        assert queue_size > 0, "queue_size must be greater than zero"
+        self._writer = writer
+        self._queue_size = queue_size
+        self._flush_bytes = flush_bytes
+        self._flush_interval = flush_interval
+        self._backpressure = backpressure
+        self._spill_dir = spill_dir or writer._directory
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._spill_lock = threading.Lock()
+        self._spill_file = None
+        self._spill_count = 0
+        self._num_dropped = 0
+        self._num_spilled = 0
+        self._error = None
+        self._thread = None
+        metrics = metrics or MetricsRegistry()
+        output = output or os.path.basename(os.path.normpath(writer._directory))
+        metrics.gauge('writer_queue_depth', "Records waiting for the background writer", labels=('output',))\
+            .labels(output, fn=lambda: self.queue_depth)
+        metrics.counter('writer_dropped_total', "Records dropped because the writer fell behind", labels=('output',))\
+            .labels(output, fn=lambda: self._num_dropped)
+        metrics.counter('writer_spilled_total', "Records spilled to disk because the writer fell behind", labels=('output',))\
+            .labels(output, fn=lambda: self._num_spilled)
+
+    @property
+    def num_dropped(self):
+        return self._num_dropped
+
+    @property
+    def num_spilled(self):
+        return self._num_spilled
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    @property
+    def current_filename(self):
+        return self._writer.current_filename
+
+    @property
+    def uploader(self):
+        return self._writer.uploader
+
+    def offload(self, storage, root=None, **kwargs):
+        self._writer.offload(storage, root=root, **kwargs)
+
+    def offload_to_s3(self, bucket, s3_root=None, **kwargs):
+        self._writer.offload_to_s3(bucket, s3_root=s3_root, **kwargs)
+
+    def convert_to_columnar(self, keep_json=True, **kwargs):
+        self._writer.convert_to_columnar(keep_json=keep_json, **kwargs)
+
+    def wrap_listener(self, wrap):
+        self._writer.wrap_listener(wrap)
+
+    def recover(self):
+        self._writer.recover()
+
+    def _check_error(self):
+        if self._error is not None:
+            six.reraise(*self._error)
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(name='shard_writer', target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _put_control(self, item):
+        with self._not_full:
+            self._queue.append(item)
+            self._not_empty.notify()
+
+    def write(self, data):
+        self._check_error()
+        with self._not_full:
+            if len(self._queue) >= self._queue_size:
+                if self._backpressure == BACKPRESSURE_BLOCK:
+                    while len(self._queue) >= self._queue_size:
+                        self._not_full.wait()
+                elif self._backpressure == BACKPRESSURE_DROP_OLDEST:
+                    self._drop_oldest()
+                else:
+                    self._spill(data)
+                    return
+            self._queue.append(data)
+            self._not_empty.notify()
+
+    def _drop_oldest(self):
+        # Control markers are never dropped; they're rare, so a linear scan
+        # past them is cheap.
+        for i, item in enumerate(self._queue):
+            if item is not _ROTATE and item is not _CLOSE:
+                del self._queue[i]
+                self._num_dropped += 1
+                return
+
+    def _spill_filename(self, n):
+        return os.path.join(self._spill_dir, ".spill-{}".format(n))
+
+    def _spill(self, data):
+        if isinstance(data, six.text_type):
+            data = data.encode("utf-8")
+        with self._spill_lock:
+            if self._spill_file is None:
+                if not os.path.exists(self._spill_dir):
+                    os.makedirs(self._spill_dir)
+                self._spill_count += 1
+                self._spill_file = open(self._spill_filename(self._spill_count), "wb", buffering=_BUFFER_SIZE)
+            self._spill_file.write(data)
+            self._num_spilled += 1
+
+    def _drain_spill(self):
+        with self._spill_lock:
+            if self._spill_file is None:
+                return
+            self._spill_file.close()
+            self._spill_file = None
+            filename = self._spill_filename(self._spill_count)
+        with open(filename, "rb") as f:
+            while True:
+                # Whole lines only, so that rotation never splits a record
+                lines = f.readlines(_BUFFER_SIZE)
+                if not lines:
+                    break
+                self._writer.write(b"".join(lines))
+        self._writer.flush()
+        os.remove(filename)
+
+    def next_shard(self):
+        self._check_error()
+        if self._thread is None:
+            # Nothing's been queued yet, so it's safe to open the first shard inline
+            self._writer.next_shard()
+            self._start()
+        else:
+            self._put_control(_ROTATE)
+
+    def _take(self, timeout):
+        with self._not_empty:
+            if not self._queue:
+                self._not_empty.wait(timeout)
+            items = list(self._queue)
+            self._queue.clear()
+            self._not_full.notify_all()
+        return items
+
+    def _run(self):
+        try:
+            pending = []
+            pending_bytes = 0
+            deadline = time.time() + self._flush_interval
+            while True:
+                items = self._take(max(0.0, deadline - time.time()))
+                for item in items:
+                    if item is _ROTATE or item is _CLOSE:
+                        self._commit(pending)
+                        pending = []
+                        pending_bytes = 0
+                        if item is _CLOSE:
+                            self._drain_spill()
+                            return
+                        self._writer.next_shard()
+                    else:
+                        pending.append(item)
+                        pending_bytes += len(item)
+                        if pending_bytes >= self._flush_bytes:
+                            self._commit(pending)
+                            pending = []
+                            pending_bytes = 0
+                if time.time() >= deadline:
+                    self._commit(pending)
+                    pending = []
+                    pending_bytes = 0
+                    if not self._queue:
+                        self._drain_spill()
+                    deadline = time.time() + self._flush_interval
+        except Exception:
+            _LOG.exception("Shard writer failed.")
+            self._error = sys.exc_info()
+            with self._not_full:
+                # Wake up any blocked producers so that they see the error
+                self._queue.clear()
+                self._not_full.notify_all()
+
+    def _commit(self, pending):
+        if pending:
+            self._writer.write(b"".join(item.encode("utf-8") if isinstance(item, six.text_type) else item
+                                        for item in pending))
+        self._writer.checkpoint()
+
+    def close(self):
+        if self._thread is not None:
+            if self._thread.is_alive():
+                self._put_control(_CLOSE)
+                self._thread.join()
+            self._thread = None
+        self._writer.close()
+        self._check_error()
+
+    def __enter__(self):
+        self.next_shard()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
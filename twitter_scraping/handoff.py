@@ -0,0 +1,313 @@
+import json
+import os
+import signal
+import threading
+import time
+
+from six.moves import queue, socketserver
+
+from .log import get_logger
+from .reconnect import ReconnectSupervisor
+
+_LOG = get_logger('handoff')
+
+# The filter parameters which can change without a restart
+FILTER_FIELDS = ('follow', 'track', 'locations', 'languages')
+_POLL_INTERVAL = 1.0
+# Handled by a pending connection itself, see _SharedListener
+_PENDING_CALLBACKS = ('on_connect', 'on_error', 'on_timeout', 'on_exception')
+
+
+class _SharedListener(object):
+    """
+    What one connection's stream calls: forwards to the listener shared by
+    every connection, holding `lock` so that only one connection's callback
+    runs at a time, and notes when the connection first delivers data.
+
+    A `pending` connection, opened for a handoff, only passes its data on
+    until it's `promote`d: its errors, timeouts and exceptions are logged
+    here and stop it, rather than opening gaps or sending alerts about the
+    stream which is still running, and its connect is held back until then.
+    """
+    def __init__(self, listener, lock, pending=False):
+        self._listener = listener
+        self._lock = lock
+        self.delivering = threading.Event()
+        self.pending = pending
+        self._connected = False
+
+    def promote(self):
+        """
+        Makes this the stream's connection, passing on its connect.
+        """
+        with self._lock:
+            self.pending = False
+            if self._connected:
+                self._listener.on_connect()
+
+    def _pending_on_connect(self):
+        self._connected = True
+
+    def _pending_on_error(self, status_code):
+        _LOG.error("New connection got error code {}; abandoning it.".format(status_code))
+        return False
+
+    def _pending_on_timeout(self):
+        _LOG.error("New connection timed out; abandoning it.")
+        return False
+
+    def _pending_on_exception(self, exception):
+        _LOG.error("New connection failed: {!r}".format(exception))
+
+    def __getattr__(self, name):
+        attr = getattr(self._listener, name)
+        if not callable(attr):
+            return attr
+        lock, delivering = self._lock, self.delivering
+        if name in _PENDING_CALLBACKS:
+            local = getattr(self, '_pending_' + name)
+
+            def call(*args, **kwargs):
+                with lock:
+                    if self.pending:
+                        return local(*args, **kwargs)
+                    return attr(*args, **kwargs)
+        elif name == 'on_data':
+            def call(*args, **kwargs):
+                with lock:
+                    ret = attr(*args, **kwargs)
+                delivering.set()
+                return ret
+        else:
+            def call(*args, **kwargs):
+                with lock:
+                    return attr(*args, **kwargs)
+        # Cached, so that later lookups skip __getattr__
+        setattr(self, name, call)
+        return call
+
+
+class _Connection(object):
+    def __init__(self, stream, listener, filters, max_reconnects):
+        self.stream = stream
+        self.listener = listener
+        self.filters = filters
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        supervisor = ReconnectSupervisor(lambda: stream.filter(**filters), listener, max_retries=max_reconnects)
+        self._thread = threading.Thread(name='stream', target=self._run, args=(supervisor,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, supervisor):
+        try:
+            self.result = supervisor.run()
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+    def close(self):
+        # The stream stops at its next message, which it drops
+        self.stream.disconnect()
+
+
+class ConnectionManager(object):
+    """
+    Runs the stream for `filters` (keyword arguments to filter()) on its own
+    thread, and replaces it when asked to `reload`: a connection with the
+    new filters is opened alongside the old one, and the old one is only
+    closed once the new one is delivering (or, if it doesn't within
+    `handoff_timeout` seconds, or fails first, the new one is abandoned). Both connections
+    feed the same `listener`, one message at a time, so its dedup index
+    absorbs the overlap and its shards, uploads and counters carry on.
+
+    `make_stream(listener)` creates a stream for each connection.
+    `load_filters()` re-reads the filters for a reload which doesn't name
+    them, e.g. from the config file.
+    """
+    def __init__(self, make_stream, listener, filters, load_filters=None, handoff_timeout=90.0, max_reconnects=None):
+        self._make_stream = make_stream
+        self._listener = listener
+        self._filters = dict(filters)
+        self._load_filters = load_filters
+        self._handoff_timeout = handoff_timeout
+        self._max_reconnects = max_reconnects
+        self._lock = threading.RLock()
+        self._requests = queue.Queue()
+        self._signalled = False
+        self.num_handoffs = 0
+
+    @property
+    def filters(self):
+        return dict(self._filters)
+
+    def reload(self, filters=None):
+        """
+        Asks for the stream to be reconnected with `filters` (any of
+        FILTER_FIELDS, the rest staying as they are), or with those from
+        `load_filters` if None.
+        """
+        self._requests.put(filters)
+
+    def reload_from_signal(self, signum=None, frame=None):
+        # Signal handlers can interrupt the main thread inside the queue's
+        # lock, so they only set a flag
+        self._signalled = True
+
+    def _connect(self, filters, pending=False):
+        listener = _SharedListener(self._listener, self._lock, pending=pending)
+        return _Connection(self._make_stream(listener), listener, filters, self._max_reconnects)
+
+    def _next_filters(self):
+        if self._signalled:
+            self._signalled = False
+            requested = None
+        else:
+            try:
+                requested = self._requests.get_nowait()
+            except queue.Empty:
+                return None
+        if requested is None:
+            if self._load_filters is None:
+                _LOG.warning("Reload requested, but there's no config file to reload from.")
+                return None
+            try:
+                requested = self._load_filters()
+            except Exception:
+                _LOG.exception("Failed to reload filters; keeping the current ones.")
+                return None
+        filters = dict(self._filters)
+        filters.update((k, v) for k, v in requested.items() if k in FILTER_FIELDS)
+        if filters == self._filters:
+            _LOG.info("Filters are unchanged; keeping the current connection.")
+            return None
+        return filters
+
+    def _handoff(self, current, filters):
+        _LOG.info("Opening a connection with new filters: {}".format(
+            json.dumps(dict((k, filters.get(k)) for k in FILTER_FIELDS))))
+        new = self._connect(filters, pending=True)
+        deadline = time.time() + self._handoff_timeout
+        while not new.listener.delivering.is_set() and not new.done.is_set() and time.time() < deadline:
+            new.listener.delivering.wait(0.1)
+        if new.done.is_set():
+            _LOG.error("New connection stopped; keeping the old filters.")
+            return current
+        if not new.listener.delivering.is_set():
+            _LOG.error("New connection didn't deliver within {:.0f}s; keeping the old filters.".format(self._handoff_timeout))
+            new.close()
+            return current
+        new.listener.promote()
+        current.close()
+        self._filters = filters
+        self.num_handoffs += 1
+        _LOG.info("Handed off to the new connection.")
+        return new
+
+    def run(self):
+        current = self._connect(self._filters)
+        while True:
+            if current.done.wait(_POLL_INTERVAL):
+                if current.error is not None:
+                    raise current.error
+                return current.result
+            filters = self._next_filters()
+            if filters is not None:
+                current = self._handoff(current, filters)
+
+
+class ConfigWatcher(object):
+    """
+    Calls `on_change` from a background thread whenever the modification
+    time of `path` changes, checking every `interval` seconds.
+    """
+    def __init__(self, path, on_change, interval=5.0):
+        self._path = path
+        self._on_change = on_change
+        self._interval = interval
+        self._mtime = self._read_mtime()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(name='config_watcher', target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read_mtime(self):
+        try:
+            return os.stat(self._path).st_mtime
+        except OSError:
+            return None
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            mtime = self._read_mtime()
+            if mtime is not None and mtime != self._mtime:
+                self._mtime = mtime
+                _LOG.info("Config file changed: {}".format(self._path))
+                self._on_change()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        manager = self.server.manager
+        for line in self.rfile:
+            command = line.decode('utf-8').strip()
+            if not command:
+                continue
+            if command == 'reload':
+                manager.reload()
+                reply = {'ok': True}
+            elif command == 'status':
+                reply = {'ok': True, 'filters': manager.filters, 'handoffs': manager.num_handoffs}
+            else:
+                try:
+                    filters = json.loads(command)
+                    if not isinstance(filters, dict):
+                        raise ValueError("expected an object")
+                    manager.reload(filters)
+                    reply = {'ok': True}
+                except ValueError as e:
+                    reply = {'ok': False, 'error': "expected 'reload', 'status' or a JSON object of filters ({})".format(e)}
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b"\n")
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Accepts commands for a ConnectionManager on the Unix socket at `path`,
+    one per line: `reload` (re-read the config file), `status`, or a JSON
+    object of new filters, e.g. {"track": ["a", "b"]}. Each gets a JSON reply.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, manager):
+        if os.path.exists(path):
+            os.remove(path)
+        socketserver.UnixStreamServer.__init__(self, path, _ControlHandler)
+        self.path = path
+        self.manager = manager
+        self._thread = threading.Thread(name='control_server', target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        _LOG.info("Listening for control commands on {}".format(path))
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def install_reload_signal(manager):
+    """
+    Reloads `manager` from its config on SIGHUP, where there is one. Only
+    works from the main thread.
+    """
+    if not hasattr(signal, 'SIGHUP') or threading.current_thread().name != 'MainThread':
+        return False
+    signal.signal(signal.SIGHUP, manager.reload_from_signal)
+    return True
@@ -0,0 +1,213 @@
+import calendar
+import json
+import six
+import time
+
+from six.moves.urllib.parse import quote, unquote
+
+from .shard_index import created_at_ms, record_id
+
+# Partition fields derived from when a tweet was created (in UTC)
+DATE = 'dt'
+HOUR = 'hour'
+TIME_FIELDS = (DATE, HOUR)
+# What Hive, Spark and Athena call the partition of records without a value
+MISSING_VALUE = "__HIVE_DEFAULT_PARTITION__"
+
+_DATE_FORMAT = "%Y-%m-%d"
+_CREATED_AT_FORMAT = "%a %b %d %H:%M:%S +0000 %Y"
+_HOUR_MS = 3600 * 1000
+_DAY_MS = 24 * _HOUR_MS
+# Beyond this many prefixes, listing the parent is cheaper than listing each
+_MAX_PREFIXES = 1000
+_MISSING = object()
+
+
+def _lookup(record, path):
+    for name in path:
+        if not isinstance(record, dict) or name not in record:
+            return _MISSING
+        record = record[name]
+    return record
+
+
+def encode_value(value):
+    """
+    A field's value as it appears in a partition directory name: strings as
+    they are and anything else in its JSON form, percent-encoded.
+    """
+    if value is _MISSING:
+        return MISSING_VALUE
+    if not isinstance(value, six.string_types):
+        value = json.dumps(value)
+    if six.PY2 and isinstance(value, six.text_type):
+        value = value.encode('utf-8')
+    return quote(value, safe="")
+
+
+def _created_at(record):
+    try:
+        return calendar.timegm(time.strptime(record['created_at'], _CREATED_AT_FORMAT)) * 1000
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class PartitionLayout(object):
+    """
+    Hive-style partition directories for records, one level per field of
+    `fields`, e.g. ['dt', 'hour', 'lang'] gives dt=2020-01-31/hour=07/lang=en.
+    'dt' and 'hour' are the UTC day and hour the tweet was created, read
+    from its snowflake id (or its created_at if it has no id); any other
+    field is a dotted path into the record, e.g. "user.lang".
+
+    Time fields are found without parsing records, but any other field means
+    each record is parsed once on its way to its partition.
+    """
+    def __init__(self, fields):
+        assert fields, "fields must not be empty"
+        self.fields = tuple(fields)
+        self._paths = [None if field in TIME_FIELDS else field.split(".") for field in self.fields]
+        self._needs_parse = any(path is not None for path in self._paths)
+        self._hour = None
+        self._hour_values = None
+
+    def _time_values(self, ms):
+        if ms is None:
+            return {DATE: MISSING_VALUE, HOUR: MISSING_VALUE}
+        hour = ms // _HOUR_MS
+        if hour != self._hour:
+            created = time.gmtime(hour * 3600)
+            self._hour = hour
+            self._hour_values = {DATE: time.strftime(_DATE_FORMAT, created), HOUR: time.strftime("%H", created)}
+        return self._hour_values
+
+    def partition(self, line):
+        """
+        The partition of a raw record, as a tuple of "field=value" directory
+        names.
+        """
+        record = None
+        if self._needs_parse:
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                record = None
+        times = None
+        ret = []
+        for field, path in zip(self.fields, self._paths):
+            if path is None:
+                if times is None:
+                    tweet_id = record_id(line)
+                    if tweet_id is not None:
+                        ms = created_at_ms(tweet_id)
+                    else:
+                        if record is None:
+                            try:
+                                record = json.loads(line.decode('utf-8'))
+                            except ValueError:
+                                pass
+                        ms = _created_at(record) if isinstance(record, dict) else None
+                    times = self._time_values(ms)
+                value = times[field]
+            else:
+                value = encode_value(_lookup(record, path))
+            ret.append("{}={}".format(field, value))
+        return tuple(ret)
+
+    def prefixes(self, record_filter):
+        """
+        The partition prefixes (ending in "/", or "" for everything) which
+        hold every record that could match `record_filter`, for listing only
+        those. Stops at the first field the filter doesn't pin down.
+        """
+        min_ms, max_ms = _time_bounds(record_filter)
+        allowed = _allowed_values(record_filter)
+        combos = [()]
+        for i, field in enumerate(self.fields):
+            if field == DATE and min_ms is not None and max_ms is not None:
+                first, last = min_ms // _DAY_MS, max_ms // _DAY_MS
+                if (last - first + 1) * len(combos) > _MAX_PREFIXES:
+                    break
+                days = [time.strftime(_DATE_FORMAT, time.gmtime(day * 86400)) for day in range(first, last + 1)]
+                expanded = [combo + (day,) for combo in combos for day in days]
+            elif field == HOUR and i > 0 and self.fields[i - 1] == DATE and len(combos[0]) == i \
+                    and min_ms is not None and max_ms is not None:
+                expanded = [combo + (hour,) for combo in combos for hour in _hours_of(combo[-1], min_ms, max_ms)]
+            elif field in allowed:
+                expanded = [combo + (encode_value(value),) for combo in combos for value in sorted(allowed[field])]
+            else:
+                break
+            if len(expanded) > _MAX_PREFIXES:
+                break
+            combos = expanded
+        return ["".join("{}={}/".format(field, value) for field, value in zip(self.fields, combo)) for combo in combos]
+
+
+def _time_bounds(record_filter):
+    min_ms = created_at_ms(record_filter.min_id) if record_filter.min_id is not None else None
+    max_ms = created_at_ms(record_filter.max_id) if record_filter.max_id is not None else None
+    return min_ms, max_ms
+
+
+def _allowed_values(record_filter):
+    # Field name to the set of values (in the JSON form used by `where`) a
+    # matching record can have
+    allowed = {}
+    if record_filter.languages is not None:
+        allowed['lang'] = set(record_filter.languages)
+    for path, value in record_filter.where:
+        field = ".".join(path)
+        allowed[field] = allowed[field] & {value} if field in allowed else {value}
+    return allowed
+
+
+def _day_start(day):
+    return calendar.timegm(time.strptime(day, _DATE_FORMAT)) * 1000
+
+
+def _hours_of(day, min_ms, max_ms):
+    start = _day_start(day)
+    return ["{:02d}".format(hour) for hour in range(24)
+            if start + (hour + 1) * _HOUR_MS > min_ms and start + hour * _HOUR_MS <= max_ms]
+
+
+def key_partitions(key):
+    """
+    The "field=value" directories in a key, as a dict of field to decoded
+    value (None for MISSING_VALUE).
+    """
+    ret = {}
+    for part in key.split("/")[:-1]:
+        field, sep, value = part.partition("=")
+        if sep and field:
+            ret[field] = None if value == MISSING_VALUE else unquote(value)
+    return ret
+
+
+def partition_may_match(partitions, record_filter):
+    """
+    Whether a shard in the partition described by `partitions` (see
+    key_partitions) could hold records matching `record_filter`.
+    """
+    min_ms, max_ms = _time_bounds(record_filter)
+    if min_ms is not None or max_ms is not None:
+        day = partitions.get(DATE, _MISSING)
+        hour = partitions.get(HOUR, _MISSING)
+        if day is None or hour is None:
+            # Records without an id never match id bounds
+            return False
+        if day is not _MISSING:
+            try:
+                start, length = _day_start(day), _DAY_MS
+                if hour is not _MISSING:
+                    start, length = start + int(hour) * _HOUR_MS, _HOUR_MS
+            except ValueError:
+                start = None
+            if start is not None and ((max_ms is not None and start > max_ms)
+                                      or (min_ms is not None and start + length <= min_ms)):
+                return False
+    for field, values in _allowed_values(record_filter).items():
+        value = partitions.get(field, _MISSING)
+        if value is not _MISSING and value not in values:
+            return False
+    return True
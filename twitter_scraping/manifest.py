@@ -0,0 +1,197 @@
+import json
+import os
+import re
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .log import get_logger
+
+_LOG = get_logger('manifest')
+
+OPEN = 'open'
+SEALED = 'sealed'
+UPLOADING = 'uploading'
+UPLOADED = 'uploaded'
+DISCARDED = 'discarded'
+# Replaced by a columnar copy
+CONVERTED = 'converted'
+# Replaced by a more compressed copy
+RECOMPRESSED = 'recompressed'
+
+
+class ManifestLocked(Exception):
+    pass
+
+
+def _read_log(path):
+    shards = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line may have been cut short by a crash
+                continue
+            shards.setdefault(entry['shard'], {}).update(entry)
+    return shards
+
+
+def open_shards(directory, filename="manifest.jsonl"):
+    """
+    The shards which the manifest in `directory` (if any) last saw open:
+    those of a run which is still going, or which crashed and hasn't been
+    recovered yet. Reads the log without taking it over.
+    """
+    path = os.path.join(directory, filename)
+    if not os.path.exists(path):
+        return []
+    return sorted(os.path.join(directory, e['shard']) for e in _read_log(path).values() if e['state'] == OPEN)
+
+
+class ShardManifest(object):
+    """
+    Write-ahead log of shard states, kept alongside the shards in `directory`.
+
+    Every line is a JSON object describing one shard at one point in time:
+    its state (open, sealed, uploading, uploaded or discarded), and the byte
+    offset and record count of the last point at which everything before it
+    was flushed to disk. Recovery only replays this log (and lists the
+    directory), so it never needs to read shard contents.
+
+    Shards are identified by their path relative to `directory`, so one
+    manifest can cover the subdirectories of a partitioned layout.
+
+    Only one manifest can be open on a directory at a time (where fcntl is
+    available): recovery would otherwise truncate and seal the shards another
+    run is still writing. ManifestLocked is raised if it's already in use.
+
+    Entries which wouldn't change anything aren't logged, and the log is
+    compacted to the latest entry per shard on opening and after every
+    `compact_every` lines logged.
+    """
+    def __init__(self, directory, filename="manifest.jsonl", fsync=False, compact_every=10000):
+        assert compact_every > 0, "compact_every must be greater than zero"
+        self._directory = directory
+        self._path = os.path.join(directory, filename)
+        self._fsync = fsync
+        self._compact_every = compact_every
+        self._appended = 0
+        self._lock = threading.Lock()
+        self._shards = {}
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock_file = self._acquire()
+        if os.path.exists(self._path):
+            self._shards = _read_log(self._path)
+        self._compact()
+        self._file = open(self._path, "a")
+
+    def _acquire(self):
+        if fcntl is None:
+            return None
+        lock_file = open("{}.lock".format(self._path), "a")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            raise ManifestLocked("{} is in use by another run.".format(self._directory))
+        return lock_file
+
+    def _compact(self):
+        # Rewrite the log so it holds only the latest entry for each shard
+        tmp_path = "{}.tmp".format(self._path)
+        with open(tmp_path, "w") as f:
+            for entry in sorted(self._shards.values(), key=lambda e: e['n']):
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            if self._fsync:
+                os.fsync(f.fileno())
+        os.rename(tmp_path, self._path)
+        self._appended = 0
+
+    def _shard(self, filename):
+        return os.path.relpath(filename, self._directory)
+
+    def get(self, filename):
+        return self._shards.get(self._shard(filename))
+
+    def record(self, filename, state, n=None, **fields):
+        shard = self._shard(filename)
+        with self._lock:
+            entry = self._shards.get(shard)
+            if entry is not None and entry['state'] == state and n in (None, entry['n']) \
+                    and all(entry.get(k) == v for k, v in fields.items()):
+                # e.g. a checkpoint with nothing written since the last one
+                return
+            entry = self._shards.setdefault(shard, {'shard': shard, 'n': n})
+            if n is not None:
+                entry['n'] = n
+            entry.update(fields)
+            entry['state'] = state
+            entry['time'] = time.time()
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            if self._fsync:
+                os.fsync(self._file.fileno())
+            self._appended += 1
+            if self._appended >= self._compact_every:
+                self._file.close()
+                self._compact()
+                self._file = open(self._path, "a")
+
+    def shards_in_state(self, *states):
+        return [os.path.join(self._directory, e['shard'])
+                for e in sorted(self._shards.values(), key=lambda e: e['n'])
+                if e['state'] in states]
+
+    def recover(self, template):
+        """
+        Brings the directory back to a consistent state after a crash and
+        returns the number of the last shard which was started. Shards which
+        were still open are truncated to their last flushed offset (dropping
+        any partially-written record) and sealed.
+        """
+        last = 0
+        for entry in list(self._shards.values()):
+            last = max(last, entry['n'] or 0)
+            if entry['state'] != OPEN:
+                continue
+            filename = os.path.join(self._directory, entry['shard'])
+            offset = entry.get('offset', 0)
+            records = entry.get('records', 0)
+            if not os.path.exists(filename) or records == 0:
+                if os.path.exists(filename):
+                    os.remove(filename)
+                _LOG.info("Discarding empty shard: {}".format(filename))
+                self.record(filename, DISCARDED)
+                continue
+            if os.path.getsize(filename) > offset:
+                _LOG.warning("Truncating partially-written shard {} to {}B ({:,} records).".format(filename, offset, records))
+                with open(filename, "r+b") as f:
+                    f.truncate(offset)
+            self.record(filename, SEALED)
+        # Shards from runs without a manifest shouldn't be overwritten either
+        prefix, _, suffix = template.partition("{n}")
+        pattern = re.compile(re.escape(prefix) + r"(\d+)" + re.escape(suffix))
+        subdirectories = set(os.path.dirname(shard) for shard in self._shards)
+        for subdirectory in subdirectories | {""}:
+            directory = os.path.join(self._directory, subdirectory)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                match = pattern.match(name)
+                if match is not None:
+                    last = max(last, int(match.group(1)))
+        return last
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            if self._lock_file is not None:
+                # Closing releases the lock
+                self._lock_file.close()
@@ -0,0 +1,333 @@
+import bisect
+import collections
+import json
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+
+from .log import get_logger
+
+_LOG = get_logger('metrics')
+
+RATE_WINDOWS = (('1m', 60), ('5m', 300), ('15m', 900))
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+
+class Counter(object):
+    """
+    Monotonically increasing count. Increments take an uncontended lock, so
+    they're cheap enough for the stream thread but safe from several threads
+    (e.g. upload workers) at once. If `fn` is given, the value is read from
+    it instead, for things which are already counted elsewhere.
+    """
+    kind = 'counter'
+
+    def __init__(self, fn=None):
+        self._value = 0
+        self._fn = fn
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        if self._fn is not None:
+            return self._fn()
+        return self._value
+
+
+class Gauge(Counter):
+    """
+    Value which can go up and down, either set directly or read from `fn`.
+    """
+    kind = 'gauge'
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = tuple(buckets)
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+            self._count += 1
+
+    @property
+    def value(self):
+        return self._count
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+        cumulative = []
+        running = 0
+        for bound, n in zip(self._buckets + (float('inf'),), counts):
+            running += n
+            cumulative.append((bound, running))
+        return {'buckets': cumulative, 'sum': total, 'count': count}
+
+
+class _Family(object):
+    def __init__(self, name, help, cls, label_names, **kwargs):
+        self.name = name
+        self.help = help
+        self.kind = cls.kind
+        self.label_names = tuple(label_names)
+        self._cls = cls
+        self._kwargs = kwargs
+        self._children = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if not self.label_names:
+            self._children[()] = cls(**kwargs)
+
+    def labels(self, *values, **kwargs):
+        """
+        The child for `values`, created with `kwargs` (e.g. its own `fn`)
+        on top of the family's if it doesn't exist yet.
+        """
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._cls(**dict(self._kwargs, **kwargs)))
+        if kwargs.get('fn') is not None and child._fn is not kwargs['fn']:
+            raise ValueError("{}{} is already registered with another fn".format(
+                self.name, _format_labels(tuple(zip(self.label_names, key)))))
+        return child
+
+    def children(self):
+        return [(tuple(zip(self.label_names, key)), child) for key, child in list(self._children.items())]
+
+
+class MetricsRegistry(object):
+    """
+    Collection of named metrics. A background thread samples every counter
+    every `sample_interval` seconds so that 1m/5m/15m rolling rates can be
+    computed without any extra work when the counter is incremented.
+    """
+    def __init__(self, sample_interval=5.0):
+        self._families = collections.OrderedDict()
+        self._sample_interval = sample_interval
+        max_samples = int(RATE_WINDOWS[-1][1] / sample_interval) + 2
+        self._samples = collections.deque(maxlen=max_samples)
+        self._start = time.time()
+        self._stop = threading.Event()
+        self._threads = []
+        self._server = None
+
+    def _add(self, name, help, cls, labels=(), fn=None, **kwargs):
+        # Metrics read from `fn` can only be registered once for each set of
+        # labels; registering the same name again would otherwise silently
+        # keep reporting the first one
+        family = self._families.get(name)
+        if family is None:
+            if fn is not None and not labels:
+                kwargs['fn'] = fn
+            family = self._families[name] = _Family(name, help, cls, labels, **kwargs)
+        elif family.kind != cls.kind or family.label_names != tuple(labels):
+            raise ValueError("{} is already registered as a {} with labels {}".format(
+                name, family.kind, family.label_names))
+        if labels:
+            if fn is not None:
+                raise ValueError("Give each child of {} its fn with labels(..., fn=fn)".format(name))
+            return family
+        return family.labels(fn=fn) if fn is not None else family.labels()
+
+    def counter(self, name, help, labels=(), fn=None):
+        return self._add(name, help, Counter, labels, fn=fn)
+
+    def gauge(self, name, help, labels=(), fn=None):
+        return self._add(name, help, Gauge, labels, fn=fn)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(name, help, Histogram, labels, buckets=buckets)
+
+    def get(self, name):
+        family = self._families.get(name)
+        return family.labels() if family is not None and not family.label_names else family
+
+    def totals(self):
+        """
+        Returns {name: (kind, help, value)} for every metric, summing over
+        labels. Histograms report their number of observations.
+        """
+        return dict((family.name, (family.kind, family.help, sum(child.value for _, child in family.children())))
+                    for family in list(self._families.values()))
+
+    def _counter_values(self):
+        values = {}
+        for family in list(self._families.values()):
+            if family.kind == 'gauge':
+                continue
+            for labels, child in family.children():
+                values[(family.name, labels)] = child.value
+        return values
+
+    def sample(self):
+        self._samples.append((time.time(), self._counter_values()))
+
+    def rates(self, name, labels=()):
+        """
+        Per-second rate of a counter over each rolling window, measured from
+        the oldest sample inside the window up to now. Windows which haven't
+        been fully observed yet cover the time since the first sample.
+        """
+        ret = {}
+        family = self._families.get(name)
+        if family is None:
+            return ret
+        key = (name, labels)
+        now = time.time()
+        current = dict(family.children()).get(labels)
+        current = current.value if current is not None else 0
+        for window_name, seconds in RATE_WINDOWS:
+            oldest = None
+            for t, values in list(self._samples):
+                if now - t <= seconds + self._sample_interval / 2.0:
+                    oldest = (t, values)
+                    break
+            if oldest is None or oldest[0] >= now:
+                ret[window_name] = None
+                continue
+            ret[window_name] = (current - oldest[1].get(key, 0)) / (now - oldest[0])
+        return ret
+
+    def snapshot(self):
+        metrics = collections.OrderedDict()
+        for family in list(self._families.values()):
+            entries = []
+            for labels, child in family.children():
+                entry = {'labels': dict(labels)}
+                if family.kind == 'histogram':
+                    entry.update(child.snapshot())
+                    entry['buckets'] = [[str(b), n] for b, n in entry['buckets']]
+                else:
+                    entry['value'] = child.value
+                    if family.kind == 'counter':
+                        entry['rates'] = self.rates(family.name, labels)
+                entries.append(entry)
+            metrics[family.name] = {'type': family.kind, 'help': family.help, 'values': entries}
+        return {'time': time.time(), 'uptime': time.time() - self._start, 'metrics': metrics}
+
+    def render_prometheus(self):
+        lines = []
+        for family in list(self._families.values()):
+            lines.append("# HELP {} {}".format(family.name, family.help))
+            lines.append("# TYPE {} {}".format(family.name, family.kind))
+            for labels, child in family.children():
+                if family.kind == 'histogram':
+                    snapshot = child.snapshot()
+                    for bound, n in snapshot['buckets']:
+                        le = "+Inf" if bound == float('inf') else repr(bound)
+                        lines.append("{}_bucket{} {}".format(family.name, _format_labels(labels + (('le', le),)), n))
+                    lines.append("{}_sum{} {}".format(family.name, _format_labels(labels), snapshot['sum']))
+                    lines.append("{}_count{} {}".format(family.name, _format_labels(labels), snapshot['count']))
+                else:
+                    lines.append("{}{} {}".format(family.name, _format_labels(labels), child.value))
+            if family.kind == 'counter':
+                rate_name = "{}_rate".format(family.name)
+                lines.append("# HELP {} Per-second rate of {} over a rolling window".format(rate_name, family.name))
+                lines.append("# TYPE {} gauge".format(rate_name))
+                for labels, _ in family.children():
+                    for window, rate in sorted(self.rates(family.name, labels).items()):
+                        if rate is not None:
+                            lines.append("{}{} {}".format(rate_name, _format_labels(labels + (('window', window),)), rate))
+        return "\n".join(lines) + "\n"
+
+    def _run_sampler(self):
+        while not self._stop.wait(self._sample_interval):
+            self.sample()
+
+    def _run_snapshots(self, path, interval):
+        while not self._stop.wait(interval):
+            try:
+                with open(path, "a") as f:
+                    f.write(json.dumps(self.snapshot()) + "\n")
+            except (IOError, OSError):
+                _LOG.exception("Failed to write metrics snapshot to {}".format(path))
+
+    def _spawn(self, name, target, *args):
+        thread = threading.Thread(name=name, target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def start(self, port=None, host='127.0.0.1', snapshot_path=None, snapshot_interval=60.0):
+        """
+        Starts sampling, and optionally serves metrics over HTTP on `port`
+        (Prometheus text at /metrics, JSON at /metrics.json) and appends a
+        JSON snapshot to `snapshot_path` every `snapshot_interval` seconds.
+        """
+        self.sample()
+        self._spawn('metrics_sampler', self._run_sampler)
+        if snapshot_path is not None:
+            self._spawn('metrics_snapshots', self._run_snapshots, snapshot_path, snapshot_interval)
+        if port is not None:
+            self._server = _MetricsServer((host, port), self)
+            self._spawn('metrics_server', self._server.serve_forever)
+            _LOG.info("Serving metrics on http://{}:{}/metrics".format(host, self._server.server_address[1]))
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        _LOG.debug(format, *args)
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path in ('/', '/metrics'):
+            body = self.server.registry.render_prometheus().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif path == '/metrics.json':
+            body = json.dumps(self.server.registry.snapshot()).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _MetricsServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, registry):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _MetricsHandler)
+        self.registry = registry
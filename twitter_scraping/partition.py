@@ -0,0 +1,219 @@
+import copy
+import multiprocessing
+import os
+import threading
+import time
+
+from six.moves import queue
+
+from .dedup import SharedIdSet
+from .email import DummyEmailer
+from .log import get_logger
+from .metrics import MetricsRegistry
+
+_LOG = get_logger('partition')
+
+
+def partition_filters(n, follow=None, track=None, locations=None):
+    """
+    Splits the stream filters into at most `n` groups, dealing users, terms
+    and bounding boxes (four coordinates each) out in turn so that every
+    group gets a similar number of them. Empty filters are None.
+    """
+    items = [('follow', f) for f in follow or []] \
+        + [('track', t) for t in track or []] \
+        + [('locations', list(locations[i:i + 4])) for i in range(0, len(locations or []), 4)]
+    n = max(1, min(n, len(items)))
+    parts = [{'follow': [], 'track': [], 'locations': []} for _ in range(n)]
+    for i, (key, value) in enumerate(items):
+        if key == 'locations':
+            parts[i % n][key].extend(value)
+        else:
+            parts[i % n][key].append(value)
+    return [dict((k, v or None) for k, v in part.items()) for part in parts]
+
+
+def _run_worker(builder, index, filters, output_dir, dedup, stats_queue, stats_interval):
+    listeners = []
+    listener_class = builder._listener_class
+
+    def make_listener(*args, **kwargs):
+        listener = listener_class(*args, **kwargs)
+        listeners.append(listener)
+        return listener
+
+    # Notifications, metrics endpoints and dedup snapshots are the
+    # supervisor's job
+    builder.ignore_none(False)\
+           .workers(1)\
+           .follow(filters['follow'])\
+           .track(filters['track'])\
+           .locations(filters['locations'])\
+           .output_dir(os.path.join(output_dir, "worker-{}".format(index)))\
+           .emailer(DummyEmailer())\
+           .metrics_port(None)\
+           .metrics_snapshot(None)\
+           .dedup_index(dedup)\
+           .dedup_snapshot(None)\
+           .listener_class(make_listener)
+    stop = threading.Event()
+
+    def report():
+        while not stop.wait(stats_interval):
+            if listeners:
+                stats_queue.put((index, listeners[0].metrics.totals()))
+
+    reporter = threading.Thread(name='worker_stats', target=report)
+    reporter.daemon = True
+    reporter.start()
+    try:
+        with builder.build():
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        if listeners:
+            stats_queue.put((index, listeners[0].metrics.totals()))
+
+
+class Supervisor(object):
+    """
+    Runs the scraper configured by `builder` as `num_workers` processes, each
+    with its own stream connection for a share of the filters and its own
+    shard sequence under `<output_dir>/worker-<n>`. The workers share a
+    SharedIdSet of `dedup_capacity` slots, so a tweet matched by several
+    partitions is only written once.
+
+    Workers report their metrics every `stats_interval` seconds; the totals
+    are served and snapshotted according to the builder's metrics options,
+    and logged (or emailed, per `notify_seconds`) from here. Workers which die
+    are restarted after `restart_delay` seconds.
+    """
+    def __init__(self, builder, num_workers, dedup_capacity=1 << 20, stats_interval=10.0, restart_delay=5.0):
+        self._builder = builder
+        self._partitions = partition_filters(num_workers, builder._follow, builder._track, builder._locations)
+        if len(self._partitions) < num_workers:
+            _LOG.warning("Only {} filters to split; running {} workers.".format(len(self._partitions), len(self._partitions)))
+        self._output_dir = builder._output_dir
+        self._emailer = builder._emailer or DummyEmailer()
+        self._stats_interval = stats_interval
+        self._restart_delay = restart_delay
+        self._dedup = self._load_dedup(builder._dedup_snapshot, dedup_capacity)
+        self._stats_queue = multiprocessing.Queue()
+        self._processes = {}
+        self._stats = {}
+        self._restarts = {}
+        self._stopping = False
+        self._metrics = MetricsRegistry()
+        self._metrics.gauge('workers_alive', "Worker processes currently running",
+                            fn=lambda: sum(1 for p in self._processes.values() if p.is_alive()))
+        self._restarts_counter = self._metrics.counter('worker_restarts_total', "Worker processes restarted after dying")
+
+    def _load_dedup(self, snapshot, capacity):
+        if snapshot is not None and os.path.exists(snapshot):
+            try:
+                ret = SharedIdSet.load(snapshot, capacity=capacity)
+                _LOG.info("Loaded {:,} ids from dedup snapshot: {}".format(len(ret), snapshot))
+                return ret
+            except ValueError as e:
+                _LOG.warning("Ignoring dedup snapshot {}: {}".format(snapshot, e))
+        return SharedIdSet(capacity=capacity)
+
+    def _worker_builder(self):
+        # Workers are handed the options, which (unlike the emailer and its
+        # dispatcher thread) can be pickled when processes are spawned
+        # rather than forked; they send no notifications anyway
+        builder = copy.copy(self._builder)
+        builder._emailer = None
+        return builder
+
+    def _start_worker(self, index):
+        process = multiprocessing.Process(
+            name='scraper_worker_{}'.format(index),
+            target=_run_worker,
+            args=(self._worker_builder(), index, self._partitions[index], self._output_dir,
+                  self._dedup, self._stats_queue, self._stats_interval))
+        process.start()
+        self._processes[index] = process
+        _LOG.info("Started worker {} (pid {}) for {}".format(index, process.pid, self._partitions[index]))
+
+    def _total(self, name):
+        return sum(stats[name][2] for stats in self._stats.values() if name in stats)
+
+    def _update_stats(self, index, totals):
+        for name, (kind, help, _) in totals.items():
+            if self._metrics.get(name) is None:
+                register = self._metrics.gauge if kind == 'gauge' else self._metrics.counter
+                register(name, "{} (all workers)".format(help), fn=lambda name=name: self._total(name))
+        self._stats[index] = totals
+
+    def _drain_stats(self, timeout):
+        try:
+            index, totals = self._stats_queue.get(timeout=timeout)
+            self._update_stats(index, totals)
+            while True:
+                index, totals = self._stats_queue.get_nowait()
+                self._update_stats(index, totals)
+        except queue.Empty:
+            pass
+
+    def summary(self):
+        written = self._total('tweets_written_total')
+        rates = self._metrics.rates('tweets_written_total')
+        return "{} workers: {:,} tweets received, {:,} written, {:,} duplicates dropped; {:,.0f} tweets/min over the last 5 minutes.".format(
+            sum(1 for p in self._processes.values() if p.is_alive()),
+            self._total('tweets_received_total'), written, self._total('dedup_hits_total'),
+            (rates.get('5m') or 0) * 60)
+
+    def _check_workers(self):
+        now = time.time()
+        for index, process in list(self._processes.items()):
+            if process.is_alive() or process.exitcode == 0:
+                continue
+            restart_at = self._restarts.get(index)
+            if restart_at is None:
+                message = "Worker {} died with exit code {}; restarting in {:.0f}s.".format(index, process.exitcode, self._restart_delay)
+                _LOG.error(message)
+                self._emailer.send_text(message=message, subject="[ERROR] {default_subject}")
+                self._restarts[index] = now + self._restart_delay
+            elif now >= restart_at and not self._stopping:
+                del self._restarts[index]
+                self._restarts_counter.inc()
+                self._start_worker(index)
+
+    def run(self):
+        builder = self._builder
+        self._metrics.start(port=builder._metrics_port, snapshot_path=builder._metrics_snapshot,
+                            snapshot_interval=builder._metrics_snapshot_interval)
+        for index in range(len(self._partitions)):
+            self._start_worker(index)
+        last_log = last_notification = time.time()
+        try:
+            while any(p.is_alive() for p in self._processes.values()) or self._restarts:
+                self._drain_stats(1.0)
+                self._check_workers()
+                now = time.time()
+                if builder._notify_seconds is not None and now - last_notification >= builder._notify_seconds:
+                    self._emailer.send_text(message=self.summary())
+                    last_notification = now
+                if now - last_log >= 3600:
+                    _LOG.info(self.summary())
+                    last_log = now
+        except KeyboardInterrupt:
+            # Workers get the interrupt too; wait for them to finish up
+            self._stopping = True
+            self._restarts = {}
+        finally:
+            self.close()
+
+    def close(self):
+        self._stopping = True
+        for process in self._processes.values():
+            process.join()
+        self._drain_stats(0.1)
+        _LOG.info(self.summary())
+        self._metrics.close()
+        if self._builder._dedup_snapshot is not None:
+            _LOG.info("Saving dedup snapshot: {}".format(self._builder._dedup_snapshot))
+            self._dedup.save(self._builder._dedup_snapshot)
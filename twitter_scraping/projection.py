@@ -0,0 +1,169 @@
+import json
+import operator
+import re
+import six
+
+from .metrics import Counter
+
+# Always kept, so that shards stay indexable and deduplicable
+_ID_FIELDS = ('id', 'id_str')
+_MISSING = object()
+# Missing fields and nulls never satisfy these
+_ORDERINGS = {
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+}
+OPERATORS = ('eq', 'ne', 'in', 'not_in', 'regex', 'exists') + tuple(sorted(_ORDERINGS))
+
+
+def _getter(path):
+    names = path.split(".")
+    if len(names) == 1:
+        name = names[0]
+        return lambda record: record.get(name, _MISSING)
+
+    def get(record):
+        for name in names:
+            if not isinstance(record, dict):
+                return _MISSING
+            record = record.get(name, _MISSING)
+            if record is _MISSING:
+                break
+        return record
+    return get
+
+
+def _test(op, value):
+    # Returns a function of a field's value (or _MISSING) for the operator
+    if op == 'eq':
+        return lambda v: v is not _MISSING and v == value
+    if op == 'ne':
+        return lambda v: v is _MISSING or v != value
+    if op in ('in', 'not_in'):
+        if not isinstance(value, list):
+            raise ValueError("'{}' needs a list of values".format(op))
+        values = frozenset(value)
+        if op == 'in':
+            return lambda v: v is not _MISSING and v in values
+        return lambda v: v is _MISSING or v not in values
+    if op == 'regex':
+        search = re.compile(value).search
+        return lambda v: isinstance(v, six.string_types) and search(v) is not None
+    if op == 'exists':
+        if value:
+            return lambda v: v is not _MISSING
+        return lambda v: v is _MISSING
+    if op in _ORDERINGS:
+        compare = _ORDERINGS[op]
+
+        def ordered(v):
+            try:
+                return v is not _MISSING and v is not None and compare(v, value)
+            except TypeError:
+                return False
+        return ordered
+    raise ValueError("Unknown operator '{}' (expected one of: {})".format(op, ", ".join(OPERATORS)))
+
+
+def compile_predicate(spec):
+    """
+    Compiles a predicate of the form {"field": <dotted path>, <operator>:
+    <value>[, "name": <label for stats>]} into (name, function of a record).
+    """
+    spec = dict(spec)
+    name = spec.pop('name', None)
+    if 'field' not in spec:
+        raise ValueError("Predicate needs a 'field': {}".format(json.dumps(spec)))
+    field = spec.pop('field')
+    if len(spec) != 1:
+        raise ValueError("Predicate on {} needs exactly one operator (one of: {})".format(field, ", ".join(OPERATORS)))
+    (op, value), = spec.items()
+    get = _getter(field)
+    test = _test(op, value)
+    return name or "{} {} {}".format(field, op, json.dumps(value)), lambda record: test(get(record))
+
+
+def _path_tree(paths):
+    # {"user": {"id_str": True}, "text": True}; True means the whole value
+    tree = {}
+    for path in paths:
+        names = path.split(".")
+        node = tree
+        for name in names[:-1]:
+            child = node.setdefault(name, {})
+            if child is True:
+                break
+            node = child
+        else:
+            node[names[-1]] = True
+    return tree
+
+
+def _keep(value, tree):
+    if isinstance(value, list):
+        return [_keep(v, tree) for v in value]
+    if not isinstance(value, dict):
+        return value
+    ret = {}
+    # In the record's order, so that ids stay ahead of nested objects
+    for name, v in value.items():
+        sub = tree.get(name)
+        if sub is True:
+            ret[name] = v
+        elif sub is not None:
+            ret[name] = _keep(v, sub)
+    return ret
+
+
+def _drop(value, tree):
+    if isinstance(value, list):
+        return [_drop(v, tree) for v in value]
+    if not isinstance(value, dict):
+        return value
+    ret = {}
+    for name, v in value.items():
+        sub = tree.get(name)
+        if sub is None:
+            ret[name] = v
+        elif sub is not True:
+            ret[name] = _drop(v, sub)
+    return ret
+
+
+class RecordSelector(object):
+    """
+    Decides which statuses get written, and which parts of them. Calling it
+    with a parsed status returns what should be written, or None.
+
+    `predicates` (see `compile_predicate`) must all hold, and are tried in
+    order; every record rejected is counted against the first predicate
+    which failed, in `dropped` (a labelled counter family, if given). Then
+    only the `keep` paths are kept, if any, and the `drop` paths removed.
+    Paths are dotted and reach into lists of objects ("entities.hashtags.text").
+    The status' id and id_str are always kept.
+    """
+    def __init__(self, keep=None, drop=None, predicates=None, dropped=None):
+        self._predicates = []
+        for spec in predicates or []:
+            name, test = compile_predicate(spec)
+            counter = dropped.labels(name) if dropped is not None else Counter()
+            self._predicates.append((name, test, counter))
+        self._keep = _path_tree(list(keep) + list(_ID_FIELDS)) if keep else None
+        self._drop = _path_tree(p for p in drop if p not in _ID_FIELDS) if drop else None
+
+    @property
+    def dropped(self):
+        return dict((name, counter.value) for name, _, counter in self._predicates)
+
+    def __call__(self, record):
+        for _, test, counter in self._predicates:
+            if not test(record):
+                counter.inc()
+                return None
+        if self._keep is not None:
+            record = _keep(record, self._keep)
+        if self._drop is not None:
+            record = _drop(record, self._drop)
+        return record
@@ -0,0 +1,200 @@
+import os
+import threading
+import time
+
+from .compression import get_codec
+from .file_utils import sidecars_for
+from .log import get_logger
+from .metrics import MetricsRegistry
+
+_LOG = get_logger('quota')
+
+RECOMPRESS = 'recompress'
+SAMPLE = 'sample'
+PAUSE = 'pause'
+QUOTA_POLICIES = (RECOMPRESS, SAMPLE, PAUSE)
+
+OK = 'ok'
+SOFT = 'soft'
+HARD = 'hard'
+LEVELS = (OK, SOFT, HARD)
+
+# Shard states, as reported by ShardUploader.pending; everything else in the
+# directory (open shards, sidecars of other outputs, logs) counts as active
+PENDING_STATES = ('queued', 'uploading', 'failed')
+STATES = PENDING_STATES + ('active',)
+
+# Recompression trades CPU for space, but still has to keep up with the stream
+_AGGRESSIVE_LEVELS = {'gzip': 9, 'zstd': 12}
+_RETRY_FAILED_INTERVAL = 300.0
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        # Uploaded and deleted since it was listed
+        return 0
+
+
+def aggressive_codec(name):
+    """
+    The codec called `name`, at the level used for recompressing.
+    """
+    return get_codec(name, level=_AGGRESSIVE_LEVELS.get(name))
+
+
+def directory_size(directory):
+    total = 0
+    for dirpath, _, filenames in os.walk(directory):
+        for name in filenames:
+            total += _size(os.path.join(dirpath, name))
+    return total
+
+
+class DiskQuota(object):
+    """
+    Keeps `directory` within `budget` bytes. Every `interval` seconds it
+    totals the directory, and how much of it is shards which `uploaders`
+    (ShardUploaders) have still to upload, and compares that with the `soft`
+    and `hard` watermarks (fractions of the budget). Over the soft one,
+    `soft_policy` applies; over the hard one, `hard_policy` does as well:
+
+    - 'recompress': waiting shards are rewritten with `codec` (by default
+      gzip at its highest level), if they were stored less compactly
+    - 'sample': `sample_rate` caps the rate the listener's sampler keeps
+      statuses at (see sampling.HashSampler)
+    - 'pause': no statuses are written
+
+    Failed uploads are retried every five minutes, rather than left on disk
+    for the next run. `on_change(level, previous)` is called from
+    the checking thread whenever the level (OK, SOFT or HARD) changes.
+    """
+    def __init__(self, directory, budget, uploaders=None, soft=0.8, hard=0.95, soft_policy=RECOMPRESS,
+                 hard_policy=PAUSE, sample_rate=0.1, codec=None, on_change=None, interval=5.0, metrics=None):
+        assert budget > 0, "budget must be greater than zero"
+        assert 0 < soft <= hard, "watermarks must satisfy 0 < soft <= hard"
+        assert soft_policy in QUOTA_POLICIES and hard_policy in QUOTA_POLICIES, \
+            "policies must be one of: {}".format(", ".join(QUOTA_POLICIES))
+        assert 0 < sample_rate <= 1, "sample_rate must be in (0, 1]"
+        self._directory = directory
+        self._budget = budget
+        self._uploaders = list(uploaders or [])
+        self._soft = soft
+        self._hard = hard
+        self._soft_policy = soft_policy
+        self._hard_policy = hard_policy
+        self._sample = sample_rate
+        self._codec = codec or aggressive_codec('gzip')
+        self._on_change = on_change
+        self._interval = interval
+        self._last_retry = 0.0
+        self._paused = False
+        self._sample_rate = 1.0
+        self.level = OK
+        self.usage = dict.fromkeys(STATES + ('total',), 0)
+        metrics = metrics or MetricsRegistry()
+        self._usage_bytes = metrics.gauge('disk_usage_bytes', "Bytes in the output directory, by shard state", labels=('state',))
+        metrics.gauge('disk_budget_bytes', "Bytes the output directory is allowed", fn=lambda: self._budget)
+        metrics.gauge('disk_quota_level', "0 under the soft watermark, 1 over it, 2 over the hard watermark",
+                      fn=lambda: LEVELS.index(self.level))
+        self._saved = metrics.counter('disk_recompressed_bytes_saved_total', "Bytes freed by recompressing shards waiting to be uploaded")
+        self._stop = threading.Event()
+        self._thread = threading.Thread(name='disk_quota', target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def paused(self):
+        return self._paused
+
+    @property
+    def sample_rate(self):
+        """
+        The most statuses may be sampled at, 1.0 unless sampling is a policy
+        currently being applied.
+        """
+        return self._sample_rate
+
+    @property
+    def policies(self):
+        """
+        The policies currently being applied.
+        """
+        if self.level == HARD:
+            return tuple(sorted({self._soft_policy, self._hard_policy}, key=QUOTA_POLICIES.index))
+        if self.level == SOFT:
+            return (self._soft_policy,)
+        return ()
+
+    def check(self):
+        total = directory_size(self._directory)
+        usage = dict.fromkeys(PENDING_STATES, 0)
+        for uploader in self._uploaders:
+            for state, filenames in uploader.pending().items():
+                usage[state] += sum(_size(f) + sum(_size(s) for s in sidecars_for(f)) for f in filenames)
+        usage['active'] = max(0, total - sum(usage.values()))
+        usage['total'] = total
+        self.usage = usage
+        for state in STATES:
+            self._usage_bytes.labels(state).set(usage[state])
+
+        previous = self.level
+        if total >= self._hard * self._budget:
+            self.level = HARD
+        elif total >= self._soft * self._budget:
+            self.level = SOFT
+        else:
+            self.level = OK
+        policies = self.policies
+        self._sample_rate = self._sample if SAMPLE in policies else 1.0
+        # Told of a change while paused, so that the gap it leaves covers
+        # every tweet which was shed
+        paused = PAUSE in policies
+        if not paused:
+            self._paused = False
+        if self.level != previous:
+            _LOG.warning(self.describe())
+            if self._on_change is not None:
+                self._on_change(self.level, previous)
+        self._paused = paused
+        if RECOMPRESS in policies:
+            saved = sum(uploader.recompress_pending(self._codec) for uploader in self._uploaders)
+            if saved:
+                self._saved.inc(saved)
+                _LOG.info("Recompressing shards waiting to be uploaded saved {:,}B.".format(saved))
+        now = time.time()
+        if now - self._last_retry >= _RETRY_FAILED_INTERVAL:
+            self._last_retry = now
+            retried = sum(uploader.retry_failed() for uploader in self._uploaders)
+            if retried:
+                _LOG.info("Retrying {:,} shards which failed to upload.".format(retried))
+
+    def describe(self):
+        usage = self.usage
+        message = "Disk usage: {:,}B of a {:,}B budget ({:.0%}); {:,}B queued for upload, {:,}B uploading, {:,}B failed to upload.".format(
+            usage['total'], self._budget, usage['total'] / float(self._budget),
+            usage['queued'], usage['uploading'], usage['failed'])
+        if self.level != OK:
+            message += " Over the {} watermark: {}.".format(self.level, ", ".join(self.describe_policy(p) for p in self.policies))
+        return message
+
+    def describe_policy(self, policy):
+        if policy == RECOMPRESS:
+            return "recompressing shards waiting to be uploaded"
+        if policy == SAMPLE:
+            return "keeping {:.0%} of tweets".format(self._sample)
+        return "not writing any tweets"
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception:
+                _LOG.exception("Failed to check disk usage")
+            if self._stop.wait(self._interval):
+                return
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
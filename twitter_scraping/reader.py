@@ -0,0 +1,355 @@
+import fnmatch
+import json
+import multiprocessing
+import os
+import re
+import six
+
+from six.moves import queue
+
+from .compression import codec_for_filename
+from .file_utils import SIDECAR_EXTENSIONS
+from .layout import key_partitions, partition_may_match
+from .log import get_logger
+from .shard_index import ShardReader, first_id_at, index_filename, read_summary, record_id
+
+_LOG = get_logger('reader')
+
+DEFAULT_PATTERN = "tweets-shard-*.json*"
+
+_CHUNK_SIZE = 1 << 20
+# Uploads and index writes in progress
+_NOT_SHARDS = tuple(SIDECAR_EXTENSIONS) + ('.part', '.tmp')
+_SHARD_NUMBER_RE = re.compile(r'(\d+)\.json')
+# Characters which JSON serializers don't escape, so a value made up only of
+# these appears verbatim in the raw bytes of any record holding it. The one
+# exception is "/", which may be written as "\/" (Twitter does), so values
+# holding it are searched for in both forms.
+_LITERAL_RE = re.compile(r'^[A-Za-z0-9 _.:/@#+-]+$')
+_MISSING = object()
+
+_BATCH = 'batch'
+_SHARD_DONE = 'shard_done'
+_ERROR = 'error'
+_EXIT = 'exit'
+
+
+def _lookup(record, path):
+    for name in path:
+        if not isinstance(record, dict) or name not in record:
+            return _MISSING
+        record = record[name]
+    return record
+
+
+def _raw_forms(value):
+    # The ways `value` (matching _LITERAL_RE) can appear in raw JSON
+    raw = value.encode('utf-8')
+    if b"/" not in raw:
+        return (raw,)
+    return (raw, raw.replace(b"/", b"\\/"))
+
+
+def _equals(actual, expected):
+    if actual is _MISSING:
+        return False
+    if isinstance(actual, six.string_types):
+        return actual == expected
+    return json.dumps(actual) == expected
+
+
+class RecordFilter(object):
+    """
+    Which records to read. Ids are inclusive bounds, and times are seconds
+    since the epoch, [since, until), judged by the tweet ids (which agree
+    with created_at). `languages` are matched against the tweet's `lang`,
+    and `where` maps dotted field paths (e.g. "user.screen_name") to values
+    the field must equal; fields which aren't strings are compared in their
+    JSON form ("true", "42").
+
+    `accepts_raw` rejects records on their raw bytes, before they're parsed:
+    by id, and by whether every value being matched appears in them at all.
+    `accepts` is the exact test, on parsed records.
+    """
+    def __init__(self, min_id=None, max_id=None, since=None, until=None, languages=None, where=None):
+        lower = [x for x in (min_id, None if since is None else first_id_at(int(since * 1000))) if x is not None]
+        upper = [x for x in (max_id, None if until is None else first_id_at(int(until * 1000)) - 1) if x is not None]
+        self.min_id = max(lower) if lower else None
+        self.max_id = min(upper) if upper else None
+        self.languages = set(languages) if languages else None
+        self.where = [(path.split("."), str(value)) for path, value in sorted((where or {}).items())]
+        # Each group holds byte strings at least one of which must appear
+        self._needles = []
+        if self.languages is not None and all(_LITERAL_RE.match(l) for l in self.languages):
+            self._needles.append(tuple(form for l in self.languages for form in _raw_forms(json.dumps(l))))
+        for _, value in self.where:
+            if _LITERAL_RE.match(value):
+                self._needles.append(_raw_forms(value))
+
+    @property
+    def has_id_bounds(self):
+        return self.min_id is not None or self.max_id is not None
+
+    @property
+    def needs_parse(self):
+        return self.languages is not None or bool(self.where)
+
+    def overlaps(self, summary):
+        """
+        Whether a shard described by `summary` (see shard_index.read_summary)
+        could hold matching records.
+        """
+        if summary['records'] == 0:
+            return False
+        if self.min_id is not None and summary['max_id'] < self.min_id:
+            return False
+        if self.max_id is not None and summary['min_id'] > self.max_id:
+            return False
+        return True
+
+    def _in_bounds(self, tweet_id):
+        return (self.min_id is None or tweet_id >= self.min_id) and (self.max_id is None or tweet_id <= self.max_id)
+
+    def accepts_raw(self, line):
+        if self.has_id_bounds:
+            tweet_id = record_id(line)
+            if tweet_id is None or not self._in_bounds(tweet_id):
+                return False
+        for needles in self._needles:
+            if not any(needle in line for needle in needles):
+                return False
+        return True
+
+    def accepts(self, record):
+        if self.has_id_bounds:
+            try:
+                if not self._in_bounds(int(record['id_str'])):
+                    return False
+            except (KeyError, TypeError, ValueError):
+                return False
+        if self.languages is not None and record.get('lang') not in self.languages:
+            return False
+        for path, value in self.where:
+            if not _equals(_lookup(record, path), value):
+                return False
+        return True
+
+
+def list_shards(storage, prefix="", pattern=DEFAULT_PATTERN, record_filter=None, layout=None):
+    """
+    Keys of the shards under `prefix` (including the worker-<n>
+    subdirectories of a supervised run), in the order they were written.
+
+    With `record_filter`, shards in field=value partition directories (see
+    layout.PartitionLayout) which can't hold matching records are left out,
+    and with the `layout` they were written with, only the partitions which
+    can are listed at all.
+    """
+    def sort_key(key):
+        dirname, _, name = key.rpartition("/")
+        match = _SHARD_NUMBER_RE.search(name)
+        return dirname, int(match.group(1)) if match is not None else 0, name
+
+    prefixes = [prefix]
+    if record_filter is not None and layout is not None:
+        prefixes = ["/".join(p for p in [prefix.rstrip("/"), partition] if p) for partition in layout.prefixes(record_filter)]
+    keys = [key for p in prefixes for key in storage.list(p)
+            if fnmatch.fnmatch(key.rpartition("/")[2], pattern) and not key.endswith(_NOT_SHARDS)]
+    if record_filter is not None:
+        keys = [key for key in keys if partition_may_match(key_partitions(key), record_filter)]
+    return sorted(keys, key=sort_key)
+
+
+def read_lines(stream, chunk_size=_CHUNK_SIZE):
+    """
+    Yields the non-empty lines of a decompressed shard stream, without their
+    newlines.
+    """
+    tail = b""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (tail + chunk).split(b"\n")
+        tail = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    if tail.strip():
+        # A record cut short by a crash; it won't parse, but may still be wanted raw
+        yield tail
+
+
+def _scan_shard(storage, key, record_filter):
+    # Yields the raw records of a shard which pass the raw filter
+    path = storage.path(key) if hasattr(storage, 'path') else None
+    if path is not None and record_filter.has_id_bounds and os.path.exists(index_filename(path)):
+        # Only the matching offsets of an indexed local shard need reading
+        with ShardReader(path) as reader:
+            for line in reader.ids_between(record_filter.min_id, record_filter.max_id):
+                if record_filter.accepts_raw(line):
+                    yield line
+        return
+    stream = storage.open(key)
+    try:
+        for line in read_lines(codec_for_filename(key).open_reader(stream)):
+            if record_filter.accepts_raw(line):
+                yield line
+    finally:
+        stream.close()
+
+
+def read_shard(storage, key, record_filter=None, raw=False):
+    """
+    Yields the records of one shard which match `record_filter`: parsed, or
+    as raw bytes with `raw` (which avoids parsing at all if only ids are
+    being filtered on).
+    """
+    record_filter = record_filter or RecordFilter()
+    for line in _scan_shard(storage, key, record_filter):
+        if raw and not record_filter.needs_parse:
+            yield line
+            continue
+        try:
+            record = json.loads(line.decode('utf-8'))
+        except ValueError:
+            _LOG.warning("Skipping unparseable record in {}".format(storage.describe(key)))
+            continue
+        if record_filter.accepts(record):
+            yield line if raw else record
+
+
+def _read_worker(storage, tasks, results, record_filter, batch_size):
+    while True:
+        key = tasks.get()
+        if key is None:
+            break
+        batch = []
+        try:
+            for item in read_shard(storage, key, record_filter, raw=True):
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    results.put((_BATCH, batch))
+                    batch = []
+            if batch:
+                results.put((_BATCH, batch))
+            results.put((_SHARD_DONE, key))
+        except Exception as e:
+            results.put((_ERROR, (key, repr(e))))
+    results.put((_EXIT, None))
+
+
+class ShardQuery(object):
+    """
+    Iterates over the records in the shards under `prefix` in `storage`
+    (a LocalStorage on an output directory, or wherever shards were
+    offloaded to) which match `record_filter`.
+
+    Shards whose sidecar index shows they hold no ids in range are skipped
+    without being opened. The rest are decompressed, filtered and parsed by
+    `processes` worker processes, one shard at a time each, so records come
+    out in no particular order. Workers hand back the raw bytes of matching
+    records, since unpickling a parsed record costs as much as parsing it;
+    unless `raw` is set they're parsed again here. With `processes` of 1
+    everything happens in this process, in shard order.
+
+    Shards written in partition directories are pruned by their directory
+    names, and given the `layout` they were written with, only the matching
+    partitions are listed (see list_shards).
+    """
+    def __init__(self, storage, prefix="", record_filter=None, processes=None, raw=False,
+                 pattern=DEFAULT_PATTERN, batch_size=1000, layout=None):
+        assert processes is None or processes > 0, "processes must be greater than zero"
+        self._storage = storage
+        self._prefix = prefix
+        self._filter = record_filter or RecordFilter()
+        self._processes = processes or multiprocessing.cpu_count()
+        self._raw = raw
+        self._pattern = pattern
+        self._batch_size = batch_size
+        self._layout = layout
+        self.shards_read = 0
+        self.shards_skipped = 0
+        self.shards_failed = 0
+        self.num_records = 0
+
+    def _may_match(self, key):
+        if not self._filter.has_id_bounds:
+            return True
+        index_key = index_filename(key)
+        try:
+            summary = read_summary(lambda start, length: self._storage.read_range(index_key, start, length))
+        except Exception:
+            # No usable index, so the shard has to be read to find out
+            return True
+        return self._filter.overlaps(summary)
+
+    def shards(self):
+        """
+        Keys of the shards which could hold matching records.
+        """
+        ret = []
+        for key in list_shards(self._storage, self._prefix, self._pattern, record_filter=self._filter,
+                               layout=self._layout):
+            if self._may_match(key):
+                ret.append(key)
+            else:
+                self.shards_skipped += 1
+        return ret
+
+    def __iter__(self):
+        keys = self.shards()
+        num_workers = min(self._processes, len(keys))
+        if num_workers <= 1:
+            for key in keys:
+                for item in read_shard(self._storage, key, self._filter, raw=self._raw):
+                    self.num_records += 1
+                    yield item
+                self.shards_read += 1
+            return
+        tasks = multiprocessing.Queue()
+        for key in keys:
+            tasks.put(key)
+        for _ in range(num_workers):
+            tasks.put(None)
+        # Bounded, so that workers wait for a slow consumer
+        results = multiprocessing.Queue(maxsize=num_workers * 4)
+        workers = []
+        for i in range(num_workers):
+            worker = multiprocessing.Process(name='shard_reader_{}'.format(i), target=_read_worker,
+                                             args=(self._storage, tasks, results, self._filter, self._batch_size))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        running = num_workers
+        try:
+            while running:
+                try:
+                    kind, payload = results.get(timeout=1.0)
+                except queue.Empty:
+                    if not any(worker.is_alive() for worker in workers):
+                        _LOG.error("Shard readers exited unexpectedly.")
+                        break
+                    continue
+                if kind == _BATCH:
+                    for item in payload:
+                        if not self._raw:
+                            try:
+                                item = json.loads(item.decode('utf-8'))
+                            except ValueError:
+                                _LOG.warning("Skipping unparseable record")
+                                continue
+                        self.num_records += 1
+                        yield item
+                elif kind == _SHARD_DONE:
+                    self.shards_read += 1
+                elif kind == _ERROR:
+                    self.shards_failed += 1
+                    _LOG.error("Failed to read {}: {}".format(self._storage.describe(payload[0]), payload[1]))
+                else:
+                    running -= 1
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+import time
+
+from .log import get_logger
+
+_LOG = get_logger('reconnect')
+
+
+class GapLog(object):
+    """
+    Records holes in coverage as JSON lines in `path`. Each gap has the time
+    the last tweet arrived before it (`start`), the time the stream was
+    re-established (`end`), what caused it, and an estimate of how many
+    tweets were missed, based on the rate beforehand as given by `rate_fn`
+    (tweets per second).
+    """
+    def __init__(self, path, rate_fn=None):
+        self._path = path
+        self._rate_fn = rate_fn or (lambda: 0.0)
+        self._lock = threading.Lock()
+        self._current = None
+        self.num_gaps = 0
+        self.total_seconds = 0.0
+
+    @property
+    def is_open(self):
+        return self._current is not None
+
+    def open(self, reason, since=None):
+        """
+        Starts a gap, unless one is already open (a reconnect can take several
+        attempts, each of which fails for its own reason).
+        """
+        with self._lock:
+            if self._current is not None:
+                self._current['attempts'] += 1
+                return
+            self._current = {
+                'start': since if since is not None else time.time(),
+                'reason': reason,
+                'rate': self._rate_fn() or 0.0,
+                'attempts': 1,
+            }
+        _LOG.warning("Coverage gap started: {}".format(reason))
+
+    def close(self, resumed=True):
+        """
+        Ends the open gap, if any, and returns its log entry.
+        """
+        with self._lock:
+            gap, self._current = self._current, None
+        if gap is None:
+            return None
+        end = time.time()
+        seconds = max(0.0, end - gap['start'])
+        entry = {
+            'start': gap['start'],
+            'end': end,
+            'seconds': seconds,
+            'reason': gap['reason'],
+            'attempts': gap['attempts'],
+            'estimated_missed': int(round(gap.pop('rate') * seconds)),
+            'resumed': resumed,
+        }
+        self.num_gaps += 1
+        self.total_seconds += seconds
+        directory = os.path.dirname(self._path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self._path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+        _LOG.info("Coverage gap of {:.1f}s ended (about {:,} tweets missed): {}".format(
+            seconds, entry['estimated_missed'], gap['reason']))
+        return entry
+
+
+class ReconnectSupervisor(object):
+    """
+    Keeps a stream running. `connect` runs the stream until it stops; if it
+    returns normally the listener asked to stop, but if it raises (tweepy
+    gives up on any error other than a timeout or HTTP status) it's called
+    again after a linear backoff of `step` seconds per consecutive failure,
+    up to `cap`. Backoff for HTTP errors and rate limiting happens inside the
+    stream itself. The same listener, and so the same shards and dedup index,
+    are used throughout.
+    """
+    def __init__(self, connect, listener, step=0.25, cap=16.0, max_retries=None):
+        self._connect = connect
+        self._listener = listener
+        self._step = step
+        self._cap = cap
+        self._max_retries = max_retries
+
+    def run(self):
+        failures = 0
+        while True:
+            connections = getattr(self._listener, 'num_connections', 0)
+            try:
+                return self._connect()
+            except Exception as e:
+                if getattr(self._listener, 'num_connections', 0) > connections:
+                    # It had been connected, so this is a fresh run of failures
+                    failures = 0
+                failures += 1
+                if self._max_retries is not None and failures > self._max_retries:
+                    raise
+                delay = min(self._step * failures, self._cap)
+                _LOG.warning("Stream failed ({!r}); reconnecting in {:.2f}s.".format(e, delay))
+                time.sleep(delay)
@@ -0,0 +1,423 @@
+import glob
+import json
+import random
+import re
+import socket
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, urlparse
+
+from .compression import codec_for_filename
+from .log import get_logger
+
+_LOG = get_logger('replay')
+
+_TIMESTAMP_RE = re.compile(br'"timestamp_ms":\s*"\d+"')
+_END_OF_REPLAY = json.dumps({'disconnect': {'code': 0, 'stream_name': 'replay', 'reason': 'end of replay'}}).encode('utf-8')
+_ERROR_BODIES = {
+    401: b'Unauthorized',
+    420: b'Exceeded connect limit',
+    503: b'Service Unavailable',
+}
+
+_WORDS = ['the', 'a', 'breaking', 'news', 'today', 'vote', 'game', 'love', 'new', 'watch', 'live',
+          'update', 'thread', 'why', 'how', 'big', 'win', 'city', 'music', 'data']
+_LANGS = ['en', 'en', 'en', 'es', 'fr', 'pt', 'ja', 'und']
+
+
+def _created_at(t):
+    return time.strftime("%a %b %d %H:%M:%S +0000 %Y", time.gmtime(t))
+
+
+def _synthetic_user(rng, user_id):
+    # Profiles stay the same from tweet to tweet, like real ones; only the
+    # counters move
+    profile_rng = random.Random(user_id)
+    return {
+        'id': user_id,
+        'id_str': str(user_id),
+        'name': 'User {}'.format(user_id),
+        'screen_name': 'user{}'.format(user_id),
+        'location': profile_rng.choice(['', 'Boston, MA', 'London', 'Tokyo']),
+        'description': ' '.join(profile_rng.choice(_WORDS) for _ in range(profile_rng.randint(0, 20))),
+        'followers_count': rng.randint(0, 100000),
+        'friends_count': rng.randint(0, 5000),
+        'statuses_count': rng.randint(0, 100000),
+        'created_at': _created_at(1300000000 + user_id % 300000000),
+        'verified': profile_rng.random() < 0.01,
+        'lang': None,
+        'profile_image_url_https': 'https://pbs.twimg.com/profile_images/{}/photo.jpg'.format(user_id),
+    }
+
+
+def _synthetic_status(rng, tweet_id, user_id, t):
+    hashtags = ['tag{}'.format(rng.randint(0, 200)) for _ in range(rng.randint(0, 3))]
+    words = [rng.choice(_WORDS) for _ in range(rng.randint(3, 25))] + ['#' + h for h in hashtags]
+    return {
+        'created_at': _created_at(t),
+        'id': tweet_id,
+        'id_str': str(tweet_id),
+        'text': ' '.join(words),
+        'source': '<a href="http://twitter.com" rel="nofollow">Twitter Web Client</a>',
+        'truncated': False,
+        'in_reply_to_status_id': None,
+        'in_reply_to_status_id_str': None,
+        'in_reply_to_user_id': None,
+        'in_reply_to_user_id_str': None,
+        'in_reply_to_screen_name': None,
+        'user': _synthetic_user(rng, user_id),
+        'geo': None,
+        'coordinates': None,
+        'place': None,
+        'is_quote_status': False,
+        'retweet_count': 0,
+        'favorite_count': 0,
+        'entities': {
+            'hashtags': [{'text': h, 'indices': [0, 0]} for h in hashtags],
+            'urls': [],
+            'user_mentions': [],
+            'symbols': [],
+        },
+        'favorited': False,
+        'retweeted': False,
+        'filter_level': 'low',
+        'lang': rng.choice(_LANGS),
+    }
+
+
+def synthetic_tweets(count, retweet_ratio=0.5, num_users=10000, num_originals=1000, seed=0):
+    """
+    Generates `count` encoded tweets which look enough like the real thing to
+    exercise the pipeline: realistic sizes, a mix of languages and hashtags,
+    and a share of retweets of a smaller pool of popular originals.
+    """
+    rng = random.Random(seed)
+    now = time.time()
+    next_id = int((now * 1000 - 1288834974657)) << 22
+    originals = []
+    for i in range(count):
+        next_id += rng.randint(1, 1 << 20)
+        user_id = rng.randint(1, num_users)
+        status = _synthetic_status(rng, next_id, user_id, now)
+        if originals and rng.random() < retweet_ratio:
+            original = rng.choice(originals)
+            status['text'] = u'RT @user{}: {}'.format(original['user']['id'], original['text'])
+            status['retweeted_status'] = original
+        elif len(originals) < num_originals:
+            originals.append(status)
+        # Originals are embedded in retweets, so don't add this to them
+        yield json.dumps(dict(status, timestamp_ms=str(int(now * 1000))), separators=(',', ':')).encode('utf-8')
+
+
+def load_tweets(patterns, limit=None):
+    """
+    Reads newline-delimited tweets from shards (optionally compressed)
+    matching the given glob patterns.
+    """
+    ret = []
+    for pattern in patterns:
+        for filename in sorted(glob.glob(pattern)):
+            with open(filename, "rb") as raw:
+                for line in codec_for_filename(filename).open_reader(raw):
+                    line = line.rstrip(b"\r\n")
+                    if line:
+                        ret.append(line)
+                        if limit is not None and len(ret) >= limit:
+                            return ret
+    return ret
+
+
+class _ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        _LOG.debug(format, *args)
+
+    def do_GET(self):
+        self._stream()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length > 0 else ''
+        self._stream(parse_qs(body))
+
+    def _write_chunk(self, data):
+        self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+
+    def _stream(self, params=None):
+        server = self.server
+        query = parse_qs(urlparse(self.path).query)
+        query.update(params or {})
+        delimited = query.get('delimited') == ['length']
+
+        status = server.next_status()
+        if status != 200:
+            body = _ERROR_BODIES.get(status, b'Error')
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def frame(message):
+            message += b"\r\n"
+            if delimited:
+                return b"%d\r\n" % len(message) + message
+            return message
+
+        try:
+            for batch in server.batches():
+                if batch is None:
+                    self._write_chunk(b"\r\n")
+                else:
+                    self._write_chunk(b"".join(frame(m) for m in batch))
+                self.wfile.flush()
+            if server.end_with_disconnect:
+                # Clients which read in fixed-size blocks (tweepy reads 512B at
+                # a time) won't see the notice until more data arrives, so pad
+                # it with keep-alives.
+                self._write_chunk(frame(_END_OF_REPLAY) + b"\r\n" * 1024)
+                self.wfile.flush()
+                # Like Twitter, leave it to the client to hang up. Clients may
+                # drop anything still buffered once the response is complete.
+                self.connection.settimeout(server.hangup_timeout)
+                self.rfile.read(1)
+            else:
+                self._write_chunk(b"")
+                self.wfile.flush()
+        except (IOError, OSError, socket.timeout):
+            # Client went away
+            pass
+        self.close_connection = True
+
+
+class ReplayServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local HTTP server which speaks the streaming filter protocol: a chunked
+    response of newline-delimited JSON (length-prefixed when the client asks
+    for `delimited=length`), with blank keep-alive lines while idle.
+
+    `tweets` (encoded messages) are replayed at `rate` messages per second
+    (as fast as possible if None), `loop`ing until `count` have been sent.
+    Each message's `timestamp_ms` is rewritten to the time it was sent, so
+    clients can measure latency. The first connections are refused with the
+    statuses in `error_codes`, e.g. [420] to exercise rate-limit handling.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, tweets, host='127.0.0.1', port=0, rate=None, count=None, loop=False,
+                 keepalive_interval=30.0, error_codes=None, end_with_disconnect=True, batch_size=100):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), _ReplayHandler)
+        self._tweets = tweets
+        self._rate = rate
+        self._count = count if count is not None else (None if loop else len(tweets))
+        self._loop = loop
+        self._keepalive_interval = keepalive_interval
+        self._error_codes = list(error_codes or [])
+        self._lock = threading.Lock()
+        self._batch_size = batch_size
+        self._thread = None
+        self.end_with_disconnect = end_with_disconnect
+        self.hangup_timeout = 30.0
+        self.num_sent = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def next_status(self):
+        with self._lock:
+            if self._error_codes:
+                return self._error_codes.pop(0)
+        return 200
+
+    def _messages(self):
+        i = 0
+        while self._count is None or self.num_sent < self._count:
+            if i >= len(self._tweets):
+                if not self._loop or not self._tweets:
+                    return
+                i = 0
+            yield self._tweets[i]
+            i += 1
+
+    def batches(self):
+        """
+        Yields lists of timestamped messages, paced to the configured rate, or
+        None when a keep-alive is due.
+        """
+        start = time.time()
+        last_sent = start
+        batch_size = self._batch_size if self._rate is None else max(1, min(self._batch_size, int(self._rate / 100)))
+        batch = []
+        # Paced per connection, since several can be open at once
+        sent = 0
+        for message in self._messages():
+            batch.append(message)
+            self.num_sent += 1
+            sent += 1
+            if len(batch) < batch_size:
+                continue
+            if self._rate is not None:
+                while True:
+                    delay = start + sent / float(self._rate) - time.time()
+                    if delay <= 0:
+                        break
+                    if time.time() - last_sent >= self._keepalive_interval:
+                        yield None
+                        last_sent = time.time()
+                    time.sleep(min(delay, self._keepalive_interval))
+            yield self._stamp(batch)
+            last_sent = time.time()
+            batch = []
+        if batch:
+            yield self._stamp(batch)
+
+    def _stamp(self, batch):
+        stamp = b'"timestamp_ms":"%d"' % int(time.time() * 1000)
+        return [_TIMESTAMP_RE.sub(stamp, m, count=1) for m in batch]
+
+    def start(self):
+        self._thread = threading.Thread(name='replay_server', target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        _LOG.info("Replay server listening on {}".format(self.url))
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class _ApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        _LOG.debug(format, *args)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        endpoint = url.path.strip("/")
+        if endpoint.startswith("1.1/"):
+            endpoint = endpoint[len("1.1/"):]
+        if endpoint.endswith(".json"):
+            endpoint = endpoint[:-len(".json")]
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        status, headers, body = self.server.respond(endpoint, params)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockApiServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local HTTP server which answers the REST search/tweets and
+    statuses/user_timeline endpoints from `tweets` (encoded messages), for
+    exercising backfill. Searches match statuses whose text holds every word
+    of `q`; both honour since_id, max_id and count, newest first.
+
+    Each endpoint allows `limits[endpoint]` requests (15 by default) per
+    window of `window_seconds`, reporting what's left in x-rate-limit-*
+    headers and answering 429 once it's used up. The first requests are
+    answered with the statuses in `error_codes`, e.g. [503].
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, tweets, host='127.0.0.1', port=0, limits=None, window_seconds=900.0, error_codes=None):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), _ApiHandler)
+        self._statuses = sorted((json.loads(t) for t in tweets), key=lambda s: s['id'], reverse=True)
+        self._limits = limits or {}
+        self._window_seconds = window_seconds
+        self._windows = {}
+        self._error_codes = list(error_codes or [])
+        self._lock = threading.Lock()
+        self._thread = None
+        self.num_requests = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}/1.1".format(host, port)
+
+    def _rate_limit(self, endpoint):
+        # Returns the headers to send, and whether the request is allowed
+        now = time.time()
+        limit = self._limits.get(endpoint, 15)
+        with self._lock:
+            self.num_requests += 1
+            reset, used = self._windows.get(endpoint, (0, 0))
+            if now >= reset:
+                reset, used = now + self._window_seconds, 0
+            allowed = used < limit
+            if allowed:
+                used += 1
+            self._windows[endpoint] = (reset, used)
+        headers = {'x-rate-limit-limit': str(limit), 'x-rate-limit-remaining': str(limit - used),
+                   'x-rate-limit-reset': str(int(reset) + 1)}
+        return headers, allowed
+
+    def _matches(self, endpoint, params):
+        if endpoint == 'search/tweets':
+            words = params.get('q', '').lower().split()
+            return lambda s: all(w in s.get('text', '').lower() for w in words)
+        if endpoint == 'statuses/user_timeline':
+            user_id = params.get('user_id')
+            return lambda s: s['user']['id_str'] == user_id
+        return None
+
+    def respond(self, endpoint, params):
+        with self._lock:
+            error = self._error_codes.pop(0) if self._error_codes else None
+        if error is not None:
+            return error, {}, json.dumps({'errors': [{'code': 0, 'message': 'Injected error'}]}).encode('utf-8')
+        matches = self._matches(endpoint, params)
+        if matches is None:
+            return 404, {}, json.dumps({'errors': [{'code': 34, 'message': 'Sorry, that page does not exist.'}]}).encode('utf-8')
+        headers, allowed = self._rate_limit(endpoint)
+        if not allowed:
+            return 429, headers, json.dumps({'errors': [{'code': 88, 'message': 'Rate limit exceeded'}]}).encode('utf-8')
+        since_id = int(params.get('since_id', 0))
+        max_id = int(params['max_id']) if 'max_id' in params else None
+        count = int(params.get('count', 20))
+        statuses = []
+        for status in self._statuses:
+            if max_id is not None and status['id'] > max_id:
+                continue
+            if status['id'] <= since_id or len(statuses) >= count:
+                break
+            if matches(status):
+                statuses.append(status)
+        body = {'statuses': statuses, 'search_metadata': {'count': count}} if endpoint == 'search/tweets' else statuses
+        return 200, headers, json.dumps(body).encode('utf-8')
+
+    def start(self):
+        self._thread = threading.Thread(name='mock_api_server', target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        _LOG.info("Mock API server listening on {}".format(self.url))
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
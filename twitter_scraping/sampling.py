@@ -0,0 +1,204 @@
+import json
+import os
+import threading
+import time
+
+from .file_utils import SAMPLE_EXTENSION, ShardListener
+from .log import get_logger
+from .metrics import MetricsRegistry
+from .shard_index import created_at_ms
+
+_LOG = get_logger('sampling')
+
+_MASK = (1 << 64) - 1
+_SPACE = float(1 << 64)
+# How full the writer's queue can get before it counts as falling behind
+_QUEUE_TARGET = 0.5
+
+
+def sample_hash(tweet_id):
+    """
+    A 64-bit hash of a tweet id (the splitmix64 finalizer), spread evenly
+    however the ids are, and the same in every process and on every run.
+    """
+    x = (int(tweet_id) + 0x9e3779b97f4a7c15) & _MASK
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _MASK
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _MASK
+    return x ^ (x >> 31)
+
+
+def in_sample(tweet_id, rate):
+    """
+    Whether the tweet `tweet_id` is in the sample kept at `rate`. The sample
+    at a lower rate is always a subset of the sample at a higher one.
+    """
+    return rate >= 1.0 or sample_hash(tweet_id) < rate * _SPACE
+
+
+class _SampleListener(ShardListener):
+    def __init__(self, sampler, downstream):
+        self._sampler = sampler
+        self._downstream = downstream
+
+    def shard_opened(self, filename):
+        self._sampler.shard_opened(filename)
+        if self._downstream is not None:
+            self._downstream.shard_opened(filename)
+
+    def handle_shard(self, filename):
+        self._sampler.shard_sealed(filename)
+        if self._downstream is not None:
+            self._downstream.handle_shard(filename)
+
+    def close(self):
+        if self._downstream is not None:
+            self._downstream.close()
+
+
+class HashSampler(object):
+    """
+    Keeps a status when the hash of its id falls below `rate`, so that
+    collectors with the same rate keep the same statuses, and reruns keep
+    the ones they kept before.
+
+    With `adaptive`, the rate follows how far behind the stream the listener
+    is: every `interval` seconds, the average lag (the time since the
+    statuses received were created) is compared with `target_lag`, and the
+    fill of the writer's queue (`queue_fn()`, between 0 and 1) with half of
+    it. Over either, the rate halves, down to `min_rate`; once both have
+    been under half of that for `recover_seconds`, it doubles, up to `rate`.
+    `limit_fn()`, if given, caps the rate from outside, e.g. for a disk
+    budget.
+
+    As a listener (see `listener`), it writes a sidecar beside each shard
+    with the rates in force and the statuses seen and kept while the shard
+    was open, so that counts read from it can be scaled back up.
+    """
+    def __init__(self, rate=1.0, adaptive=False, min_rate=0.01, target_lag=5.0, recover_seconds=30.0, interval=1.0,
+                 queue_fn=None, limit_fn=None, metrics=None):
+        assert 0 < rate <= 1, "rate must be in (0, 1]"
+        assert 0 < min_rate <= rate, "min_rate must be in (0, rate]"
+        assert target_lag > 0, "target_lag must be greater than zero"
+        self._max_rate = rate
+        self._base = rate
+        self._adaptive = adaptive
+        self._min_rate = min_rate
+        self._target_lag = target_lag
+        self._recover_seconds = recover_seconds
+        self._interval = interval
+        self._queue_fn = queue_fn
+        self._limit_fn = limit_fn
+        self._next_adjust = 0.0
+        self._calm_since = None
+        self._lag_total = 0.0
+        self._lag_count = 0
+        self._lock = threading.Lock()
+        # Shard filename to [seen, kept, min rate, max rate, opened] at open
+        self._open = {}
+        self.rate = rate
+        self._threshold = rate * _SPACE
+        self.lag = 0.0
+        self.num_seen = 0
+        self.num_kept = 0
+        metrics = metrics or MetricsRegistry()
+        metrics.gauge('sample_rate', "Fraction of statuses being kept", fn=lambda: self.rate)
+        metrics.gauge('stream_lag_seconds', "Average time between a status being created and received",
+                      fn=lambda: self.lag)
+        metrics.counter('tweets_sampled_out_total', "Statuses not kept by the sampler",
+                        fn=lambda: self.num_seen - self.num_kept)
+
+    def keep(self, tweet_id, received_id=None):
+        """
+        Whether to keep the status `tweet_id` (the original, for a retweet),
+        which arrived as `received_id`, if different.
+        """
+        now = time.time()
+        if self._adaptive:
+            self._lag_total += now - created_at_ms(int(received_id or tweet_id)) / 1000.0
+            self._lag_count += 1
+        if now >= self._next_adjust:
+            self._adjust(now)
+        self.num_seen += 1
+        if self._threshold >= _SPACE or sample_hash(tweet_id) < self._threshold:
+            self.num_kept += 1
+            return True
+        return False
+
+    def _adjust(self, now):
+        self._next_adjust = now + self._interval
+        if self._adaptive:
+            if self._lag_count:
+                self.lag = self._lag_total / self._lag_count
+            self._lag_total = 0.0
+            self._lag_count = 0
+            pressure = self.lag / self._target_lag
+            if self._queue_fn is not None:
+                pressure = max(pressure, self._queue_fn() / _QUEUE_TARGET)
+            if pressure > 1:
+                self._calm_since = None
+                if self._base > self._min_rate:
+                    self._base = max(self._min_rate, self._base / 2)
+                    _LOG.warning("Falling behind the stream (lag {:.1f}s); sampling {:.1%} of tweets.".format(
+                        self.lag, self._base))
+            elif pressure < 0.5 and self._base < self._max_rate:
+                if self._calm_since is None:
+                    self._calm_since = now
+                elif now - self._calm_since >= self._recover_seconds:
+                    self._calm_since = now
+                    self._base = min(self._max_rate, self._base * 2)
+                    _LOG.info("Caught up with the stream (lag {:.1f}s); sampling {:.1%} of tweets.".format(
+                        self.lag, self._base))
+            else:
+                self._calm_since = None
+        rate = self._base
+        if self._limit_fn is not None:
+            rate = min(rate, self._limit_fn())
+        if rate != self.rate:
+            self._set_rate(rate)
+
+    def _set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+            self._threshold = rate * _SPACE
+            for entry in self._open.values():
+                entry[2] = min(entry[2], rate)
+                entry[3] = max(entry[3], rate)
+
+    def shard_opened(self, filename):
+        with self._lock:
+            self._open[filename] = [self.num_seen, self.num_kept, self.rate, self.rate, time.time()]
+
+    def shard_sealed(self, filename):
+        with self._lock:
+            entry = self._open.pop(filename, None)
+        if entry is None:
+            # Opened before this run
+            return
+        seen, kept, min_rate, max_rate, opened = entry
+        sample = {
+            'shard': os.path.basename(filename),
+            'opened': opened,
+            'sealed': time.time(),
+            'min_rate': min_rate,
+            'max_rate': max_rate,
+            'seen': self.num_seen - seen,
+            'kept': self.num_kept - kept,
+        }
+        path = filename + SAMPLE_EXTENSION
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "w") as f:
+            json.dump(sample, f)
+        os.rename(tmp_path, path)
+
+    def listener(self, downstream):
+        """
+        A ShardListener which writes each sealed shard's sample sidecar,
+        then passes it on to `downstream`.
+        """
+        return _SampleListener(self, downstream)
+
+    def describe(self):
+        message = "Sampling {:.1%} of tweets".format(self.rate)
+        if self._adaptive:
+            message += " (lag {:.1f}s)".format(self.lag)
+        return message + "; {:,} sampled out.".format(self.num_seen - self.num_kept)
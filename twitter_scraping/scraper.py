@@ -1,19 +1,63 @@
 import json
+import os
+import re
 import sys
 import time
 import tweepy
 
-from cachetools import LRUCache
 from contextlib import contextmanager
 from io import open
+from requests.adapters import HTTPAdapter
+from six.moves.urllib.parse import urlparse
 from tweepy.models import Model
 
 from .auth import get_auth
-from .file_utils import ShardedFileWriter
+from .compression import CODECS, get_codec
+from .dedup import DEDUP_KINDS, LRUDedup, make_dedup
+from .engagement import ENGAGEMENT_DIRECTORY, ENGAGEMENT_TEMPLATE, QUOTE, RETWEET, EngagementAggregator
+from .file_utils import BackgroundShardWriter, PartitionedShardWriter, ShardedFileWriter, BACKPRESSURE_BLOCK, BACKPRESSURE_POLICIES, default_root
+from .layout import PartitionLayout
 from .log import get_logger
+from .manifest import ShardManifest
+from .metrics import MetricsRegistry
+from .projection import RecordSelector
+from .quota import HARD, OK, PAUSE, QUOTA_POLICIES, RECOMPRESS, SAMPLE, DiskQuota, aggressive_codec
+from .reconnect import GapLog, ReconnectSupervisor
+from .sampling import HashSampler
+from .storage import LocalStorage
+from .trends import TRENDS_DIRECTORY, TrendTracker
+from .users import USERS_DIRECTORY, USERS_TEMPLATE, UserNormalizer
 
 _LOG = get_logger('scraper')
 
+# Twitter emits compact JSON with `id_str` ahead of any nested objects, so the
+# first match in a status message is the status' own id. Quotes inside string
+# values are always escaped, so these can't match user-supplied text.
+_ID_STR_RE = re.compile(r'"id_str":\s*"(\d+)"')
+_RETWEETED_STATUS_RE = re.compile(r'"retweeted_status":\s*\{')
+_STATUS_KEY = '"in_reply_to_status_id"'
+_QUOTED_ID_KEY = '"quoted_status_id_str"'
+_QUOTED_ID_RE = re.compile(r'"quoted_status_id_str":\s*"(\d+)"')
+
+def extract_ids(raw_data):
+    """
+    Pulls the status id and, for retweets, the retweeted status id out of a
+    raw stream message without parsing it. Returns ``(None, None)`` for
+    anything which doesn't look like a status.
+    """
+    if _STATUS_KEY not in raw_data:
+        return None, None
+    id_match = _ID_STR_RE.search(raw_data)
+    if id_match is None:
+        return None, None
+    retweeted_match = _RETWEETED_STATUS_RE.search(raw_data)
+    if retweeted_match is None:
+        return id_match.group(1), None
+    retweeted_id_match = _ID_STR_RE.search(raw_data, retweeted_match.end())
+    if retweeted_id_match is None:
+        return None, None
+    return id_match.group(1), retweeted_id_match.group(1)
+
 class _ElapsedTime(object):
     def __init__(self, total_seconds):
         self._total_seconds = total_seconds
@@ -50,15 +94,252 @@ class _ElapsedTime(object):
     def __str__(self):
         return self.format("{days}d{hours}h{minutes}m{seconds}s [{total_seconds_int}s]")
 
+# Statuses which mean the request itself is wrong, so retrying can't help
+_FATAL_STATUS_CODES = (401, 403, 404, 406, 413, 416)
+
+def _wrap_all(wraps, downstream):
+    # The last of `wraps` ends up in front
+    for wrap in wraps:
+        downstream = wrap(downstream)
+    return downstream
+
+
+class OutputOptions(object):
+    """
+    How a listener's shards are cut, compressed, indexed, partitioned and,
+    with `background`, written from a separate thread.
+    """
+    def __init__(self, shard_max=50000, shard_max_bytes=None, shard_max_compressed_bytes=None, shard_max_age=None,
+                 codec=None, manifest=True, shard_index=True, index_block_bytes=1 << 20, columnar=False,
+                 keep_json=True, partition_by=None, max_open_partitions=64, partition_idle_seconds=300.0,
+                 background=False, queue_size=10000, flush_bytes=1 << 20, flush_interval=1.0,
+                 backpressure=BACKPRESSURE_BLOCK):
+        self.shard_max = shard_max
+        self.shard_max_bytes = shard_max_bytes
+        self.shard_max_compressed_bytes = shard_max_compressed_bytes
+        self.shard_max_age = shard_max_age
+        self.codec = codec
+        self.manifest = manifest
+        self.shard_index = shard_index
+        self.index_block_bytes = index_block_bytes
+        self.columnar = columnar
+        self.keep_json = keep_json
+        self.partition_by = partition_by
+        self.max_open_partitions = max_open_partitions
+        self.partition_idle_seconds = partition_idle_seconds
+        self.background = background
+        self.queue_size = queue_size
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.backpressure = backpressure
+
+class UploadOptions(object):
+    """
+    Where sealed shards are offloaded to: S3 if `s3_bucket` is given, else
+    `storage_dir`.
+    """
+    def __init__(self, s3_bucket=None, s3_root=None, storage_dir=None, workers=2, retries=5):
+        self.s3_bucket = s3_bucket
+        self.s3_root = s3_root
+        self.storage_dir = storage_dir
+        self.workers = workers
+        self.retries = retries
+
+class MetricsOptions(object):
+    def __init__(self, port=None, snapshot=None, snapshot_interval=60.0):
+        self.port = port
+        self.snapshot = snapshot
+        self.snapshot_interval = snapshot_interval
+
+class UserOptions(object):
+    def __init__(self, cache_size=100000):
+        self.cache_size = cache_size
+
+class SelectOptions(object):
+    """
+    The fields kept in (or dropped from) written statuses, and the
+    predicates a status has to pass to be written at all.
+    """
+    def __init__(self, keep_fields=None, drop_fields=None, predicates=None):
+        self.keep_fields = keep_fields
+        self.drop_fields = drop_fields
+        self.predicates = predicates
+
+class EngagementOptions(object):
+    def __init__(self, capacity=100000, flush_interval=300.0):
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+
+class TrendOptions(object):
+    def __init__(self, terms=None, window=300.0, capacity=1000, top=20, in_notify=False):
+        self.terms = terms
+        self.window = window
+        self.capacity = capacity
+        self.top = top
+        self.in_notify = in_notify
+
+class QuotaOptions(object):
+    def __init__(self, budget, soft_watermark=0.8, hard_watermark=0.95, soft_policy=RECOMPRESS, hard_policy=PAUSE,
+                 sample_rate=0.1, recompress_codec='gzip'):
+        self.budget = budget
+        self.soft_watermark = soft_watermark
+        self.hard_watermark = hard_watermark
+        self.soft_policy = soft_policy
+        self.hard_policy = hard_policy
+        self.sample_rate = sample_rate
+        self.recompress_codec = recompress_codec
+
+class SamplingOptions(object):
+    def __init__(self, rate=1.0, adaptive=False, min_rate=0.01, target_lag=5.0):
+        self.rate = rate
+        self.adaptive = adaptive
+        self.min_rate = min_rate
+        self.target_lag = target_lag
+
+
 class ScraperStreamListener(tweepy.StreamListener):
-    def __init__(self, output_dir, s3_bucket=None, s3_root=None, emailer=None, notify_count=None, notify_frequency=None, shard_max=50000, *args, **kwargs):
+    """
+    Writes the statuses of a stream into shards under `output_dir`. Each
+    optional feature is configured by its own options object, and is off
+    when that is None: `users` (normalizing user objects into a side
+    store), `engagement`, `trends`, `quota` (a disk budget), `sampling` and
+    `select`.
+    """
+    def __init__(self, output_dir, emailer=None, notify_count=None, notify_frequency=None, raw=False, dedup=None,
+                 dedup_snapshot=None, gaps_log=None, max_errors=None, output=None, upload=None, metrics=None,
+                 users=None, select=None, engagement=None, trends=None, quota=None, sampling=None, *args, **kwargs):
         super(ScraperStreamListener, self).__init__(*args, **kwargs)
+        output_options = output or OutputOptions()
+        upload = upload or UploadOptions()
+        metrics = metrics or MetricsOptions()
         self._emailer = emailer
-        self._output = ShardedFileWriter(output_dir, "tweets-shard-{n}.json")
-        self._output.next_shard()
-        if s3_bucket is not None:
-            self._output.offload_to_s3(s3_bucket, s3_root=s3_root)
-        self._cache = LRUCache(maxsize=1000)
+        self._raw = raw
+        self._metrics = MetricsRegistry()
+        self._received = self._metrics.counter('tweets_received_total', "Statuses received from the stream")
+        self._written = self._metrics.counter('tweets_written_total', "Statuses written after dropping duplicates")
+        self._errors = self._metrics.counter('stream_errors_total', "Error statuses returned by the stream", labels=('code',))
+        self._selector = None
+        if select is not None and (select.keep_fields or select.drop_fields or select.predicates):
+            self._selector = RecordSelector(keep=select.keep_fields, drop=select.drop_fields, predicates=select.predicates,
+                                            dropped=self._metrics.counter('records_filtered_total', "Statuses not written, by the predicate which rejected them", labels=('predicate',)))
+        # Fixed here so that profiles are uploaded under the same root as tweets
+        s3_root = upload.s3_root or default_root()
+
+        self._trends = None
+        self._trends_in_notify = trends is not None and trends.in_notify
+        if trends is not None:
+            self._trends = TrendTracker(os.path.join(output_dir, TRENDS_DIRECTORY), terms=trends.terms,
+                                        window_seconds=trends.window, capacity=trends.capacity, top=trends.top)
+            self._metrics.counter('trend_messages_queued_total', "Stream messages handed to the trend counter",
+                                  fn=lambda: self._trends.num_queued)
+            self._metrics.counter('trend_messages_dropped_total', "Stream messages not counted because the trend counter fell behind",
+                                  fn=lambda: self._trends.num_dropped)
+            self._metrics.counter('trend_shard_summaries_dropped_total', "Sealed shards left without a trend summary because the trend counter fell behind",
+                                  fn=lambda: self._trends.num_seals_dropped)
+
+        self._sampler = None
+        self._quota = None
+        if (sampling is not None and (sampling.rate < 1.0 or sampling.adaptive)) \
+                or (quota is not None and SAMPLE in (quota.soft_policy, quota.hard_policy)):
+            sampling = sampling or SamplingOptions()
+            # The quota and output are set up below
+            queue_fn = None
+            if output_options.background:
+                queue_fn = lambda: self._output.queue_depth / float(output_options.queue_size)
+            self._sampler = HashSampler(rate=sampling.rate, adaptive=sampling.adaptive, min_rate=min(sampling.min_rate, sampling.rate),
+                                        target_lag=sampling.target_lag, queue_fn=queue_fn,
+                                        limit_fn=lambda: self._quota.sample_rate if self._quota is not None else 1.0,
+                                        metrics=self._metrics)
+
+        def open_output(name, directory, template, root, columnar, listener=None, partition_by=None):
+            options = dict(codec=output_options.codec,
+                           max_records=output_options.shard_max,
+                           max_bytes=output_options.shard_max_bytes,
+                           max_compressed_bytes=output_options.shard_max_compressed_bytes,
+                           max_age=output_options.shard_max_age,
+                           manifest=ShardManifest(directory) if output_options.manifest else None,
+                           metrics=self._metrics,
+                           index=output_options.shard_index,
+                           index_block_bytes=output_options.index_block_bytes)
+            if partition_by:
+                output = PartitionedShardWriter(directory, template, PartitionLayout(partition_by),
+                                                max_open=output_options.max_open_partitions,
+                                                idle_seconds=output_options.partition_idle_seconds,
+                                                **options)
+            else:
+                output = ShardedFileWriter(directory, template, **options)
+            if output_options.background:
+                output = BackgroundShardWriter(output,
+                                               queue_size=output_options.queue_size,
+                                               flush_bytes=output_options.flush_bytes,
+                                               flush_interval=output_options.flush_interval,
+                                               backpressure=output_options.backpressure,
+                                               metrics=self._metrics,
+                                               output=name)
+            if upload.s3_bucket is not None:
+                output.offload_to_s3(upload.s3_bucket, s3_root=root, workers=upload.workers, retries=upload.retries,
+                                     output=name)
+            elif upload.storage_dir is not None:
+                output.offload(LocalStorage(upload.storage_dir), root=root, workers=upload.workers,
+                               retries=upload.retries, output=name)
+            if columnar:
+                output.convert_to_columnar(keep_json=output_options.keep_json)
+            output.recover()
+            if listener is not None:
+                # After recovery, so that only shards from this run are seen
+                output.wrap_listener(listener)
+            output.next_shard()
+            return output
+
+        wraps = [tracker.listener for tracker in (self._trends, self._sampler) if tracker is not None]
+        self._output = open_output("tweets", output_dir, "tweets-shard-{n}.json", s3_root, output_options.columnar,
+                                   listener=(lambda downstream: _wrap_all(wraps, downstream)) if wraps else None,
+                                   partition_by=output_options.partition_by)
+        self._users = None
+        self._user_output = None
+        if users is not None:
+            self._user_output = open_output(USERS_DIRECTORY, os.path.join(output_dir, USERS_DIRECTORY), USERS_TEMPLATE,
+                                            "/".join([s3_root, USERS_DIRECTORY]), False)
+            self._users = UserNormalizer(lambda record: self._user_output.write(record + "\n"), cache_size=users.cache_size)
+            self._metrics.counter('user_profiles_written_total', "User profile versions written to the side store",
+                                  fn=lambda: self._users.num_written)
+            self._metrics.counter('user_profiles_reused_total', "User objects replaced by a reference to a stored profile",
+                                  fn=lambda: self._users.num_reused)
+        self._engagement = None
+        self._engagement_output = None
+        if engagement is not None:
+            self._engagement_output = open_output(ENGAGEMENT_DIRECTORY, os.path.join(output_dir, ENGAGEMENT_DIRECTORY), ENGAGEMENT_TEMPLATE,
+                                                  "/".join([s3_root, ENGAGEMENT_DIRECTORY]), False)
+            self._engagement = EngagementAggregator(lambda record: self._engagement_output.write(record + "\n"),
+                                                    capacity=engagement.capacity, flush_interval=engagement.flush_interval)
+            self._metrics.counter('engagement_events_total', "Retweets and quotes counted towards their originals",
+                                  fn=lambda: sum(self._engagement.num_events.values()))
+            self._metrics.counter('engagement_records_written_total', "Per-original engagement records written",
+                                  fn=lambda: self._engagement.num_written)
+            self._metrics.counter('engagement_evictions_total', "Originals written out early to stay within capacity",
+                                  fn=lambda: self._engagement.num_evicted)
+            self._metrics.gauge('engagement_originals', "Originals being counted in the current window",
+                                fn=lambda: len(self._engagement))
+        self._dedup = dedup if dedup is not None else LRUDedup(maxsize=1000)
+        self._dedup_snapshot = dedup_snapshot
+        self._metrics.counter('dedup_hits_total', "Duplicate statuses dropped", fn=lambda: self._dedup.hits)
+        self._metrics.counter('dedup_misses_total', "Statuses not seen before", fn=lambda: self._dedup.misses)
+        self._metrics.gauge('dedup_memory_bytes', "Memory used by the dedup index", fn=lambda: self._dedup.memory_bytes)
+        self._gaps = GapLog(gaps_log or os.path.join(output_dir, "gaps.jsonl"),
+                            rate_fn=lambda: self._metrics.rates('tweets_received_total').get('5m'))
+        self._metrics.counter('stream_gaps_total', "Disconnections which left a hole in coverage", fn=lambda: self._gaps.num_gaps)
+        self._metrics.counter('stream_gap_seconds_total', "Seconds spent disconnected", fn=lambda: self._gaps.total_seconds)
+        self._quota_gap = False
+        if quota is not None:
+            self._shed = self._metrics.counter('tweets_shed_total', "Statuses not written to stay within the disk budget")
+            outputs = [self._output, self._user_output, self._engagement_output]
+            self._quota = DiskQuota(output_dir, quota.budget,
+                                    uploaders=[o.uploader for o in outputs if o is not None and o.uploader is not None],
+                                    soft=quota.soft_watermark, hard=quota.hard_watermark,
+                                    soft_policy=quota.soft_policy, hard_policy=quota.hard_policy,
+                                    sample_rate=quota.sample_rate, codec=aggressive_codec(quota.recompress_codec),
+                                    on_change=self._on_quota_change, metrics=self._metrics)
+        self._metrics.start(port=metrics.port, snapshot_path=metrics.snapshot, snapshot_interval=metrics.snapshot_interval)
         self._num_written = 0
         self._log_frequency = 3600 # Write log message every 60min
         self._notify_frequency = notify_frequency
@@ -67,53 +348,111 @@ class ScraperStreamListener(tweepy.StreamListener):
         self._last_notification = time.time()
         self._last_notification_count = 0
         self._last_log_notification = time.time()
-        self._rate_limit_errors = 0
-        self._other_errors = 0
+        self._max_errors = max_errors
+        self._consecutive_errors = 0
+        self._last_data = None
+        self._last_connect = None
+        self.num_connections = 0
         self._milestone_size = 1000000
-        self._shard_max = shard_max
-        self._last_shard = 0 # <- should be unneeded, but let's play it safe
         _LOG.info("Starting collection.")
 
+    @property
+    def _gap_start(self):
+        # When the last tweet arrived, unless it was before the current connection
+        return max(self._last_data or 0, self._last_connect) if self._last_connect is not None else self._last_data
+
+    def on_connect(self):
+        self.num_connections += 1
+        self._last_connect = time.time()
+        gap = self._gaps.close()
+        if gap is not None:
+            self._emailer.send_text(
+                message="Reconnected after a {:.0f}s gap ({}); about {:,} tweets were missed.".format(
+                    gap['seconds'], gap['reason'], gap['estimated_missed']),
+                subject="[WARNING] {default_subject}")
+
     def on_error(self, status_code):
+        # The stream backs off before reconnecting: exponentially, and for
+        # longer after a 420.
+        self._errors.labels(status_code).inc()
+        self._gaps.open("HTTP {}".format(status_code), since=self._gap_start)
+        self._consecutive_errors += 1
+        if status_code in _FATAL_STATUS_CODES \
+           or (self._max_errors is not None and self._consecutive_errors >= self._max_errors):
+            _LOG.error("Giving up after error code {} ({} in a row). Closing at {}.".format(
+                status_code, self._consecutive_errors, time.strftime("%Y-%m-%d %H:%M:%S")))
+            self._emailer.send_text(
+                message="Disconnected scraper due to error code: {}".format(status_code),
+                subject="[ERROR] {default_subject}")
+            return False
         if status_code == 420:
-            _LOG.debug("Rate limited.")
-            self._rate_limit_errors += 1
-            if self._rate_limit_errors >= 3:
-                _LOG.error("Too many rate limit errors. Closing at {}.".format(time.strftime("%Y-%m-%d %H:%M:%S")))
-                self._emailer.send_text(
-                    message="Disconnected scraper due to error code: {}".format(status_code),
-                    subject="[ERROR] {default_subject}")
-                return False
+            _LOG.warning("Rate limited; backing off.")
         else:
-            _LOG.error("Error code received: {}".format(status_code))
-            self._other_errors += 1
-            if self._other_errors >= 2:
-                _LOG.error("Too many other errors in a row. Closing at {}.".format(time.strftime("%Y-%m-%d %H:%M:%S")))
-                self._emailer.send_text(
-                    message="Disconnected scraper due to error code: {}".format(status_code),
-                    subject="[ERROR] {default_subject}")
-                return False
+            _LOG.error("Error code received: {}; reconnecting.".format(status_code))
+
+    def _on_quota_change(self, level, previous):
+        # Called from the quota's thread
+        # Tweets not written while paused are a gap like any other, which
+        # backfill can fill in later
+        pausing = PAUSE in self._quota.policies
+        if pausing and not self._gaps.is_open:
+            self._gaps.open("paused: over the disk budget")
+            self._quota_gap = True
+        elif not pausing and self._quota_gap:
+            self._quota_gap = False
+            self._gaps.close()
+        message = self._quota.describe()
+        if level == OK:
+            self._emailer.send_text(message="Back under the disk budget's watermarks. " + message)
+        else:
+            self._emailer.send_text(message=message,
+                                    subject="[ERROR] {default_subject}" if level == HARD else "[WARNING] {default_subject}")
+
+    def on_timeout(self):
+        self._gaps.open("stalled", since=self._gap_start)
+
+    def on_exception(self, exception):
+        self._gaps.open("{}: {}".format(type(exception).__name__, exception), since=self._gap_start)
+
+    def on_disconnect(self, notice):
+        # Twitter closes the connection after this, and the stream reconnects
+        self._gaps.open("disconnected: {}".format(notice.get('reason', notice)), since=self._gap_start)
 
     @property
     def elapsed(self):
         return _ElapsedTime(time.time() - self._start)
 
+    @property
+    def metrics(self):
+        return self._metrics
+
     @property
     def next_milestone(self):
         return (int(self._num_written / self._milestone_size) + 1) * self._milestone_size
 
-    @property
-    def num_in_shard(self):
-        return self._num_written - self._last_shard
     
     def notify(self, send_email=False):
         self._last_log_notification = time.time()
         elapsed = self.elapsed
         next_milestone = self.next_milestone
         remaining_to_milestone = next_milestone - self._num_written
-        rate = self._num_written / float(elapsed.total_seconds)
-        eta = _ElapsedTime(remaining_to_milestone / rate)
-        message = "{:,} tweets have been collected so far (time elapsed: {}). The collection rate is an average of {} tweets/min. ETA to {:,} tweets: {}".format(self._num_written, elapsed, rate * 60, next_milestone, eta)
+        average = self._num_written / float(elapsed.total_seconds)
+        rates = self._metrics.rates('tweets_written_total')
+        # Windows which haven't been sampled yet fall back to the average
+        recent = dict((window, (rate if rate is not None else average) * 60) for window, rate in rates.items())
+        rate = rates.get('5m') or average
+        eta = _ElapsedTime(remaining_to_milestone / rate) if rate > 0 else "unknown"
+        message = "{:,} tweets have been collected so far (time elapsed: {}). The collection rate is {:,.0f} tweets/min over the last minute, {:,.0f} over 5 minutes and {:,.0f} over 15 minutes ({:,.0f} on average). ETA to {:,} tweets: {}".format(
+            self._num_written, elapsed, recent.get('1m', average * 60), recent.get('5m', average * 60),
+            recent.get('15m', average * 60), average * 60, next_milestone, eta)
+        dedup_stats = self._dedup.stats()
+        message += " Dedup index ({kind}): {size:,} ids in {memory_bytes:,}B, {hits:,} duplicates dropped, {misses:,} new.".format(**dedup_stats)
+        if self._trends is not None and self._trends_in_notify:
+            message += " " + self._trends.describe()
+        if self._sampler is not None:
+            message += " " + self._sampler.describe()
+        if self._quota is not None:
+            message += " " + self._quota.describe()
         _LOG.info(message)
         if send_email:
             self._last_notification = time.time()
@@ -132,37 +471,138 @@ class ScraperStreamListener(tweepy.StreamListener):
         if send_email or time.time() - self._last_log_notification > self._log_frequency:
             self.notify(send_email=send_email)
 
-    def shard_if_needed(self):
-        if self.num_in_shard >= self._shard_max:
-            self._last_shard = self._num_written
-            self._output.next_shard()
+
+    def _is_duplicate(self, id_str):
+        return self._dedup.check_and_add(id_str)
+
+    def _write_status(self, status):
+        if self._selector is not None:
+            status = self._selector(status)
+            if status is None:
+                return
+        if self._users is not None:
+            status = self._users.normalize(status)
+        self._write_record(json.dumps(status))
+
+    def _is_shed(self):
+        # Checked before the dedup index, so that tweets shed while paused
+        # aren't taken as seen, and backfilling the pause can still fetch them
+        if self._quota is not None and self._quota.paused:
+            self._shed.inc()
+            return True
+        return False
+
+    def _write_record(self, record):
+        self._output.write(record + "\n")
+        self._num_written += 1
+        self._written.inc()
+
+    def _after_status(self):
+        self._received.inc()
+        self._consecutive_errors = 0
+        self._last_data = time.time()
+        if self._engagement is not None:
+            self._engagement.flush_if_needed()
+        self.notify_if_needed()
+
+    def on_data(self, raw_data):
+        if self._trends is not None:
+            self._trends.add(raw_data)
+        if not self._raw:
+            return super(ScraperStreamListener, self).on_data(raw_data)
+        id_str, retweeted_id_str = extract_ids(raw_data)
+        if id_str is None:
+            # Not a status (or not one we can read cheaply); let tweepy handle it
+            return super(ScraperStreamListener, self).on_data(raw_data)
+        if self._engagement is not None:
+            if retweeted_id_str is not None:
+                self._engagement.add(retweeted_id_str, id_str, RETWEET)
+            elif _QUOTED_ID_KEY in raw_data:
+                quoted_match = _QUOTED_ID_RE.search(raw_data)
+                if quoted_match is not None:
+                    self._engagement.add(quoted_match.group(1), id_str, QUOTE)
+        if (self._sampler is not None and not self._sampler.keep(retweeted_id_str or id_str, id_str)) \
+                or self._is_shed():
+            self._after_status()
+            return
+        if retweeted_id_str is None:
+            if not self._is_duplicate(id_str):
+                if self._users is not None or self._selector is not None:
+                    # Selecting or normalizing means parsing every status after all
+                    self._write_status(json.loads(raw_data))
+                else:
+                    self._write_record(raw_data.rstrip("\r\n"))
+        elif not self._is_duplicate(retweeted_id_str):
+            # Flatten retweets. Only new originals pay for a full parse.
+            self._write_status(json.loads(raw_data)['retweeted_status'])
+        self._after_status()
 
     def on_status(self, status):
-        self._rate_limit_errors = 0
-        self._other_errors = 0
+        if self._engagement is not None:
+            if hasattr(status, 'retweeted_status'):
+                self._engagement.add(status.retweeted_status.id_str, status.id_str, RETWEET)
+            elif getattr(status, 'quoted_status_id_str', None):
+                self._engagement.add(status.quoted_status_id_str, status.id_str, QUOTE)
+        received_id = status.id_str
         # Flatten retweets
         if hasattr(status, 'retweeted_status'):
             status = status.retweeted_status
-        if status.id_str not in self._cache:
-            self._cache[status.id_str] = True
-            self._output.write(json.dumps(status._json))
-            self._output.write("\n")
-            self._num_written += 1
-        self.notify_if_needed()
-        self.shard_if_needed()
+        if (self._sampler is not None and not self._sampler.keep(status.id_str, received_id)) or self._is_shed():
+            self._after_status()
+            return
+        if not self._is_duplicate(status.id_str):
+            self._write_status(status._json)
+        self._after_status()
 
     def __enter__(self):
         return self
 
     def __exit__(self, *args):
+        if self._quota is not None:
+            self._quota.close()
+        # A gap still open here is never going to be resumed
+        self._gaps.close(resumed=False)
         self._output.close()
+        if self._trends is not None:
+            self._trends.close()
+        if self._user_output is not None:
+            self._user_output.close()
+        if self._engagement is not None:
+            self._engagement.flush()
+            self._engagement_output.close()
+        self._metrics.close()
+        if self._dedup_snapshot is not None:
+            _LOG.info("Saving dedup snapshot: {}".format(self._dedup_snapshot))
+            self._dedup.save(self._dedup_snapshot)
+        self._dedup.close()
+
+class _PlainHTTPAdapter(HTTPAdapter):
+    # tweepy always connects over https; this lets a stream talk to a local
+    # plain-http endpoint such as the replay server.
+    def send(self, request, **kwargs):
+        request.url = "http://" + request.url[len("https://"):]
+        return super(_PlainHTTPAdapter, self).send(request, **kwargs)
+
+class _ScraperStream(tweepy.Stream):
+    def __init__(self, auth, listener, secure=True, **options):
+        self._secure = secure
+        super(_ScraperStream, self).__init__(auth, listener, **options)
+
+    def new_session(self):
+        super(_ScraperStream, self).new_session()
+        if not self._secure:
+            self.session.mount("https://", _PlainHTTPAdapter())
+
+ENGINE_TWEEPY = 'tweepy'
+ENGINE_ASYNCIO = 'asyncio'
+ENGINES = (ENGINE_TWEEPY, ENGINE_ASYNCIO)
 
 class ScraperBuilder(object):
     def __init__(self):
         self._ignore_none = False
         self._follow = None
         self._track = None
-        self._async = False
+        self._is_async = False
         self._locations = None
         self._stall_warnings = False
         self._languages = None
@@ -175,6 +615,74 @@ class ScraperBuilder(object):
         self._s3_bucket = None
         self._s3_root = None
         self._shard_max = 50000
+        self._raw = False
+        self._background_writer = False
+        self._writer_queue_size = 10000
+        self._flush_bytes = 1 << 20
+        self._flush_interval = 1.0
+        self._backpressure = BACKPRESSURE_BLOCK
+        self._dedup = 'lru'
+        self._dedup_options = {}
+        self._dedup_snapshot = None
+        self._codec = 'none'
+        self._compression_level = None
+        self._shard_max_bytes = None
+        self._shard_max_compressed_bytes = None
+        self._shard_max_age = None
+        self._storage_dir = None
+        self._upload_workers = 2
+        self._upload_retries = 5
+        self._manifest = True
+        self._stream_url = None
+        self._api_url = None
+        self._config_file = None
+        self._hot_reload = False
+        self._control_socket = None
+        self._handoff_timeout = 90.0
+        self._auth = None
+        self._listener_class = ScraperStreamListener
+        self._metrics_port = None
+        self._metrics_snapshot = None
+        self._metrics_snapshot_interval = 60.0
+        self._workers = 1
+        self._shared_dedup_capacity = 1 << 20
+        self._dedup_index = None
+        self._engine = ENGINE_TWEEPY
+        self._stall_timeout = 90.0
+        self._gaps_log = None
+        self._max_errors = None
+        self._max_reconnects = None
+        self._shard_index = True
+        self._index_block_bytes = 1 << 20
+        self._columnar = False
+        self._keep_json = True
+        self._normalize_users = False
+        self._user_cache_size = 100000
+        self._keep_fields = None
+        self._drop_fields = None
+        self._predicates = None
+        self._engagement = False
+        self._engagement_capacity = 100000
+        self._engagement_flush_interval = 300.0
+        self._trends = False
+        self._trends_window = 300.0
+        self._trends_capacity = 1000
+        self._trends_top = 20
+        self._trends_in_notify = False
+        self._partition_by = None
+        self._max_open_partitions = 64
+        self._partition_idle_seconds = 300.0
+        self._disk_budget = None
+        self._disk_soft_watermark = 0.8
+        self._disk_hard_watermark = 0.95
+        self._disk_soft_policy = RECOMPRESS
+        self._disk_hard_policy = PAUSE
+        self._disk_sample_rate = 0.1
+        self._disk_recompress_codec = 'gzip'
+        self._sample_rate = 1.0
+        self._adaptive_sampling = False
+        self._min_sample_rate = 0.01
+        self._sampling_target_lag = 5.0
 
     @classmethod
     def load_config(cls, config_file):
@@ -183,8 +691,90 @@ class ScraperBuilder(object):
             ret = cls()
             for field in cfg:
                 getattr(ret, field)(cfg[field])
+            ret._config_file = config_file
             return ret
 
+    def _new_listener(self, adaptive_sampling=None, save_dedup=True):
+        if self._dedup_index is not None:
+            dedup = self._dedup_index
+        else:
+            dedup = make_dedup(self._dedup, snapshot=self._dedup_snapshot, **self._dedup_options)
+        output = OutputOptions(shard_max=self._shard_max,
+                               shard_max_bytes=self._shard_max_bytes,
+                               shard_max_compressed_bytes=self._shard_max_compressed_bytes,
+                               shard_max_age=self._shard_max_age,
+                               codec=get_codec(self._codec, level=self._compression_level),
+                               manifest=self._manifest,
+                               shard_index=self._shard_index,
+                               index_block_bytes=self._index_block_bytes,
+                               columnar=self._columnar,
+                               keep_json=self._keep_json,
+                               partition_by=self._partition_by,
+                               max_open_partitions=self._max_open_partitions,
+                               partition_idle_seconds=self._partition_idle_seconds,
+                               background=self._background_writer,
+                               queue_size=self._writer_queue_size,
+                               flush_bytes=self._flush_bytes,
+                               flush_interval=self._flush_interval,
+                               backpressure=self._backpressure)
+        upload = UploadOptions(s3_bucket=self._s3_bucket,
+                               s3_root=self._s3_root,
+                               storage_dir=self._storage_dir,
+                               workers=self._upload_workers,
+                               retries=self._upload_retries)
+        metrics = MetricsOptions(port=self._metrics_port,
+                                 snapshot=self._metrics_snapshot,
+                                 snapshot_interval=self._metrics_snapshot_interval)
+        users = None
+        if self._normalize_users:
+            users = UserOptions(cache_size=self._user_cache_size)
+        select = SelectOptions(keep_fields=self._keep_fields,
+                               drop_fields=self._drop_fields,
+                               predicates=self._predicates)
+        engagement = None
+        if self._engagement:
+            engagement = EngagementOptions(capacity=self._engagement_capacity,
+                                           flush_interval=self._engagement_flush_interval)
+        trends = None
+        if self._trends:
+            trends = TrendOptions(terms=self._track,
+                                  window=self._trends_window,
+                                  capacity=self._trends_capacity,
+                                  top=self._trends_top,
+                                  in_notify=self._trends_in_notify)
+        quota = None
+        if self._disk_budget is not None:
+            quota = QuotaOptions(self._disk_budget,
+                                 soft_watermark=self._disk_soft_watermark,
+                                 hard_watermark=self._disk_hard_watermark,
+                                 soft_policy=self._disk_soft_policy,
+                                 hard_policy=self._disk_hard_policy,
+                                 sample_rate=self._disk_sample_rate,
+                                 recompress_codec=self._disk_recompress_codec)
+        adaptive_sampling = self._adaptive_sampling if adaptive_sampling is None else adaptive_sampling
+        sampling = SamplingOptions(rate=self._sample_rate,
+                                   adaptive=adaptive_sampling,
+                                   min_rate=self._min_sample_rate,
+                                   target_lag=self._sampling_target_lag)
+        return self._listener_class(output_dir=self._output_dir,
+                                    emailer=self._emailer,
+                                    notify_count=self._notify_count,
+                                    notify_frequency=self._notify_seconds,
+                                    raw=self._raw,
+                                    dedup=dedup,
+                                    dedup_snapshot=self._dedup_snapshot if save_dedup else None,
+                                    gaps_log=self._gaps_log,
+                                    max_errors=self._max_errors,
+                                    output=output,
+                                    upload=upload,
+                                    metrics=metrics,
+                                    users=users,
+                                    select=select,
+                                    engagement=engagement,
+                                    trends=trends,
+                                    quota=quota,
+                                    sampling=sampling)
+
     @contextmanager
     def build(self):
         if all(x is None for x in [self._follow, self._track, self._locations]):
@@ -193,24 +783,106 @@ class ScraperBuilder(object):
         if self._output_dir is None:
             print("Output file is required.")
             sys.exit(1)
-        with ScraperStreamListener(emailer=self._emailer,
-                                   s3_bucket=self._s3_bucket,
-                                   s3_root=self._s3_root,
-                                   shard_max=self._shard_max,
-                                   output_dir=self._output_dir,
-                                   notify_frequency=self._notify_seconds,
-                                   notify_count=self._notify_count) as listener:
-            auth = get_auth()
-            stream = tweepy.Stream(auth, listener)
-            yield stream.filter(
-                follow=self._follow,
-                track=self._track,
-                async=self._async,
-                locations=self._locations,
-                stall_warnings=self._stall_warnings,
-                languages=self._languages,
-                encoding=self._encoding,
-                filter_level=self._filter_level)
+        if self._workers > 1:
+            from .partition import Supervisor
+            yield Supervisor(self, self._workers, dedup_capacity=self._shared_dedup_capacity).run()
+            return
+        with self._new_listener() as listener:
+            auth = self._auth or get_auth()
+            options = {}
+            if self._stream_url is not None:
+                url = urlparse(self._stream_url)
+                options = {'secure': url.scheme == 'https', 'host': url.netloc}
+            filters = dict(follow=self._follow,
+                           track=self._track,
+                           locations=self._locations,
+                           stall_warnings=self._stall_warnings,
+                           languages=self._languages,
+                           encoding=self._encoding,
+                           filter_level=self._filter_level)
+            if self._engine == ENGINE_ASYNCIO:
+                from . import async_stream
+                if self._hot_reload or self._control_socket is not None:
+                    _LOG.warning("Hot reload needs the tweepy engine; filters are fixed for this run.")
+                stream = async_stream.AsyncStream(auth, listener, stall_timeout=self._stall_timeout, **options)
+                connect = lambda: async_stream.run(stream.filter(**filters))
+            elif self._is_async:
+                # filter() returns straight away, so there's nothing to supervise
+                stream = _ScraperStream(auth, listener, **options)
+                yield stream.filter(is_async=True, **filters)
+                return
+            elif self._hot_reload or self._control_socket is not None:
+                yield self._run_reloadable(auth, listener, filters, options)
+                return
+            else:
+                stream = _ScraperStream(auth, listener, **options)
+                connect = lambda: stream.filter(**filters)
+            yield ReconnectSupervisor(connect, listener, max_retries=self._max_reconnects).run()
+
+    def _run_reloadable(self, auth, listener, filters, options):
+        from .handoff import ConfigWatcher, ConnectionManager, ControlServer, FILTER_FIELDS, install_reload_signal
+        config_file = self._config_file
+
+        def load_filters():
+            reloaded = ScraperBuilder.load_config(config_file)
+            return dict((k, getattr(reloaded, '_' + k)) for k in FILTER_FIELDS)
+
+        manager = ConnectionManager(lambda l: _ScraperStream(auth, l, **options), listener, filters,
+                                    load_filters=load_filters if config_file is not None else None,
+                                    handoff_timeout=self._handoff_timeout, max_reconnects=self._max_reconnects)
+        watcher = None
+        control = None
+        if self._hot_reload:
+            install_reload_signal(manager)
+            if config_file is not None:
+                watcher = ConfigWatcher(config_file, manager.reload)
+        if self._control_socket is not None:
+            control = ControlServer(self._control_socket, manager)
+        try:
+            return manager.run()
+        finally:
+            if watcher is not None:
+                watcher.close()
+            if control is not None:
+                control.close()
+
+    @contextmanager
+    def backfill(self, ranges, workers=4):
+        """
+        Fetches the tweets matching `track` and `follow` which were posted
+        during `ranges` ((since, until) pairs of seconds since the epoch,
+        such as the gaps in a gaps log) from the REST API, and writes them
+        through the same listener, dedup and output layout as `build`.
+        Yields the number of statuses fetched.
+
+        The output directory must not be the one a stream is writing to:
+        starting up would seal the stream's open shard and reuse its shard
+        numbers. A directory whose manifest still has open shards is
+        refused, and one in use is refused when the manifest is opened (see
+        ShardManifest).
+
+        The dedup snapshot, if any, is only read: tweets the stream had
+        written when it last saved it (on exit) are skipped, and the ids
+        fetched here are never written back, so the stream's own snapshot
+        is left as it was.
+        """
+        from .backfill import Backfill, backfill_queries
+        from .manifest import open_shards
+        if all(x is None for x in [self._follow, self._track]):
+            print("'follow' or 'track' is required.")
+            sys.exit(1)
+        if self._output_dir is None:
+            print("Output file is required.")
+            sys.exit(1)
+        if open_shards(self._output_dir):
+            print("{} has open shards, so a stream may be writing to it; backfill into a separate directory.".format(self._output_dir))
+            sys.exit(1)
+        # Backfilled tweets are old by definition, which adaptive sampling
+        # would take for falling behind
+        with self._new_listener(adaptive_sampling=False, save_dedup=False) as listener:
+            backfill = Backfill(self._auth or get_auth(), backfill_queries(self._track, self._follow), ranges,
+                                api_url=self._api_url, workers=workers, metrics=listener.metrics)
+            yield backfill.run(listener.on_data)
 
     def ignore_none(self, ignore_none=True):
         self._ignore_none = ignore_none
@@ -226,9 +898,9 @@ class ScraperBuilder(object):
             self._track = track
         return self
 
-    def async(self, async):
-        if not self._ignore_none or async is not None:
-            self._async = async
+    def is_async(self, is_async):
+        if not self._ignore_none or is_async is not None:
+            self._is_async = is_async
         return self
 
     def locations(self, locations):
@@ -295,4 +967,429 @@ class ScraperBuilder(object):
             self._shard_max = shard_max
         return self
 
+    def raw(self, raw):
+        if not self._ignore_none or raw is not None:
+            self._raw = raw
+        return self
+
+    def background_writer(self, background_writer):
+        if not self._ignore_none or background_writer is not None:
+            self._background_writer = background_writer
+        return self
+
+    def writer_queue_size(self, writer_queue_size):
+        if self._ignore_none and writer_queue_size is None:
+            return self
+        assert writer_queue_size > 0, "writer_queue_size must be greater than zero"
+        self._writer_queue_size = writer_queue_size
+        return self
+
+    def flush_bytes(self, flush_bytes):
+        if not self._ignore_none or flush_bytes is not None:
+            self._flush_bytes = flush_bytes
+        return self
+
+    def flush_interval(self, flush_interval):
+        if self._ignore_none and flush_interval is None:
+            return self
+        assert flush_interval > 0, "flush_interval must be greater than zero"
+        self._flush_interval = flush_interval
+        return self
+
+    def backpressure(self, backpressure):
+        if self._ignore_none and backpressure is None:
+            return self
+        assert backpressure in BACKPRESSURE_POLICIES, "backpressure must be one of: {}".format(", ".join(BACKPRESSURE_POLICIES))
+        self._backpressure = backpressure
+        return self
+
+    def dedup(self, dedup):
+        if self._ignore_none and dedup is None:
+            return self
+        assert dedup in DEDUP_KINDS, "dedup must be one of: {}".format(", ".join(sorted(DEDUP_KINDS)))
+        self._dedup = dedup
+        return self
+
+    def dedup_options(self, dedup_options):
+        if not self._ignore_none or dedup_options is not None:
+            self._dedup_options = dedup_options or {}
+        return self
+
+    def dedup_snapshot(self, dedup_snapshot):
+        if not self._ignore_none or dedup_snapshot is not None:
+            self._dedup_snapshot = dedup_snapshot
+        return self
+
+    def codec(self, codec):
+        if self._ignore_none and codec is None:
+            return self
+        assert codec in CODECS, "codec must be one of: {}".format(", ".join(sorted(CODECS)))
+        self._codec = codec
+        return self
+
+    def compression_level(self, compression_level):
+        if not self._ignore_none or compression_level is not None:
+            self._compression_level = compression_level
+        return self
+
+    def shard_max_bytes(self, shard_max_bytes):
+        if self._ignore_none and shard_max_bytes is None:
+            return self
+        assert shard_max_bytes is None or shard_max_bytes > 0, "shard_max_bytes must be greater than zero"
+        self._shard_max_bytes = shard_max_bytes
+        return self
+
+    def shard_max_compressed_bytes(self, shard_max_compressed_bytes):
+        if self._ignore_none and shard_max_compressed_bytes is None:
+            return self
+        assert shard_max_compressed_bytes is None or shard_max_compressed_bytes > 0, "shard_max_compressed_bytes must be greater than zero"
+        self._shard_max_compressed_bytes = shard_max_compressed_bytes
+        return self
+
+    def shard_max_age(self, shard_max_age):
+        if self._ignore_none and shard_max_age is None:
+            return self
+        assert shard_max_age is None or shard_max_age > 0, "shard_max_age must be greater than zero"
+        self._shard_max_age = shard_max_age
+        return self
+
+    def storage_dir(self, storage_dir):
+        if not self._ignore_none or storage_dir is not None:
+            self._storage_dir = storage_dir
+        return self
+
+    def upload_workers(self, upload_workers):
+        if self._ignore_none and upload_workers is None:
+            return self
+        assert upload_workers > 0, "upload_workers must be greater than zero"
+        self._upload_workers = upload_workers
+        return self
+
+    def upload_retries(self, upload_retries):
+        if self._ignore_none and upload_retries is None:
+            return self
+        assert upload_retries >= 0, "upload_retries must not be negative"
+        self._upload_retries = upload_retries
+        return self
+
+    def manifest(self, manifest):
+        if not self._ignore_none or manifest is not None:
+            self._manifest = manifest
+        return self
+
+    def stream_url(self, stream_url):
+        if not self._ignore_none or stream_url is not None:
+            self._stream_url = stream_url
+        return self
+
+    def api_url(self, api_url):
+        if not self._ignore_none or api_url is not None:
+            self._api_url = api_url
+        return self
+
+    def hot_reload(self, hot_reload):
+        if self._ignore_none and hot_reload is None:
+            return self
+        self._hot_reload = hot_reload
+        return self
+
+    def control_socket(self, control_socket):
+        if not self._ignore_none or control_socket is not None:
+            self._control_socket = control_socket
+        return self
+
+    def handoff_timeout(self, handoff_timeout):
+        if self._ignore_none and handoff_timeout is None:
+            return self
+        assert handoff_timeout > 0, "handoff_timeout must be greater than zero"
+        self._handoff_timeout = handoff_timeout
+        return self
+
+    def auth(self, auth):
+        if not self._ignore_none or auth is not None:
+            self._auth = auth
+        return self
+
+    def listener_class(self, listener_class):
+        if not self._ignore_none or listener_class is not None:
+            self._listener_class = listener_class
+        return self
+
+    def metrics_port(self, metrics_port):
+        if not self._ignore_none or metrics_port is not None:
+            self._metrics_port = metrics_port
+        return self
+
+    def metrics_snapshot(self, metrics_snapshot):
+        if not self._ignore_none or metrics_snapshot is not None:
+            self._metrics_snapshot = metrics_snapshot
+        return self
+
+    def metrics_snapshot_interval(self, metrics_snapshot_interval):
+        if self._ignore_none and metrics_snapshot_interval is None:
+            return self
+        assert metrics_snapshot_interval > 0, "metrics_snapshot_interval must be greater than zero"
+        self._metrics_snapshot_interval = metrics_snapshot_interval
+        return self
+
+    def workers(self, workers):
+        if self._ignore_none and workers is None:
+            return self
+        assert workers > 0, "workers must be greater than zero"
+        self._workers = workers
+        return self
+
+    def shared_dedup_capacity(self, shared_dedup_capacity):
+        if self._ignore_none and shared_dedup_capacity is None:
+            return self
+        assert shared_dedup_capacity > 0 and shared_dedup_capacity & (shared_dedup_capacity - 1) == 0, \
+            "shared_dedup_capacity must be a power of two"
+        self._shared_dedup_capacity = shared_dedup_capacity
+        return self
+
+    def dedup_index(self, dedup_index):
+        if not self._ignore_none or dedup_index is not None:
+            self._dedup_index = dedup_index
+        return self
+
+    def engine(self, engine):
+        if self._ignore_none and engine is None:
+            return self
+        assert engine in ENGINES, "engine must be one of: {}".format(", ".join(ENGINES))
+        self._engine = engine
+        return self
+
+    def stall_timeout(self, stall_timeout):
+        if self._ignore_none and stall_timeout is None:
+            return self
+        assert stall_timeout > 0, "stall_timeout must be greater than zero"
+        self._stall_timeout = stall_timeout
+        return self
+
+    def gaps_log(self, gaps_log):
+        if not self._ignore_none or gaps_log is not None:
+            self._gaps_log = gaps_log
+        return self
+
+    def max_errors(self, max_errors):
+        if self._ignore_none and max_errors is None:
+            return self
+        assert max_errors is None or max_errors > 0, "max_errors must be greater than zero"
+        self._max_errors = max_errors
+        return self
+
+    def max_reconnects(self, max_reconnects):
+        if self._ignore_none and max_reconnects is None:
+            return self
+        assert max_reconnects is None or max_reconnects >= 0, "max_reconnects must not be negative"
+        self._max_reconnects = max_reconnects
+        return self
+
+    def shard_index(self, shard_index):
+        if not self._ignore_none or shard_index is not None:
+            self._shard_index = shard_index
+        return self
+
+    def index_block_bytes(self, index_block_bytes):
+        if self._ignore_none and index_block_bytes is None:
+            return self
+        assert index_block_bytes > 0, "index_block_bytes must be greater than zero"
+        self._index_block_bytes = index_block_bytes
+        return self
+
+    def columnar(self, columnar):
+        if not self._ignore_none or columnar is not None:
+            self._columnar = columnar
+        return self
+
+    def keep_json(self, keep_json):
+        if not self._ignore_none or keep_json is not None:
+            self._keep_json = keep_json
+        return self
+
+    def normalize_users(self, normalize_users):
+        if not self._ignore_none or normalize_users is not None:
+            self._normalize_users = normalize_users
+        return self
+
+    def user_cache_size(self, user_cache_size):
+        if self._ignore_none and user_cache_size is None:
+            return self
+        assert user_cache_size > 0, "user_cache_size must be greater than zero"
+        self._user_cache_size = user_cache_size
+        return self
+
+    def keep_fields(self, keep_fields):
+        if self._ignore_none and keep_fields is None:
+            return self
+        assert keep_fields is None or isinstance(keep_fields, list), "keep_fields must be a list of dotted paths"
+        self._keep_fields = keep_fields
+        return self
+
+    def drop_fields(self, drop_fields):
+        if self._ignore_none and drop_fields is None:
+            return self
+        assert drop_fields is None or isinstance(drop_fields, list), "drop_fields must be a list of dotted paths"
+        self._drop_fields = drop_fields
+        return self
+
+    def predicates(self, predicates):
+        if self._ignore_none and predicates is None:
+            return self
+        assert predicates is None or isinstance(predicates, list), "predicates must be a list"
+        if predicates:
+            # Fail now rather than when the stream starts
+            RecordSelector(predicates=predicates)
+        self._predicates = predicates
+        return self
+
+    def engagement(self, engagement):
+        if self._ignore_none and engagement is None:
+            return self
+        self._engagement = engagement
+        return self
+
+    def engagement_capacity(self, engagement_capacity):
+        if self._ignore_none and engagement_capacity is None:
+            return self
+        assert engagement_capacity > 1, "engagement_capacity must be greater than one"
+        self._engagement_capacity = engagement_capacity
+        return self
+
+    def engagement_flush_interval(self, engagement_flush_interval):
+        if self._ignore_none and engagement_flush_interval is None:
+            return self
+        assert engagement_flush_interval > 0, "engagement_flush_interval must be greater than zero"
+        self._engagement_flush_interval = engagement_flush_interval
+        return self
+
+    def trends(self, trends):
+        if self._ignore_none and trends is None:
+            return self
+        self._trends = trends
+        return self
+
+    def trends_window(self, trends_window):
+        if self._ignore_none and trends_window is None:
+            return self
+        assert trends_window > 0, "trends_window must be greater than zero"
+        self._trends_window = trends_window
+        return self
+
+    def trends_capacity(self, trends_capacity):
+        if self._ignore_none and trends_capacity is None:
+            return self
+        assert trends_capacity > 0, "trends_capacity must be greater than zero"
+        self._trends_capacity = trends_capacity
+        return self
+
+    def trends_top(self, trends_top):
+        if self._ignore_none and trends_top is None:
+            return self
+        assert trends_top > 0, "trends_top must be greater than zero"
+        self._trends_top = trends_top
+        return self
+
+    def trends_in_notify(self, trends_in_notify):
+        if self._ignore_none and trends_in_notify is None:
+            return self
+        self._trends_in_notify = trends_in_notify
+        return self
+
+    def partition_by(self, partition_by):
+        if not self._ignore_none or partition_by is not None:
+            self._partition_by = partition_by
+        return self
+
+    def max_open_partitions(self, max_open_partitions):
+        if self._ignore_none and max_open_partitions is None:
+            return self
+        assert max_open_partitions > 0, "max_open_partitions must be greater than zero"
+        self._max_open_partitions = max_open_partitions
+        return self
+
+    def partition_idle_seconds(self, partition_idle_seconds):
+        if self._ignore_none and partition_idle_seconds is None:
+            return self
+        assert partition_idle_seconds > 0, "partition_idle_seconds must be greater than zero"
+        self._partition_idle_seconds = partition_idle_seconds
+        return self
+
+    def disk_budget(self, disk_budget):
+        if self._ignore_none and disk_budget is None:
+            return self
+        assert disk_budget is None or disk_budget > 0, "disk_budget must be greater than zero"
+        self._disk_budget = disk_budget
+        return self
+
+    def disk_soft_watermark(self, disk_soft_watermark):
+        if self._ignore_none and disk_soft_watermark is None:
+            return self
+        assert 0 < disk_soft_watermark <= 1, "disk_soft_watermark must be in (0, 1]"
+        self._disk_soft_watermark = disk_soft_watermark
+        return self
+
+    def disk_hard_watermark(self, disk_hard_watermark):
+        if self._ignore_none and disk_hard_watermark is None:
+            return self
+        assert 0 < disk_hard_watermark <= 1, "disk_hard_watermark must be in (0, 1]"
+        self._disk_hard_watermark = disk_hard_watermark
+        return self
+
+    def disk_soft_policy(self, disk_soft_policy):
+        if self._ignore_none and disk_soft_policy is None:
+            return self
+        assert disk_soft_policy in QUOTA_POLICIES, "disk_soft_policy must be one of: {}".format(", ".join(QUOTA_POLICIES))
+        self._disk_soft_policy = disk_soft_policy
+        return self
+
+    def disk_hard_policy(self, disk_hard_policy):
+        if self._ignore_none and disk_hard_policy is None:
+            return self
+        assert disk_hard_policy in QUOTA_POLICIES, "disk_hard_policy must be one of: {}".format(", ".join(QUOTA_POLICIES))
+        self._disk_hard_policy = disk_hard_policy
+        return self
+
+    def disk_sample_rate(self, disk_sample_rate):
+        if self._ignore_none and disk_sample_rate is None:
+            return self
+        assert 0 < disk_sample_rate <= 1, "disk_sample_rate must be in (0, 1]"
+        self._disk_sample_rate = disk_sample_rate
+        return self
+
+    def disk_recompress_codec(self, disk_recompress_codec):
+        if self._ignore_none and disk_recompress_codec is None:
+            return self
+        assert disk_recompress_codec in CODECS, "disk_recompress_codec must be one of: {}".format(", ".join(sorted(CODECS)))
+        self._disk_recompress_codec = disk_recompress_codec
+        return self
+
+    def sample_rate(self, sample_rate):
+        if self._ignore_none and sample_rate is None:
+            return self
+        assert 0 < sample_rate <= 1, "sample_rate must be in (0, 1]"
+        self._sample_rate = sample_rate
+        return self
+
+    def adaptive_sampling(self, adaptive_sampling):
+        if not self._ignore_none or adaptive_sampling is not None:
+            self._adaptive_sampling = adaptive_sampling
+        return self
+
+    def min_sample_rate(self, min_sample_rate):
+        if self._ignore_none and min_sample_rate is None:
+            return self
+        assert 0 < min_sample_rate <= 1, "min_sample_rate must be in (0, 1]"
+        self._min_sample_rate = min_sample_rate
+        return self
+
+    def sampling_target_lag(self, sampling_target_lag):
+        if self._ignore_none and sampling_target_lag is None:
+            return self
+        assert sampling_target_lag > 0, "sampling_target_lag must be greater than zero"
+        self._sampling_target_lag = sampling_target_lag
+        return self
 
+# `async` is a keyword from Python 3.7, so the setter can't be defined under that
+# name, but existing configs and callers using getattr() keep working.
+setattr(ScraperBuilder, 'async', ScraperBuilder.is_async)
@@ -0,0 +1,271 @@
+import array
+import bisect
+import mmap
+import os
+import re
+import six
+import struct
+
+from .compression import codec_for_filename
+from .log import get_logger
+
+_LOG = get_logger('shard_index')
+
+INDEX_EXTENSION = '.idx'
+
+_MAGIC = b'TSIX'
+_VERSION = 1
+# magic, version, reserved, number of records, number of blocks, min and max
+# created_at (ms since the epoch)
+_HEADER = struct.Struct('=4sHHQQqq')
+_ID = struct.Struct('=q')
+# The first id_str in a status is its own (see scraper.extract_ids)
+_ID_STR_RE = re.compile(br'"id_str":\s*"(\d+)"')
+# Tweet ids are snowflakes: milliseconds since this epoch, shifted left 22 bits
+_TWEPOCH_MS = 1288834974657
+
+
+def created_at_ms(tweet_id):
+    """
+    When a tweet was created, in milliseconds since the epoch, read straight
+    out of its id.
+    """
+    return (tweet_id >> 22) + _TWEPOCH_MS
+
+
+def first_id_at(ms):
+    """
+    The smallest tweet id which could have been created at or after `ms`.
+    """
+    return max(0, ms - _TWEPOCH_MS) << 22
+
+
+def record_id(data):
+    """
+    The id of the status in a raw record, found without parsing it, or None.
+    """
+    match = _ID_STR_RE.search(data)
+    return int(match.group(1)) if match is not None else None
+
+
+def index_filename(filename):
+    return filename + INDEX_EXTENSION
+
+
+def _tobytes(a):
+    return a.tostring() if six.PY2 else a.tobytes()
+
+
+def _int64s(buf, start, count):
+    # `count` int64s from `start` in `buf`; a view of them where memoryview
+    # can be cast (Python 3), otherwise a copy
+    if six.PY2:
+        ret = array.array('q')
+        ret.fromstring(buf[start:start + count * 8])
+        return ret
+    return memoryview(buf)[start:start + count * 8].cast('q')
+
+
+class ShardIndexBuilder(object):
+    """
+    Collects the id and uncompressed offset of every record as a shard is
+    written, plus where each compressed block (gzip member or zstd frame)
+    starts, and writes them out as a sidecar when the shard is sealed.
+
+    The sidecar holds a header, the block table as (compressed offset,
+    uncompressed offset) pairs, then the ids in sorted order followed by the
+    matching record offsets, all as native 64-bit integers so that readers
+    can use them straight out of an mmap.
+    """
+    def __init__(self):
+        self._ids = array.array('q')
+        self._offsets = array.array('q')
+        self._blocks = array.array('q')
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add_block(self, compressed_offset, uncompressed_offset):
+        self._blocks.extend((compressed_offset, uncompressed_offset))
+
+    def add_records(self, data, base_offset, num_records):
+        """
+        Indexes `num_records` newline-terminated records in `data`, which
+        starts `base_offset` bytes into the uncompressed shard.
+        """
+        ids, offsets = self._ids, self._offsets
+        search = _ID_STR_RE.search
+        pos = 0
+        for _ in range(num_records):
+            end = data.find(b"\n", pos)
+            match = search(data, pos, end)
+            if match is not None:
+                ids.append(int(match.group(1)))
+                offsets.append(base_offset + pos)
+            pos = end + 1
+
+    def write(self, path):
+        # Ids mostly arrive in order (only flattened retweets don't), which
+        # is the best case for the sort
+        order = sorted(range(len(self._ids)), key=self._ids.__getitem__)
+        ids = array.array('q', (self._ids[i] for i in order))
+        offsets = array.array('q', (self._offsets[i] for i in order))
+        min_created = created_at_ms(ids[0]) if ids else 0
+        max_created = created_at_ms(ids[-1]) if ids else 0
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, 0, len(ids), len(self._blocks) // 2, min_created, max_created))
+            f.write(_tobytes(self._blocks))
+            f.write(_tobytes(ids))
+            f.write(_tobytes(offsets))
+        os.rename(tmp_path, path)
+
+
+def build_index(filename):
+    """
+    Writes the sidecar for an existing shard by reading it through. Block
+    boundaries can't be recovered this way, so for compressed shards
+    lookups decompress from the start of the file.
+    """
+    codec = codec_for_filename(filename)
+    builder = ShardIndexBuilder()
+    if codec.extension:
+        builder.add_block(0, 0)
+    offset = 0
+    with open(filename, "rb") as raw:
+        for line in codec.open_reader(raw):
+            if line.endswith(b"\n"):
+                builder.add_records(line, offset, 1)
+            offset += len(line)
+    builder.write(index_filename(filename))
+    return len(builder)
+
+
+def read_summary(read_range):
+    """
+    Reads just enough of a sidecar to describe its shard, through
+    `read_range(start, length)`, so that it's cheap even when the index is
+    remote. Returns a dict of the number of records, the smallest and
+    largest ids (None if there are no records), and the min/max created_at.
+    """
+    magic, version, _, count, num_blocks, min_created, max_created = _HEADER.unpack(read_range(0, _HEADER.size))
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError("Not a shard index")
+    summary = {'records': count, 'min_id': None, 'max_id': None,
+               'min_created_ms': min_created, 'max_created_ms': max_created}
+    if count > 0:
+        ids_start = _HEADER.size + num_blocks * 16
+        summary['min_id'] = _ID.unpack(read_range(ids_start, _ID.size))[0]
+        summary['max_id'] = _ID.unpack(read_range(ids_start + (count - 1) * _ID.size, _ID.size))[0]
+    return summary
+
+
+class ShardReader(object):
+    """
+    Random access to the records of a shard through its sidecar index. The
+    index (and uncompressed shards) are memory-mapped, so opening a reader
+    costs the same whatever the shard's size. Compressed shards are read a
+    block at a time, keeping the last block decompressed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._codec = codec_for_filename(filename)
+        with open(index_filename(filename), "rb") as f:
+            self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, count, num_blocks, self.min_created_ms, self.max_created_ms = \
+            _HEADER.unpack_from(self._index, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("Not a shard index: {}".format(index_filename(filename)))
+        offset = _HEADER.size
+        blocks = _int64s(self._index, offset, num_blocks * 2).tolist()
+        self._block_compressed = blocks[0::2]
+        self._block_starts = blocks[1::2]
+        offset += num_blocks * 16
+        self._ids = _int64s(self._index, offset, count)
+        offset += count * 8
+        self._offsets = _int64s(self._index, offset, count)
+        self._raw = open(filename, "rb")
+        self._data = None
+        if not self._codec.extension:
+            self._data = mmap.mmap(self._raw.fileno(), 0, access=mmap.ACCESS_READ) \
+                if os.path.getsize(filename) > 0 else b""
+        self._cached_block = None
+        self._cached_data = None
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, tweet_id):
+        return self._find(int(tweet_id)) is not None
+
+    @property
+    def ids(self):
+        return self._ids
+
+    def _find(self, tweet_id):
+        i = bisect.bisect_left(self._ids, tweet_id)
+        if i < len(self._ids) and self._ids[i] == tweet_id:
+            return i
+        return None
+
+    def _block(self, i):
+        if self._cached_block != i:
+            self._raw.seek(self._block_compressed[i])
+            reader = self._codec.open_reader(self._raw)
+            if i + 1 < len(self._block_starts):
+                self._cached_data = reader.read(self._block_starts[i + 1] - self._block_starts[i])
+            else:
+                self._cached_data = reader.read()
+            self._cached_block = i
+        return self._cached_data
+
+    def record_at(self, offset):
+        """
+        Returns the record starting `offset` bytes into the uncompressed shard.
+        """
+        if self._data is not None:
+            data, start = self._data, offset
+        else:
+            i = bisect.bisect_right(self._block_starts, offset) - 1
+            data, start = self._block(i), offset - self._block_starts[i]
+        end = data.find(b"\n", start)
+        return data[start:end if end >= 0 else len(data)]
+
+    def get(self, tweet_id):
+        """
+        Returns the raw record for `tweet_id`, or None if it isn't in the shard.
+        """
+        i = self._find(int(tweet_id))
+        return self.record_at(self._offsets[i]) if i is not None else None
+
+    def ids_between(self, min_id=None, max_id=None):
+        """
+        Yields the records with ids in [min_id, max_id], in file order so
+        that each compressed block is only decompressed once.
+        """
+        lo = 0 if min_id is None else bisect.bisect_left(self._ids, min_id)
+        hi = len(self._ids) if max_id is None else bisect.bisect_right(self._ids, max_id)
+        for offset in sorted(self._offsets[lo:hi]):
+            yield self.record_at(offset)
+
+    def range(self, start_ms=None, end_ms=None):
+        """
+        Yields the records of tweets created in [start_ms, end_ms).
+        """
+        return self.ids_between(None if start_ms is None else first_id_at(start_ms),
+                                None if end_ms is None else first_id_at(end_ms) - 1)
+
+    def close(self):
+        if not six.PY2:
+            self._ids.release()
+            self._offsets.release()
+        self._index.close()
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
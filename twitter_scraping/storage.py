@@ -0,0 +1,184 @@
+import abc
+import boto3
+import hashlib
+import os
+import shutil
+import six
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+from .auth import check_boto_credentials
+from .log import get_logger
+
+_LOG = get_logger('storage')
+
+_CHUNK_SIZE = 1 << 20
+_MB = 1 << 20
+
+
+def file_checksum(filename):
+    """
+    Hex SHA-256 of a file's contents.
+    """
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            chunk = f.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class UploadError(Exception):
+    pass
+
+
+@six.add_metaclass(abc.ABCMeta)
+class StorageBackend(object):
+    """
+    Somewhere finished shards can be uploaded to.
+    """
+    @abc.abstractmethod
+    def upload(self, filename, key):
+        """
+        Uploads `filename` to `key`, raising an exception if the stored copy
+        can't be verified against the local file.
+        """
+        pass
+
+    @abc.abstractmethod
+    def describe(self, key):
+        """
+        Human-readable location of `key`, for logging.
+        """
+        pass
+
+    def list(self, prefix=""):
+        """
+        Yields the keys stored under `prefix`.
+        """
+        raise NotImplementedError("{} can't be listed".format(type(self).__name__))
+
+    def open(self, key):
+        """
+        Returns a binary file object streaming the contents of `key`.
+        """
+        raise NotImplementedError("{} can't be read".format(type(self).__name__))
+
+    def read_range(self, key, start, length):
+        """
+        Returns `length` bytes of `key` from offset `start`.
+        """
+        with self.open(key) as f:
+            f.read(start)
+            return f.read(length)
+
+
+class LocalStorage(StorageBackend):
+    """
+    Stores uploads under a local directory. Useful for testing and
+    benchmarking without AWS, or for moving shards onto another volume.
+    """
+    def __init__(self, root):
+        self._root = root
+
+    def path(self, key):
+        return os.path.join(self._root, key)
+
+    def describe(self, key):
+        return self.path(key)
+
+    def upload(self, filename, key):
+        dest = self.path(key)
+        if not os.path.exists(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        tmp_dest = "{}.part".format(dest)
+        shutil.copyfile(filename, tmp_dest)
+        expected = file_checksum(filename)
+        actual = file_checksum(tmp_dest)
+        if expected != actual:
+            os.remove(tmp_dest)
+            raise UploadError("Checksum mismatch for {}: expected {}, got {}".format(dest, expected, actual))
+        os.rename(tmp_dest, dest)
+
+    def list(self, prefix=""):
+        top = self.path(prefix)
+        if os.path.isfile(top):
+            yield prefix
+            return
+        for dirpath, _, filenames in os.walk(top):
+            for filename in filenames:
+                yield os.path.relpath(os.path.join(dirpath, filename), self._root).replace(os.sep, "/")
+
+    def open(self, key):
+        return open(self.path(key), "rb")
+
+    def read_range(self, key, start, length):
+        with open(self.path(key), "rb") as f:
+            f.seek(start)
+            return f.read(length)
+
+
+class S3Storage(StorageBackend):
+    """
+    Uploads to an S3 bucket, creating it if needed. S3 validates a SHA-256
+    checksum of every part as it's received, so a successful upload doesn't
+    need a separate HEAD request to verify it. The whole-file checksum is
+    also stored in the object's metadata for consumers.
+
+    Readers should pass `create_bucket=False`. The client is recreated when
+    the storage is unpickled, so it can be handed to other processes.
+    """
+    def __init__(self, bucket, multipart_threshold=8 * _MB, multipart_chunksize=16 * _MB, max_concurrency=4,
+                 create_bucket=True):
+        assert bucket is not None, "Bucket name must not be None."
+        check_boto_credentials()
+        self._bucket_name = bucket
+        self._client = boto3.client('s3')
+        self._transfer_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                               multipart_chunksize=multipart_chunksize,
+                                               max_concurrency=max_concurrency,
+                                               use_threads=max_concurrency > 1)
+        if not create_bucket:
+            return
+        try:
+            self._client.head_bucket(Bucket=bucket)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchBucket'):
+                raise
+            # Create the bucket if it doesn't exist
+            self._client.create_bucket(Bucket=bucket)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_client']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._client = boto3.client('s3')
+
+    def describe(self, key):
+        return "s3://{}/{}".format(self._bucket_name, key)
+
+    def list(self, prefix=""):
+        paginator = self._client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self._bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
+    def open(self, key):
+        return self._client.get_object(Bucket=self._bucket_name, Key=key)['Body']
+
+    def read_range(self, key, start, length):
+        response = self._client.get_object(Bucket=self._bucket_name, Key=key,
+                                           Range="bytes={}-{}".format(start, start + length - 1))
+        return response['Body'].read()
+
+    def upload(self, filename, key):
+        self._client.upload_file(filename, self._bucket_name, key,
+                                 ExtraArgs={'ChecksumAlgorithm': 'SHA256',
+                                            'Metadata': {'sha256': file_checksum(filename)}},
+                                 Config=self._transfer_config)
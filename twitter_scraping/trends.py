@@ -0,0 +1,386 @@
+import collections
+import glob
+import heapq
+import json
+import multiprocessing
+import os
+import re
+import time
+
+from six.moves import queue
+from six.moves.urllib.parse import urlparse
+
+from .file_utils import ShardListener
+from .log import get_logger
+
+_LOG = get_logger('trends')
+
+TRENDS_DIRECTORY = "trends"
+CATEGORIES = ('hashtags', 'mentions', 'domains', 'terms')
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+# Statuses' own entities start with hashtags (users' entities don't)
+_ENTITIES_RE = re.compile(r'"entities":\s*(?=\{\s*"hashtags")')
+_TEXT_RE = re.compile(r'"text":\s*(?=")')
+_FULL_TEXT_RE = re.compile(r'"full_text":\s*(?=")')
+_STATUS_KEY = '"in_reply_to_status_id"'
+_DECODER = json.JSONDecoder()
+_WINDOW_TEMPLATE = "window-{}.json"
+_WINDOW_START_RE = re.compile(r'window-(\d+)\.json$')
+_SEALED = 'sealed'
+_POLL_INTERVAL = 1.0
+
+
+class SpaceSaving(object):
+    """
+    Approximate counts of the most frequent of a stream of items, in
+    `capacity` slots (the space-saving algorithm). An item arriving when the
+    slots are full takes over the least counted one, inheriting its count
+    as the item's possible overcount (`error`). Any item occurring more than
+    total / capacity times is guaranteed to be held.
+    """
+    def __init__(self, capacity):
+        assert capacity > 0, "capacity must be greater than zero"
+        self._capacity = capacity
+        self._counts = {}
+        self._errors = {}
+        # One entry per held item, whose count may be behind; they're only
+        # brought up to date when they reach the top
+        self._heap = []
+        self.total = 0
+
+    def __len__(self):
+        return len(self._counts)
+
+    def add(self, item):
+        self.total += 1
+        counts = self._counts
+        count = counts.get(item)
+        if count is not None:
+            counts[item] = count + 1
+            return
+        if len(counts) < self._capacity:
+            counts[item] = 1
+            heapq.heappush(self._heap, (1, item))
+            return
+        heap = self._heap
+        while True:
+            count, victim = heap[0]
+            current = counts[victim]
+            if current == count:
+                break
+            heapq.heapreplace(heap, (current, victim))
+        del counts[victim]
+        self._errors.pop(victim, None)
+        counts[item] = count + 1
+        self._errors[item] = count
+        heapq.heapreplace(heap, (count + 1, item))
+
+    def top(self, n=None):
+        """
+        The `n` (default all) most counted items, as (item, count, error)
+        tuples; the true count is between count - error and count.
+        """
+        ranked = sorted(self._counts.items(), key=lambda item: (-item[1], item[0]))
+        return [(item, count, self._errors.get(item, 0)) for item, count in ranked[:n]]
+
+
+def _term_matcher(terms):
+    # Like the streaming API: a phrase matches when all its words appear
+    phrases = [(term, frozenset(_WORD_RE.findall(term.lower()))) for term in terms or []]
+    phrases = [(term, words) for term, words in phrases if words]
+    if not phrases:
+        return None
+
+    def match(text):
+        words = set(_WORD_RE.findall(text.lower()))
+        return [term for term, phrase in phrases if phrase <= words]
+    return match
+
+
+def _domain(url):
+    netloc = urlparse(url).netloc.lower()
+    return netloc[4:] if netloc.startswith("www.") else netloc
+
+
+def _from_entities(entities, items):
+    for hashtag in entities.get('hashtags') or ():
+        items['hashtags'].append(hashtag['text'].lower())
+    for mention in entities.get('user_mentions') or ():
+        items['mentions'].append(mention['screen_name'].lower())
+    for url in entities.get('urls') or ():
+        domain = _domain(url.get('expanded_url') or url.get('url') or "")
+        if domain:
+            items['domains'].append(domain)
+
+
+def _decode_at(raw, regex):
+    match = regex.search(raw)
+    if match is None:
+        return None
+    try:
+        return _DECODER.raw_decode(raw, match.end())[0]
+    except ValueError:
+        return None
+
+
+def status_items(status, match_terms=None):
+    """
+    The hashtags, mentions, URL domains and tracked terms of a status, as a
+    dict of category to lists. `status` may be parsed or a raw message; only
+    the entities and text of raw ones are decoded.
+    """
+    items = {'hashtags': [], 'mentions': [], 'domains': [], 'terms': []}
+    if isinstance(status, dict):
+        extended = status.get('extended_tweet') or {}
+        entities = extended.get('entities') or status.get('entities')
+        text = extended.get('full_text') or status.get('text')
+    else:
+        entities = _decode_at(status, _ENTITIES_RE)
+        text = _decode_at(status, _FULL_TEXT_RE) or _decode_at(status, _TEXT_RE) if match_terms is not None else None
+    if isinstance(entities, dict):
+        _from_entities(entities, items)
+    if match_terms is not None and text:
+        items['terms'] = match_terms(text)
+    return items
+
+
+class _Counts(object):
+    def __init__(self, capacity, start=None):
+        self.start = start or time.time()
+        self.statuses = 0
+        self.sketches = dict((category, SpaceSaving(capacity)) for category in CATEGORIES)
+
+    def add(self, items):
+        self.statuses += 1
+        for category, values in items.items():
+            add = self.sketches[category].add
+            for value in values:
+                add(value)
+
+    def summary(self, top, end):
+        ret = collections.OrderedDict([
+            ('start_ms', int(self.start * 1000)),
+            ('end_ms', int(end * 1000)),
+            ('statuses', self.statuses),
+        ])
+        for category in CATEGORIES:
+            ret[category] = [collections.OrderedDict([('item', item), ('count', count), ('error', error)])
+                             for item, count, error in self.sketches[category].top(top)]
+        return ret
+
+
+class _SealListener(ShardListener):
+    def __init__(self, tracker, downstream):
+        self._tracker = tracker
+        self._downstream = downstream
+
+    def shard_opened(self, filename):
+        if self._downstream is not None:
+            self._downstream.shard_opened(filename)
+
+    def handle_shard(self, filename):
+        self._tracker.shard_sealed(filename)
+        if self._downstream is not None:
+            self._downstream.handle_shard(filename)
+
+    def close(self):
+        if self._downstream is not None:
+            self._downstream.close()
+
+
+class _Counter(object):
+    # The state kept by the counting process
+    def __init__(self, directory, terms, window_seconds, capacity, top):
+        self._directory = directory
+        self._match_terms = _term_matcher(terms)
+        self._window_seconds = window_seconds
+        self._capacity = capacity
+        self._top = top
+        self._window = _Counts(capacity)
+        self._shard = _Counts(capacity)
+
+    def _write(self, name, summary):
+        path = os.path.join(self._directory, name)
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "w") as f:
+            json.dump(summary, f)
+        os.rename(tmp_path, path)
+
+    def count(self, messages):
+        match_terms = self._match_terms
+        for message in messages:
+            if _STATUS_KEY not in message:
+                continue
+            items = status_items(message, match_terms)
+            self._window.add(items)
+            self._shard.add(items)
+
+    def end_window_if_due(self, force=False):
+        now = time.time()
+        if now - self._window.start < self._window_seconds and not (force and self._window.statuses):
+            return
+        summary = self._window.summary(self._top, now)
+        self._write(_WINDOW_TEMPLATE.format(summary['start_ms']), summary)
+        self._window = _Counts(self._capacity, start=now)
+
+    def seal(self, filename):
+        now = time.time()
+        name = os.path.basename(filename)
+        summary = self._shard.summary(self._top, now)
+        summary['shard'] = name
+        self._write("{}.json".format(name.split(".", 1)[0]), summary)
+        self._shard = _Counts(self._capacity, start=now)
+
+
+def _count_worker(tasks, directory, terms, window_seconds, capacity, top):
+    counter = _Counter(directory, terms, window_seconds, capacity, top)
+    while True:
+        try:
+            task = tasks.get(timeout=_POLL_INTERVAL)
+        except queue.Empty:
+            counter.end_window_if_due()
+            continue
+        if task is None:
+            break
+        try:
+            if isinstance(task, tuple):
+                counter.seal(task[1])
+            else:
+                counter.count(task)
+            counter.end_window_if_due()
+        except Exception:
+            _LOG.exception("Failed to count trends")
+    counter.end_window_if_due(force=True)
+
+
+class TrendTracker(object):
+    """
+    Keeps the top hashtags, mentions, expanded URL domains and tracked
+    `terms` of the stream messages passed to `add`, over windows of
+    `window_seconds` and over each shard, in `capacity` slots per category
+    (see SpaceSaving). The `top` items of each are written to `directory`
+    as window-<start ms>.json when the window ends, and <shard>.json when a
+    shard is sealed (see `listener`).
+
+    Counting happens in a separate process, so `add` only appends to a
+    batch, which is handed over every `batch_size` messages (or
+    `batch_interval` seconds). Batches are dropped if `queue_size` are
+    already waiting. Shard summaries cover the messages added while the
+    shard was being written, so with a background writer they can be off
+    by the records still queued at the edges. Sealed shards which can't be
+    handed over are tried again with the next batch; past `queue_size` of
+    them, the oldest are dropped and get no summary.
+    """
+    def __init__(self, directory, terms=None, window_seconds=300.0, capacity=1000, top=20,
+                 batch_size=500, batch_interval=1.0, queue_size=100):
+        assert window_seconds > 0, "window_seconds must be greater than zero"
+        assert batch_size > 0, "batch_size must be greater than zero"
+        self._directory = directory
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._batch = []
+        self._last_batch = time.time()
+        # Sealed shards, noted from the writer's thread and sent from add's
+        self._seals = collections.deque()
+        # Sealed shards which didn't fit in the queue, oldest first
+        self._unsent = collections.deque()
+        self._queue_size = queue_size
+        self.num_queued = 0
+        self.num_dropped = 0
+        self.num_seals_dropped = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._tasks = multiprocessing.Queue(maxsize=queue_size)
+        self._process = multiprocessing.Process(name='trends', target=_count_worker,
+                                                args=(self._tasks, directory, terms, window_seconds, capacity, top))
+        self._process.daemon = True
+        self._process.start()
+
+    def add(self, message):
+        """
+        Counts a raw stream message (anything but a status is ignored).
+        """
+        self._batch.append(message)
+        if len(self._batch) >= self._batch_size or self._seals \
+                or time.time() - self._last_batch >= self._batch_interval:
+            self._send()
+
+    def _send_seals(self):
+        # Returns whether every unsent seal was handed over
+        while self._unsent:
+            try:
+                self._tasks.put_nowait((_SEALED, self._unsent[0]))
+            except queue.Full:
+                return False
+            self._unsent.popleft()
+        return True
+
+    def _send(self):
+        batch, self._batch = self._batch, []
+        self._last_batch = time.time()
+        # Seals left over from before go ahead of the batch, which belongs
+        # to a later shard; if they still don't fit, neither would it
+        sent = self._send_seals()
+        if batch and sent:
+            try:
+                self._tasks.put_nowait(batch)
+                self.num_queued += len(batch)
+                batch = None
+            except queue.Full:
+                pass
+        if batch:
+            self.num_dropped += len(batch)
+        # Only after the batch, which was written into the sealed shard
+        while self._seals:
+            self._unsent.append(self._seals.popleft())
+        if sent:
+            self._send_seals()
+        while len(self._unsent) > self._queue_size:
+            _LOG.warning("Trend counter fell behind; no summary for {}".format(self._unsent.popleft()))
+            self.num_seals_dropped += 1
+
+    def shard_sealed(self, filename):
+        self._seals.append(filename)
+
+    def listener(self, downstream):
+        """
+        A ShardListener which notes each sealed shard, then passes it on to
+        `downstream`.
+        """
+        return _SealListener(self, downstream)
+
+    @property
+    def latest(self):
+        """
+        The summary of the last complete window, or None.
+        """
+        windows = glob.glob(os.path.join(self._directory, _WINDOW_TEMPLATE.format("*")))
+        if not windows:
+            return None
+        with open(max(windows, key=lambda path: int(_WINDOW_START_RE.search(path).group(1)))) as f:
+            return json.load(f)
+
+    def describe(self, n=5):
+        """
+        The top `n` items of each category in the last complete window, for
+        notifications.
+        """
+        latest = self.latest
+        if latest is None:
+            return "No trends yet."
+        parts = []
+        for category in CATEGORIES:
+            items = latest[category][:n]
+            if items:
+                parts.append("{}: {}".format(category, ", ".join(
+                    "{} ({:,})".format(entry['item'], entry['count']) for entry in items)))
+        return "Top items over the last {:.0f}s: {}.".format(
+            (latest['end_ms'] - latest['start_ms']) / 1000.0, "; ".join(parts) or "none")
+
+    def close(self):
+        self._send()
+        while self._unsent:
+            self._tasks.put((_SEALED, self._unsent.popleft()))
+        self._tasks.put(None)
+        self._process.join()
@@ -0,0 +1,157 @@
+import collections
+import hashlib
+import json
+import re
+
+from .compression import codec_for_filename
+from .log import get_logger
+
+_LOG = get_logger('users')
+
+USERS_DIRECTORY = "users"
+USERS_TEMPLATE = "users-shard-{n}.json"
+USERS_PATTERN = "users-shard-*.json*"
+
+# Counters which change with nearly every tweet. They stay in each tweet's
+# reference, so that a profile only counts as changed when the user edits it.
+VOLATILE_FIELDS = ('followers_count', 'friends_count', 'listed_count', 'favourites_count', 'statuses_count')
+# Kept in each reference as well as the profile, so that tweets can still be
+# attributed (e.g. in columnar shards) without joining the profiles
+IDENTITY_FIELDS = ('id', 'screen_name')
+# Statuses which can be embedded in others, each with its own user
+_NESTED_STATUSES = ('retweeted_status', 'quoted_status')
+_PROFILE_KEY_RE = re.compile(br'"id_str":\s*"(\d+)",\s*"profile":\s*"([0-9a-f]+)"')
+
+
+def _version(profile):
+    # repr is several times faster than serializing, and only has to be
+    # consistent within a run (the store is keyed by whatever was written)
+    return hashlib.md5(repr(profile).encode('utf-8')).hexdigest()[:16]
+
+
+class UserNormalizer(object):
+    """
+    Replaces the user objects embedded in statuses with references of the
+    form {"id_str", "profile", "id", "screen_name", <volatile counters>},
+    where `profile` is a hash of the rest of the user object. Each version
+    of a profile is written (as a JSON line, with its id_str and profile
+    hash first) through `write` the first time it's seen.
+
+    The most recent version of up to `cache_size` users is remembered; a
+    user who drops out of the cache has their profile written again the
+    next time they appear, which readers ignore.
+    """
+    def __init__(self, write, cache_size=100000):
+        assert cache_size > 0, "cache_size must be greater than zero"
+        self._write = write
+        self._cache_size = cache_size
+        self._versions = collections.OrderedDict()
+        self.num_written = 0
+        self.num_reused = 0
+
+    def _reference(self, user):
+        id_str = user.get('id_str')
+        if id_str is None:
+            return user
+        profile = dict((k, v) for k, v in user.items() if k not in VOLATILE_FIELDS)
+        version = _version(profile)
+        # Popped and re-added to keep the cache in least recently used order
+        if self._versions.pop(id_str, None) == version:
+            self.num_reused += 1
+        else:
+            record = collections.OrderedDict([('id_str', id_str), ('profile', version)])
+            record.update((k, v) for k, v in profile.items() if k != 'id_str')
+            self._write(json.dumps(record))
+            self.num_written += 1
+        self._versions[id_str] = version
+        if len(self._versions) > self._cache_size:
+            self._versions.popitem(last=False)
+        ret = {'id_str': id_str, 'profile': version}
+        for k in IDENTITY_FIELDS + VOLATILE_FIELDS:
+            if k in user:
+                ret[k] = user[k]
+        return ret
+
+    def normalize(self, status):
+        """
+        Returns a copy of `status` (a parsed tweet) with its user objects,
+        and those of any statuses embedded in it, replaced by references.
+        """
+        status = dict(status)
+        if isinstance(status.get('user'), dict):
+            status['user'] = self._reference(status['user'])
+        for key in _NESTED_STATUSES:
+            if isinstance(status.get(key), dict):
+                status[key] = self.normalize(status[key])
+        return status
+
+
+class ProfileStore(object):
+    """
+    The profiles written by a UserNormalizer, for rebuilding normalized
+    statuses. Profiles are kept as raw bytes and only parsed when used.
+    """
+    def __init__(self):
+        self._profiles = {}
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def add(self, line):
+        match = _PROFILE_KEY_RE.search(line)
+        if match is None:
+            return
+        key = (match.group(1).decode('ascii'), match.group(2).decode('ascii'))
+        self._profiles.setdefault(key, line)
+
+    @classmethod
+    def load(cls, storage, prefix=USERS_DIRECTORY, processes=1):
+        """
+        Reads every profile shard under `prefix` in `storage`.
+        """
+        from .reader import ShardQuery
+        ret = cls()
+        for line in ShardQuery(storage, prefix=prefix, processes=processes, raw=True, pattern=USERS_PATTERN):
+            ret.add(line)
+        return ret
+
+    def _user(self, reference):
+        line = self._profiles.get((reference.get('id_str'), reference.get('profile')))
+        if line is None:
+            return None
+        user = json.loads(line.decode('utf-8'))
+        del user['profile']
+        user.update((k, v) for k, v in reference.items() if k != 'profile')
+        return user
+
+    def rebuild_shard(self, filename, dest):
+        """
+        Writes the statuses of the shard `filename`, rebuilt, to `dest`
+        (uncompressed).
+        """
+        from .reader import read_lines
+        with open(filename, "rb") as raw, open(dest, "wb") as out:
+            for line in read_lines(codec_for_filename(filename).open_reader(raw)):
+                try:
+                    status = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    _LOG.warning("Skipping unparseable record in {}".format(filename))
+                    continue
+                out.write(json.dumps(self.rebuild(status)).encode('utf-8') + b"\n")
+
+    def rebuild(self, status):
+        """
+        Returns `status` with its user references replaced by the full user
+        objects. References to unknown profiles are left as they are.
+        """
+        user = status.get('user')
+        if isinstance(user, dict) and 'profile' in user:
+            full = self._user(user)
+            if full is not None:
+                status['user'] = full
+            else:
+                _LOG.warning("No profile {} for user {}".format(user.get('profile'), user.get('id_str')))
+        for key in _NESTED_STATUSES:
+            if isinstance(status.get(key), dict):
+                self.rebuild(status[key])
+        return status